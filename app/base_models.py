@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, conint
 from typing import List
 
 class Token(BaseModel):
@@ -52,12 +52,19 @@ class UpdateProduct(BaseModel):
     expiration_date: str | None = None
     images: List[str] | None = None
 
+class StockShards(BaseModel):
+    shards: int
+
+# Largest values of the INT and SMALLINT columns order payloads are saved to
+MAX_ID = 2**31 - 1
+MAX_QUANTITY = 32767
+
 class Product_Quantity(BaseModel):
-    product_id: int
+    product_id: conint(le=MAX_ID)
     quantity: int
 
 class NewOrder(BaseModel):
-    client_id: int
+    client_id: conint(le=MAX_ID)
     products: List[Product_Quantity]
 
 class UpdateOrder(BaseModel):
@@ -0,0 +1,276 @@
+'''Fills the database with synthetic clients, products (with images), orders and order lines, so benchmarks and query plans
+can be checked at production volumes.
+
+Run from the /app folder, on a database nobody else is writing to:
+
+    python -m benchmarks.dataset --clients 2000000 --products 300000 --orders 20000000 --workers 8
+    python -m benchmarks.dataset --orders 1000000 --start-date 01/01/2022 --end-date 31/12/2025 --date-skew 1.5 \
+        --status-weights "Entregue=70,Em transporte=10,Nova=7,Em separação=5,Cancelada=8" --section-weights "Bebidas=3,Higiene=0.5"
+
+Rows are generated in chunks by --workers processes, each loading its chunks with COPY on a connection of its own.
+New rows are added to the existing ones, and running it again adds more.
+'''
+import argparse
+import multiprocessing
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+import bulk_import
+import db_operations
+import utils
+
+# Rows generated and copied at a time by a worker
+CHUNK_SIZE = 50000
+# Products whose images are copied at a time
+IMAGE_BATCH_SIZE = 500
+# Clients get CPFs (CPF_MULTIPLIER * n + CPF_OFFSET) % 10^9 for increasing n, all different since the multiplier is coprime with 10^9
+CPF_MULTIPLIER = 387420489
+CPF_OFFSET = 123456789
+# Barcodes of generated products start with this, out of the range of real EAN-13 codes from Brazil (789/790)
+BARCODE_PREFIX = '20'
+
+FIRST_NAMES = ['Ana', 'Bruno', 'Carla', 'Daniel', 'Eduarda', 'Felipe', 'Gabriela', 'Henrique', 'Isabela', 'João', 'Karina', 'Lucas',
+    'Mariana', 'Nicolas', 'Olivia', 'Pedro', 'Rafaela', 'Samuel', 'Tatiana', 'Vinicius', 'Laurence', 'Wilda', 'Eunice', 'Juliet']
+LAST_NAMES = ['Silva', 'Santos', 'Oliveira', 'Souza', 'Lima', 'Pereira', 'Costa', 'Ferreira', 'Almeida', 'Ribeiro', 'Carvalho',
+    'Gomes', 'Martins', 'Rocha', 'Howe', 'Gonzales', 'Shaw', 'Wiley', 'Curtis', 'Stout', 'Rose', 'Richardson']
+PRODUCT_NAMES = ['Leite', 'Queijo', 'Iogurte', 'Arroz', 'Feijão', 'Café', 'Presunto', 'Pão', 'Bolo', 'Refrigerante', 'Suco',
+    'Picanha', 'Frango', 'Tomate', 'Banana', 'Sabonete', 'Shampoo', 'Detergente', 'Amaciante', 'Biscoito']
+PRODUCT_VARIANTS = ['Integral', 'Desnatado', 'Tradicional', 'Light', 'Orgânico', 'Premium', 'Zero', 'Caseiro', 'Família', 'Mini']
+
+def parse_weights(text: str | None, names: list) -> np.ndarray:
+    '''Converts "name=weight,..." into probabilities in the order of names. Names left out weigh 1.
+    Raises ValueError for unknown names or invalid weights.
+    '''
+    weights = {name: 1.0 for name in names}
+    for item in (text or '').split(','):
+        if item.strip() == '':
+            continue
+        name, _, weight = item.partition('=')
+        if name.strip() not in weights:
+            raise ValueError(f"Unknown name: {name.strip()}")
+        weights[name.strip()] = float(weight)
+    probabilities = np.array([weights[name] for name in names], dtype=float)
+    if (probabilities < 0).any() or probabilities.sum() == 0:
+        raise ValueError("Weights must not be negative and must not all be 0")
+    return probabilities / probabilities.sum()
+
+def format_cents(cents: np.ndarray) -> list:
+    return [f"{value // 100}.{value % 100:02d}" for value in cents.tolist()]
+
+def format_timestamps(seconds: np.ndarray) -> list:
+    return [text + '+00' for text in np.datetime_as_string(seconds.astype(np.int64).astype('datetime64[s]'), unit='s').tolist()]
+
+def load_clients(task: tuple) -> int:
+    '''Generates and inserts count clients numbered from start. Returns how many were inserted (CPFs or emails already used are skipped).
+    '''
+    start, count, seed = task
+    rng = np.random.default_rng(seed)
+    numbers = np.arange(start, start + count, dtype=np.int64)
+    first_names = np.array(FIRST_NAMES)[rng.integers(len(FIRST_NAMES), size=count)]
+    last_names = np.array(LAST_NAMES)[rng.integers(len(LAST_NAMES), size=count)]
+    cpfs = utils.generate_cpfs((CPF_MULTIPLIER * numbers + CPF_OFFSET) % 10**9)
+    rows = [
+        (f"{first} {last}", f"{first.lower()}.{last.lower()}.{number}@example.com", cpf)
+        for first, last, number, cpf in zip(first_names.tolist(), last_names.tolist(), numbers.tolist(), cpfs)
+    ]
+    db_connection = db_operations.postgres_connection()
+    try:
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("CREATE TEMP TABLE clients_import (name VARCHAR(50), email VARCHAR(50), cpf CHAR(11)) ON COMMIT DROP")
+        bulk_import.copy_rows(db_cursor, 'clients_import', ('name', 'email', 'cpf'), rows)
+        db_cursor.execute("INSERT INTO clients (name, email, cpf) SELECT name, email, cpf FROM clients_import ON CONFLICT DO NOTHING")
+        inserted = db_cursor.rowcount
+        db_connection.commit()
+        return inserted
+    finally:
+        db_connection.close()
+
+def load_products(task: tuple) -> int:
+    '''Generates and inserts count products numbered from start, each with images_per_product random images of image_size bytes.
+    Returns how many were inserted (barcodes already used are skipped).
+    '''
+    start, count, seed, section_ids, section_p, images_per_product, image_size = task
+    rng = np.random.default_rng(seed)
+    numbers = np.arange(start, start + count, dtype=np.int64)
+    names = np.array(PRODUCT_NAMES)[rng.integers(len(PRODUCT_NAMES), size=count)]
+    variants = np.array(PRODUCT_VARIANTS)[rng.integers(len(PRODUCT_VARIANTS), size=count)]
+    # Prices between R$1 and a few hundred, most of them cheap
+    prices = np.clip(np.round(rng.lognormal(np.log(1500), 1, size=count)), 100, 9999999).astype(np.int64)
+    sections = np.array(section_ids)[rng.choice(len(section_ids), size=count, p=section_p)]
+    stocks = rng.integers(0, 1000, size=count)
+    expiration_days = rng.integers(30, 730, size=count)
+    has_expiration = rng.random(count) < .6
+    today = np.datetime64(datetime.now(timezone.utc).date())
+    expirations = np.datetime_as_string(today + expiration_days.astype('timedelta64[D]'), unit='D').tolist()
+    rows = [
+        (f"{name} {variant} {number}", price, f"{BARCODE_PREFIX}{number:011d}", section, stock, expiration if expires else None)
+        for name, variant, number, price, section, stock, expiration, expires in zip(
+            names.tolist(), variants.tolist(), numbers.tolist(), format_cents(prices), sections.tolist(), stocks.tolist(), expirations, has_expiration.tolist())
+    ]
+    db_connection = db_operations.postgres_connection()
+    try:
+        db_cursor = db_connection.cursor()
+        db_cursor.execute("""
+            CREATE TEMP TABLE products_import (
+                description VARCHAR(50), sell_value DECIMAL(9,2), barcode VARCHAR(50), section_id SMALLINT, stock INT, expiration_date DATE
+            ) ON COMMIT DROP
+        """)
+        bulk_import.copy_rows(db_cursor, 'products_import', ('description', 'sell_value', 'barcode', 'section_id', 'stock', 'expiration_date'), rows)
+        db_cursor.execute("""
+            INSERT INTO products (description, sell_value, barcode, section_id, stock, expiration_date)
+            SELECT description, sell_value, barcode, section_id, stock, expiration_date FROM products_import
+            ON CONFLICT DO NOTHING
+            RETURNING id
+        """)
+        product_ids = [row[0] for row in db_cursor.fetchall()]
+        # Images are copied a few at a time, their size would otherwise multiply the memory of a chunk
+        for index in range(0, len(product_ids) if images_per_product > 0 else 0, IMAGE_BATCH_SIZE):
+            images = [
+                (product_id, '\\x' + rng.bytes(image_size).hex())
+                for product_id in product_ids[index:index + IMAGE_BATCH_SIZE] for _ in range(images_per_product)
+            ]
+            bulk_import.copy_rows(db_cursor, 'images', ('product_id', 'image'), images)
+        db_connection.commit()
+        return len(product_ids)
+    finally:
+        db_connection.close()
+
+# Set in each worker by init_order_worker, so the id arrays are sent once per worker instead of once per chunk
+order_state = {}
+
+def init_order_worker(state: dict):
+    order_state.update(state)
+
+def load_orders(task: tuple) -> int:
+    '''Generates and inserts count orders with ids from first_id, with their lines. Returns the number of lines.
+    '''
+    first_id, count, seed = task
+    state = order_state
+    rng = np.random.default_rng(seed)
+    ids = np.arange(first_id, first_id + count, dtype=np.int64)
+    # A skew above 0 moves orders toward the end date, like a growing store
+    created_at = state['start'] + (state['end'] - state['start']) * rng.random(count) ** (1 / (1 + state['date_skew']))
+    statuses = state['status_ids'][rng.choice(len(state['status_ids']), size=count, p=state['status_p'])]
+    clients = state['client_ids'][rng.integers(len(state['client_ids']), size=count)]
+    line_counts = rng.integers(1, state['max_items'] + 1, size=count)
+    products = rng.choice(len(state['product_ids']), size=int(line_counts.sum()), p=state['product_p'])
+    quantities = rng.integers(1, state['max_quantity'] + 1, size=len(products))
+    prices = state['product_prices'][products]
+    starts = np.concatenate([[0], np.cumsum(line_counts)[:-1]])
+    item_counts = np.add.reduceat(quantities, starts)
+    totals = np.add.reduceat(quantities * prices, starts)
+
+    # updated_at is the load time, so the sales rollups pick the new orders up on their next refresh
+    orders = zip(ids.tolist(), format_timestamps(created_at), statuses.tolist(), clients.tolist(), item_counts.tolist(), format_cents(totals))
+    lines = zip(np.repeat(ids, line_counts).tolist(), state['product_ids'][products].tolist(), quantities.tolist(), format_cents(prices))
+    db_connection = db_operations.postgres_connection()
+    try:
+        db_cursor = db_connection.cursor()
+        bulk_import.copy_rows(db_cursor, 'orders', ('id', 'created_at', 'status', 'client_id', 'item_count', 'total_value', 'updated_at'),
+            [order + (state['loaded_at'],) for order in orders])
+        bulk_import.copy_rows(db_cursor, 'orders_products', ('order_id', 'product_id', 'quantity', 'unit_price'), list(lines))
+        db_connection.commit()
+        return len(products)
+    finally:
+        db_connection.close()
+
+def get_tasks(start: int, total: int, seed: int) -> list:
+    return [(start + offset, min(CHUNK_SIZE, total - offset), seed + index) for index, offset in enumerate(range(0, total, CHUNK_SIZE))]
+
+def run(pool, function, tasks: list, label: str) -> int:
+    done = 0
+    result = 0
+    started_at = time.perf_counter()
+    for count in pool.imap_unordered(function, tasks):
+        done += 1
+        result += count
+        print(f"\r{label}: {done}/{len(tasks)} chunks, {time.perf_counter() - started_at:.0f}s", end='', flush=True)
+    if len(tasks) > 0:
+        print()
+    return result
+
+def main(args):
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    sections = db_operations.select(db_cursor, "SELECT id, name FROM sections ORDER BY id")
+    statuses = db_operations.select(db_cursor, "SELECT id, description FROM order_status ORDER BY id")
+    section_p = parse_weights(args.section_weights, [name for _, name in sections])
+    status_p = parse_weights(args.status_weights, [description for _, description in statuses])
+    start = datetime.strptime(args.start_date, "%d/%m/%Y").replace(tzinfo=timezone.utc).timestamp()
+    end = datetime.strptime(args.end_date, "%d/%m/%Y").replace(tzinfo=timezone.utc).timestamp() + 86399
+    seed = args.seed if args.seed != None else int(time.time())
+
+    with multiprocessing.Pool(args.workers) as pool:
+        first = db_operations.select(db_cursor, "SELECT COALESCE(MAX(id), 0) + 1 FROM clients", fetch=1)[0]
+        inserted = run(pool, load_clients, get_tasks(first, args.clients, seed), 'clients')
+        print(f"{inserted} clients inserted")
+
+        first = db_operations.select(db_cursor, "SELECT COALESCE(MAX(id), 0) + 1 FROM products", fetch=1)[0]
+        tasks = [
+            task + ([id for id, _ in sections], section_p, args.images_per_product, args.image_size)
+            for task in get_tasks(first, args.products, seed + 1000000)
+        ]
+        inserted = run(pool, load_products, tasks, 'products')
+        print(f"{inserted} products inserted")
+
+    if args.orders > 0:
+        client_ids = np.array([row[0] for row in db_operations.select(db_cursor, "SELECT id FROM clients")], dtype=np.int64)
+        products = db_operations.select(db_cursor, "SELECT id, (sell_value * 100)::bigint, section_id FROM products")
+        if len(client_ids) == 0 or len(products) == 0:
+            raise SystemExit("There must be clients and products to generate orders")
+        weight_by_section = {id: weight for (id, _), weight in zip(sections, section_p)}
+        product_p = np.array([weight_by_section[section_id] for _, _, section_id in products], dtype=float)
+        if product_p.sum() == 0:
+            raise SystemExit("All products are in sections weighing 0")
+        # Ids are reserved in advance, so orders and their lines can be copied by the workers in parallel
+        last_id = db_operations.select(db_cursor, """
+            SELECT setval(pg_get_serial_sequence('orders', 'id'), GREATEST((SELECT COALESCE(MAX(id), 0) FROM orders), nextval(pg_get_serial_sequence('orders', 'id'))) + %s)
+        """, (args.orders,), fetch=1)[0]
+        db_connection.commit()
+        state = {
+            'client_ids': client_ids,
+            'product_ids': np.array([id for id, _, _ in products], dtype=np.int64),
+            'product_prices': np.array([price for _, price, _ in products], dtype=np.int64),
+            'product_p': product_p / product_p.sum(),
+            'status_ids': np.array([id for id, _ in statuses], dtype=np.int64),
+            'status_p': status_p,
+            'start': start,
+            'end': end,
+            'date_skew': args.date_skew,
+            'max_items': args.max_items,
+            'max_quantity': args.max_quantity,
+            'loaded_at': datetime.now(timezone.utc).isoformat(),
+        }
+        with multiprocessing.Pool(args.workers, initializer=init_order_worker, initargs=(state,)) as pool:
+            lines = run(pool, load_orders, get_tasks(last_id - args.orders + 1, args.orders, seed + 2000000), 'orders')
+        print(f"{args.orders} orders and {lines} order lines inserted")
+
+    # Fresh statistics, so the planner sees the new volumes right away
+    db_connection.autocommit = True
+    db_cursor.execute("ANALYZE clients, products, images, orders, orders_products")
+    db_cursor.close()
+    db_connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fills the database with synthetic data at production volumes.")
+    parser.add_argument('--clients', type=int, default=1000000, help="Clients to add.")
+    parser.add_argument('--products', type=int, default=200000, help="Products to add.")
+    parser.add_argument('--orders', type=int, default=10000000, help="Orders to add, spread over the existing and new clients and products.")
+    parser.add_argument('--images-per-product', type=int, default=1, help="Images of each new product.")
+    parser.add_argument('--image-size', type=int, default=8192, help="Bytes of each image.")
+    parser.add_argument('--max-items', type=int, default=5, help="Most lines in an order, from 1.")
+    parser.add_argument('--max-quantity', type=int, default=3, help="Most units in an order line, from 1.")
+    parser.add_argument('--start-date', default='01/01/2023', help="First day of the orders (dd/mm/aaaa).")
+    parser.add_argument('--end-date', default=datetime.now(timezone.utc).strftime('%d/%m/%Y'), help="Last day of the orders (dd/mm/aaaa).")
+    parser.add_argument('--date-skew', type=float, default=0, help="0 spreads orders evenly over the dates, higher values put more of them near the end date.")
+    parser.add_argument('--status-weights', help='Relative weights of order statuses, e.g. "Entregue=70,Cancelada=5". Statuses left out weigh 1.')
+    parser.add_argument('--section-weights', help='Relative weights of sections in new products and in order lines, e.g. "Bebidas=3". Sections left out weigh 1.')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="Processes generating and copying rows.")
+    parser.add_argument('--seed', type=int, help="Seed for repeatable data.")
+    args = parser.parse_args()
+    try:
+        main(args)
+    except ValueError as error:
+        parser.error(str(error))
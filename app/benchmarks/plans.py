@@ -0,0 +1,195 @@
+'''Snapshots of the query plans of the list routes, for every combination of their filters.
+
+Run from the /app folder, on a database filled by benchmarks/dataset.py:
+
+    python -m benchmarks.plans --update
+    python -m benchmarks.plans
+    python -m benchmarks.plans --route orders --strict
+
+Each plan is reduced to its shape: the scan of each table (sequential, index or bitmap) with the index used, and the join,
+sort and aggregate strategies, leaving out costs and row estimates. --update saves the shapes to benchmarks/plan_snapshots.
+Otherwise they are compared with the saved ones, exiting with 1 when a plan degrades: a table read through an index in the
+snapshot is now read sequentially. Other changes are only reported, unless --strict is given.
+'''
+import argparse
+import itertools
+import json
+import os
+import re
+import sys
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+from fastapi import HTTPException
+
+import db_operations
+from benchmarks.run import get_commit
+from routers import clients, orders, products
+
+SNAPSHOTS_DIR = os.path.join(os.path.dirname(__file__), 'plan_snapshots')
+
+# Builder of the query of each list route, called with a cursor and filters, and the values tried for each filter.
+# Every combination of filters is explained, each filter taking each of its values.
+ROUTES = {
+    'clients': (lambda db_cursor, **filters: clients.get_clients_query(**filters), {
+        'filter': ['silva', 'ana.silva@'],
+        'offset': [10000],
+    }),
+    'products': (products.get_products_query, {
+        'category': ['Bebidas'],
+        'sell_value': [20],
+        'available': [True],
+        'q': ['leite'],
+        'offset': [10000],
+    }),
+    'orders': (orders.get_orders_query, {
+        'start_date': ['01/01/2025'],
+        'end_date': ['31/01/2025'],
+        'section': ['Bebidas'],
+        'id': [1],
+        'order_status': ['Entregue'],
+        'client_id': [1],
+        'min_total': [100],
+        'max_total': [200],
+        'sort_by': ['-created_at', 'total_value'],
+        'offset': [10000],
+    }),
+}
+
+SCAN = re.compile(r'^\s*(?P<node>.*?Scan) on (?P<relation>\S+)(?: using (?P<index>\S+))?$')
+
+def get_combinations(values: dict) -> list:
+    '''Returns every combination of filters, from none to all of them, as dicts of filter and value.
+    '''
+    combinations = []
+    names = list(values)
+    for size in range(len(names) + 1):
+        for subset in itertools.combinations(names, size):
+            for chosen in itertools.product(*[values[name] for name in subset]):
+                combinations.append(dict(zip(subset, chosen)))
+    return combinations
+
+def get_shape(plan: dict, depth: int = 0) -> list:
+    '''Returns a line for each node of an EXPLAIN (FORMAT JSON) plan, indented by depth, e.g.
+    "Hashed Aggregate", "Hash Join (Inner)" or "Index Scan on orders using orders_pkey".
+    '''
+    node = plan['Node Type']
+    if plan.get('Strategy') not in (None, 'Plain'):
+        node = f"{plan['Strategy']} {node}"
+    if 'Join Type' in plan:
+        node += f" ({plan['Join Type']})"
+    if 'Relation Name' in plan:
+        node += f" on {plan['Relation Name']}"
+    if 'Index Name' in plan:
+        node += f" using {plan['Index Name']}"
+    lines = ['  ' * depth + node]
+    for child in plan.get('Plans', []):
+        lines += get_shape(child, depth + 1)
+    return lines
+
+def get_scans(shape: list) -> dict:
+    '''Returns the scan nodes of a shape by table.
+    '''
+    scans = {}
+    for line in shape:
+        match = SCAN.match(line)
+        if match != None:
+            scans.setdefault(match.group('relation'), set()).add(match.group('node'))
+    return scans
+
+def explain_route(db_cursor, route: str) -> dict:
+    '''Returns the shape of the plan of each combination of filters of a route, by the query string of the request.
+    Combinations the route refuses get the error instead of a shape.
+    '''
+    builder, values = ROUTES[route]
+    shapes = {}
+    for filters in get_combinations(values):
+        key = f"GET /{route}" + (f"?{urlencode(filters)}" if len(filters) > 0 else '')
+        try:
+            query, args = builder(db_cursor, **filters)
+        except HTTPException as error:
+            shapes[key] = [f"error {error.status_code}: {error.detail}"]
+            continue
+        result = db_operations.select(db_cursor, "EXPLAIN (FORMAT JSON) " + query, args, fetch=1)
+        shapes[key] = get_shape(result[0][0]['Plan'])
+    return shapes
+
+def compare(snapshot: dict, shapes: dict) -> tuple:
+    '''Compares the shapes of a route with its snapshot. Returns the degradations and the other changes, as messages.
+    '''
+    degradations = []
+    changes = []
+    for key, old_shape in snapshot.items():
+        if key not in shapes:
+            changes.append(f"{key}: no longer explained")
+            continue
+        new_shape = shapes[key]
+        if new_shape == old_shape:
+            continue
+        old_scans = get_scans(old_shape)
+        for relation, nodes in get_scans(new_shape).items():
+            if 'Seq Scan' in nodes and relation in old_scans and 'Seq Scan' not in old_scans[relation]:
+                degradations.append(f"{key}: {relation} read by Seq Scan, was {', '.join(sorted(old_scans[relation]))}")
+        changes.append(f"{key}: plan changed\n    was:\n      " + '\n      '.join(old_shape) + "\n    now:\n      " + '\n      '.join(new_shape))
+    for key in shapes:
+        if key not in snapshot:
+            changes.append(f"{key}: not in the snapshot")
+    return degradations, changes
+
+def get_snapshot_path(route: str) -> str:
+    return os.path.join(SNAPSHOTS_DIR, f"{route}.json")
+
+def load_snapshot(route: str) -> dict | None:
+    '''Returns the saved shapes of a route, None if it has no snapshot.
+    '''
+    try:
+        with open(get_snapshot_path(route)) as file:
+            return json.load(file)['plans']
+    except FileNotFoundError:
+        return None
+
+def save_snapshot(route: str, shapes: dict):
+    os.makedirs(SNAPSHOTS_DIR, exist_ok=True)
+    with open(get_snapshot_path(route), 'w') as file:
+        json.dump({
+            'commit': get_commit(),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'plans': shapes,
+        }, file, indent=4, ensure_ascii=False)
+
+def main(args) -> int:
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    failed = False
+    try:
+        for route in args.route or list(ROUTES):
+            shapes = explain_route(db_cursor, route)
+            if args.update:
+                save_snapshot(route, shapes)
+                print(f"{route}: {len(shapes)} plans saved to {get_snapshot_path(route)}")
+                continue
+            snapshot = load_snapshot(route)
+            if snapshot == None:
+                print(f"{route}: no snapshot, run with --update first")
+                failed = True
+                continue
+            degradations, changes = compare(snapshot, shapes)
+            print(f"{route}: {len(shapes)} plans, {len(degradations)} degraded, {len(changes)} changed")
+            for message in degradations:
+                print(f"  DEGRADED {message}")
+            for message in changes:
+                print(f"  {message}")
+            if len(degradations) > 0 or (args.strict and len(changes) > 0):
+                failed = True
+    finally:
+        db_connection.rollback()
+        db_cursor.close()
+        db_connection.close()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Snapshots of the query plans of the list routes, for every combination of their filters.")
+    parser.add_argument('--route', action='append', choices=list(ROUTES), help="Route to explain, may be repeated. Defaults to all.")
+    parser.add_argument('--update', action='store_true', help="Save the plans as the new snapshots instead of comparing.")
+    parser.add_argument('--strict', action='store_true', help="Fail on any change of plan, not only on degradations.")
+    sys.exit(main(parser.parse_args()))
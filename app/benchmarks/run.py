@@ -0,0 +1,141 @@
+'''Load test of the API with a mix of realistic scenarios.
+
+Run from the /app folder, against the app in this process (default) or a running server:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --scenario catalog --scenario order_filters --concurrency 50 --iterations 2000
+    python -m benchmarks.run --url http://localhost:80 --compare benchmarks/results/20250601-101500-1a2b3c4.json
+
+Results are saved as JSON in benchmarks/results, named after the time and commit, to be compared between commits.
+'''
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+from benchmarks.scenarios import SCENARIOS, Recorder, setup
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+def percentile(values: list, percent: float) -> float:
+    '''Nearest rank percentile of sorted values.
+    '''
+    if len(values) == 0:
+        return 0
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+def summarize(samples: list, duration: float) -> dict:
+    latencies = sorted(latency for latency, _, _ in samples)
+    queries = [count for _, _, count in samples if count != None]
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for _, status_code, _ in samples if status_code >= 400),
+        'rps': round(len(samples) / duration, 2) if duration > 0 else 0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2) if len(latencies) > 0 else 0,
+        'queries_per_request': round(sum(queries) / len(queries), 2) if len(queries) > 0 else None,
+    }
+
+async def run_scenario(http_client, name: str, state: dict, concurrency: int, iterations: int) -> dict:
+    '''Runs iterations of the scenario from concurrency simultaneous users. Returns the summary of each request of the scenario.
+    '''
+    scenario = SCENARIOS[name]
+    recorder = Recorder()
+    remaining = iterations
+
+    async def user():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await scenario(http_client, recorder, state)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[user() for _ in range(concurrency)])
+    duration = time.perf_counter() - start
+    all_samples = [sample for samples in recorder.samples.values() for sample in samples]
+    return {
+        'duration_s': round(duration, 2),
+        'iterations': iterations,
+        'total': summarize(all_samples, duration),
+        'requests': {request: summarize(samples, duration) for request, samples in sorted(recorder.samples.items())},
+    }
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def print_results(results: dict, previous: dict | None = None):
+    print(f"{'request':<36}{'count':>7}{'errors':>7}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}")
+    for scenario, result in results['scenarios'].items():
+        old = previous['scenarios'].get(scenario) if previous != None else None
+        rows = [(f"[{scenario}]", result['total'], old['total'] if old != None else None)]
+        for request, summary in result['requests'].items():
+            rows.append((f"  {request}", summary, old['requests'].get(request) if old != None else None))
+        for label, summary, old_summary in rows:
+            queries = summary['queries_per_request'] if summary['queries_per_request'] != None else '-'
+            print(f"{label:<36}{summary['requests']:>7}{summary['errors']:>7}{summary['rps']:>9}{summary['p50_ms']:>9}{summary['p95_ms']:>9}{summary['p99_ms']:>9}{queries:>9}")
+            if old_summary == None:
+                continue
+            changes = [
+                f"{key} {(summary[key] - old_summary[key]) / old_summary[key]:+.1%}"
+                for key in ('rps', 'p95_ms', 'p99_ms', 'queries_per_request')
+                if old_summary.get(key) and summary.get(key) != None
+            ]
+            print(f"{'':<36}vs {previous['commit']}: {', '.join(changes)}")
+
+async def main(args):
+    if args.url != None:
+        transport = None
+        base_url = args.url
+    else:
+        from main import app
+        transport = httpx.ASGITransport(app=app)
+        base_url = 'http://benchmark'
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout, limits=limits) as http_client:
+        state = await setup(http_client)
+        results = {
+            'commit': get_commit(),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'target': args.url or 'in-process',
+            'concurrency': args.concurrency,
+            'scenarios': {},
+        }
+        for name in args.scenario or list(SCENARIOS):
+            results['scenarios'][name] = await run_scenario(http_client, name, state, args.concurrency, args.iterations)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test of the API with a mix of realistic scenarios.")
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help="Scenario to run, may be repeated. Defaults to all.")
+    parser.add_argument('--concurrency', type=int, default=10, help="Simultaneous users.")
+    parser.add_argument('--iterations', type=int, default=200, help="Times each scenario runs.")
+    parser.add_argument('--url', help="Base URL of a running server. Defaults to the app in this process.")
+    parser.add_argument('--timeout', type=float, default=60, help="Seconds before a request fails.")
+    parser.add_argument('--compare', help="Results file of an earlier run to compare with.")
+    parser.add_argument('--output', help="Where to save the results. Defaults to benchmarks/results/<time>-<commit>.json.")
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args))
+    previous = None
+    if args.compare != None:
+        with open(args.compare) as file:
+            previous = json.load(file)
+    print_results(results, previous)
+    output = args.output
+    if output == None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{results['commit']}.json")
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=4)
+    print(f"Results saved to {output}")
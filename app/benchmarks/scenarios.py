@@ -0,0 +1,111 @@
+import random
+import re
+import time
+
+USERNAME = 'test_op'
+PASSWORD = 'test'
+
+SECTIONS = ['Laticínios', 'Marcearia', 'Frios', 'Padaria', 'Confeitaria', 'Bebidas', 'Açougue', 'Hortifruti', 'Higiene', 'Limpeza']
+ORDER_STATUSES = ['Cancelada', 'Nova', 'Em separação', 'Em transporte', 'Entregue']
+ORDER_SORTS = ['id', '-id', 'created_at', '-created_at', 'item_count', '-total_value']
+
+QUERY_COUNT = re.compile(r'desc="(\d+) queries"')
+
+class Recorder():
+    '''
+    Latency, status and statements (read from the Server-Timing header) of every request, by request name.
+    '''
+    def __init__(self):
+        self.samples = {}
+
+    async def request(self, http_client, name: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        response = await http_client.request(method, url, **kwargs)
+        latency = time.perf_counter() - start
+        match = QUERY_COUNT.search(response.headers.get('Server-Timing', ''))
+        self.samples.setdefault(name, []).append((latency, response.status_code, int(match.group(1)) if match != None else None))
+        return response
+
+async def setup(http_client) -> dict:
+    '''Logs in and loads the ids the scenarios pick from. Returns the state shared by all scenarios.
+    '''
+    response = await http_client.post('/auth/login', data={'username': USERNAME, 'password': PASSWORD})
+    response.raise_for_status()
+    headers = {'Authorization': f"Bearer {response.json()['access_token']}"}
+    product_ids = []
+    offset = 0
+    while len(product_ids) < 1000:
+        page = (await http_client.get('/products', headers=headers, params={'offset': offset, 'available': True})).json()
+        if len(page) == 0:
+            break
+        product_ids += [product['id'] for product in page]
+        offset += len(page)
+    client_ids = [client['id'] for client in (await http_client.get('/clients', headers=headers)).json()]
+    if len(product_ids) == 0 or len(client_ids) == 0:
+        raise RuntimeError("The database has no products in stock or no clients to benchmark with")
+    return {
+        'headers': headers,
+        'product_ids': product_ids,
+        'client_ids': client_ids,
+        'product_pages': max(offset // 20, 1),
+    }
+
+async def login_burst(http_client, recorder: Recorder, state: dict):
+    await recorder.request(http_client, 'post /auth/login', 'POST', '/auth/login', data={'username': USERNAME, 'password': PASSWORD})
+
+async def catalog(http_client, recorder: Recorder, state: dict):
+    '''A customer browsing: a page of the catalog, sometimes filtered by section, then a product's details with its images.
+    '''
+    params = {'offset': random.randrange(state['product_pages']) * 20}
+    if random.random() < .3:
+        params['category'] = random.choice(SECTIONS)
+    await recorder.request(http_client, 'get /products', 'GET', '/products', headers=state['headers'], params=params)
+    product_id = random.choice(state['product_ids'])
+    await recorder.request(http_client, 'get /products/{id}', 'GET', f'/products/{product_id}', headers=state['headers'])
+
+async def order_lifecycle(http_client, recorder: Recorder, state: dict):
+    '''Creates an order, adds a product to it and cancels it, so stock ends where it started.
+    '''
+    products = [{'product_id': id, 'quantity': 1} for id in random.sample(state['product_ids'], min(3, len(state['product_ids'])))]
+    response = await recorder.request(http_client, 'post /orders', 'POST', '/orders', headers=state['headers'], json={
+        'client_id': random.choice(state['client_ids']),
+        'products': products
+    })
+    if response.status_code != 200:
+        return
+    id = response.json()['id']
+    await recorder.request(http_client, 'put /orders/{id}', 'PUT', f'/orders/{id}', headers=state['headers'], json={
+        'products_to_include': [{'product_id': random.choice(state['product_ids']), 'quantity': 1}]
+    })
+    await recorder.request(http_client, 'put /orders/{id} (cancel)', 'PUT', f'/orders/{id}', headers=state['headers'], json={
+        'status': 'Cancelada'
+    })
+
+async def order_filters(http_client, recorder: Recorder, state: dict):
+    '''The back office order list with a random mix of filters, each changing the plan of the query.
+    '''
+    params = {}
+    if random.random() < .5:
+        year = random.randint(2023, 2025)
+        params['start_date'] = f"01/{random.randint(1, 12):02d}/{year}"
+        params['end_date'] = f"28/12/{year}"
+    if random.random() < .3:
+        params['section'] = random.choice(SECTIONS)
+    if random.random() < .3:
+        params['order_status'] = random.choice(ORDER_STATUSES)
+    if random.random() < .2:
+        params['client_id'] = random.choice(state['client_ids'])
+    if random.random() < .2:
+        params['min_total'] = random.choice([10, 50, 100])
+    if random.random() < .5:
+        params['sort_by'] = random.choice(ORDER_SORTS)
+    if random.random() < .3:
+        params['offset'] = random.choice([20, 100, 1000])
+    await recorder.request(http_client, 'get /orders', 'GET', '/orders', headers=state['headers'], params=params)
+
+SCENARIOS = {
+    'login': login_burst,
+    'catalog': catalog,
+    'orders': order_lifecycle,
+    'order_filters': order_filters,
+}
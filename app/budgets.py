@@ -0,0 +1,56 @@
+import query_stats
+
+# Dataset the latency budgets are checked against by default: the sample data of postgresql/init.sql
+DEFAULT_DATASET = 'sample'
+
+class Budget():
+    '''
+    Most statements and milliseconds a request to a route may take.
+    Latency depends on the data, so it is given by dataset: "sample" is the data of postgresql/init.sql and "large" the defaults
+    of benchmarks/dataset.py. Latency is not checked for datasets left out.
+    '''
+    def __init__(self, queries: int, latency_ms: dict = {}):
+        self.queries = queries
+        self.latency_ms = latency_ms
+
+# Budgets by (method, route template). Routes left out are not checked.
+# Lists return 20 entries, so each statement run per entry adds 20 to the count.
+BUDGETS = {
+    # Hashing the password is slow on purpose
+    ('POST', '/auth/login'): Budget(2, {'sample': 1000, 'large': 1000}),
+    ('GET', '/clients'): Budget(2, {'sample': 300, 'large': 500}),
+    ('GET', '/clients/{id}'): Budget(2, {'sample': 200, 'large': 200}),
+    # User, ids, then product, section and images of each product
+    ('GET', '/products'): Budget(65, {'sample': 1000, 'large': 2000}),
+    ('GET', '/products/{id}'): Budget(4, {'sample': 300, 'large': 300}),
+    ('GET', '/products/changes'): Budget(4, {'sample': 500}),
+    # User, ids, then order, status and lines of each order, with product and section of each line.
+    # The 20 orders of a page have at most 50 lines on the sample data: 2 + 20 * 3 + 50 * 2 = 162
+    ('GET', '/orders'): Budget(165, {'sample': 2000, 'large': 5000}),
+    # User, order, status, lines, then product and section of each of the 3 lines of the sample orders
+    ('GET', '/orders/{id}'): Budget(12, {'sample': 500, 'large': 500}),
+    ('GET', '/search/autocomplete'): Budget(2, {'sample': 300, 'large': 300}),
+}
+
+def check(method: str, route: str, stats: query_stats.RequestStats, duration: float, dataset: str = DEFAULT_DATASET) -> list:
+    '''Returns what a request went over its route's budget, empty if within it or the route has no budget.
+    '''
+    budget = BUDGETS.get((method, route))
+    if budget == None:
+        return []
+    problems = []
+    if stats.count > budget.queries:
+        problems.append(f"{stats.count} statements, budget is {budget.queries}")
+    latency_ms = budget.latency_ms.get(dataset)
+    if latency_ms != None and duration * 1000 > latency_ms:
+        problems.append(f"{duration * 1000:.0f} ms, budget is {latency_ms} ms on the {dataset} dataset")
+    return problems
+
+def describe(stats: query_stats.RequestStats, callers: bool = True) -> list:
+    '''Returns a "count x shape (caller)" line for each statement shape of a request, most run first.
+    Without callers the lines don't change when code moves around, so they can be compared between runs.
+    '''
+    return [
+        f"{statement.count}x {shape}" + (f" ({statement.caller})" if callers else '')
+        for shape, statement in sorted(stats.statements.items(), key=lambda item: (-item[1].count, item[0]))
+    ]
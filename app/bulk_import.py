@@ -0,0 +1,122 @@
+import codecs
+import csv
+import io
+import json
+
+# Rows validated and copied to the staging table at a time, so memory doesn't grow with the size of the upload
+BATCH_SIZE = 5000
+# Errors listed in the response. Rejected rows past this are only counted.
+MAX_REPORTED_ERRORS = 1000
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+CONTENT_TYPES = {
+    'text/csv': CSV,
+    'application/x-ndjson': NDJSON,
+    'application/ndjson': NDJSON,
+    'application/jsonl': NDJSON,
+}
+
+class InvalidFile(Exception):
+    pass
+
+def get_format(content_type: str | None) -> str | None:
+    '''Returns CSV or NDJSON for the Content-Type of an upload, or None if not supported.
+    '''
+    if content_type == None:
+        return None
+    return CONTENT_TYPES.get(content_type.split(';')[0].strip().lower())
+
+async def iter_lines(request):
+    '''Yields the lines of the request body as it arrives, without reading the whole body first.
+    Raises InvalidFile if the body is not UTF-8.
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+    try:
+        async for chunk in request.stream():
+            pending += decoder.decode(chunk)
+            lines = pending.split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip('\r')
+        pending += decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        raise InvalidFile
+    if pending != '':
+        yield pending.rstrip('\r')
+
+async def iter_records(request, format: str, columns: tuple):
+    '''Yields (row, record) for each non blank line of a CSV (with header) or NDJSON body, row counting from 1.
+    record is a dict of the expected columns (missing ones are None), or None if the line can't be parsed.
+    Raises InvalidFile if the CSV header lacks a column.
+    '''
+    header = None
+    row = 0
+    async for line in iter_lines(request):
+        if line.strip() == '':
+            continue
+        if format == CSV and header == None:
+            header = [name.strip().lower() for name in next(csv.reader([line]))]
+            if any(column not in header for column in columns):
+                raise InvalidFile
+            continue
+        row += 1
+        try:
+            if format == CSV:
+                values = next(csv.reader([line]))
+                if len(values) != len(header):
+                    raise ValueError
+                record = dict(zip(header, values))
+            else:
+                record = json.loads(line)
+                if type(record) != dict:
+                    raise ValueError
+        except (ValueError, csv.Error):
+            yield row, None
+            continue
+        yield row, {column: record.get(column) for column in columns}
+    if format == CSV and header == None:
+        raise InvalidFile
+
+async def iter_batches(request, format: str, columns: tuple):
+    '''Groups the records of iter_records in lists of up to BATCH_SIZE (row, record) tuples.
+    '''
+    batch = []
+    async for entry in iter_records(request, format, columns):
+        batch.append(entry)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def copy_rows(db_cursor, table: str, columns: tuple, rows: list):
+    '''Loads rows (tuples in the order of columns) into table with a single COPY.
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows(rows)
+    buffer.seek(0)
+    db_cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+class Report():
+    '''
+    Counts the rows of an import and keeps the first MAX_REPORTED_ERRORS rejections.
+    '''
+    def __init__(self):
+        self.received = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, row: int, detail: str):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row, 'detail': detail})
+
+    def get_info(self) -> dict:
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'errors': sorted(self.errors, key=lambda error: error['row'])
+        }
@@ -1,8 +1,34 @@
 import db_operations
+import leaderboard
+import order_events
+import stock_ledger
 import base64
 
 admin_role_id = 1
 
+# Columns loaded by Client, in the order expected by Client.from_row
+CLIENT_COLUMNS = "id, name, email, cpf"
+
+# Stock as seen by the API: the sum of the shards for sharded products, products.stock otherwise. Expects products aliased as p.
+# Unsharded products add the movements not yet folded into products.stock by the ledger compactor.
+PENDING_STOCK = "COALESCE((SELECT SUM(delta) FROM stock_movements WHERE product_id = p.id AND txid >= p.stock_folded_xid), 0)"
+PRODUCT_STOCK = f"""CASE WHEN p.stock_shards > 0 THEN (SELECT COALESCE(SUM(stock), 0) FROM product_stock_shards WHERE product_id = p.id)
+    ELSE p.stock + {PENDING_STOCK} END"""
+PRODUCT_COLUMNS = f"p.id, p.description, p.sell_value, p.barcode, p.section_id, {PRODUCT_STOCK}, p.expiration_date, p.stock_shards"
+
+# Products returned per page of get(/products/changes)
+CHANGES_PAGE_SIZE = 500
+
+# Lookups run on almost every request, prepared once on each pooled connection and run by name
+db_operations.prepare_statement('user_by_username', "SELECT id, username, password_hash, role_id, disabled FROM users WHERE username = %s LIMIT 1")
+db_operations.prepare_statement('client_by_id', f"SELECT {CLIENT_COLUMNS} FROM clients WHERE id = %s LIMIT 1", ('bigint',))
+db_operations.prepare_statement('client_by_cpf', f"SELECT {CLIENT_COLUMNS} FROM clients WHERE cpf = %s LIMIT 1")
+db_operations.prepare_statement('client_by_email', f"SELECT {CLIENT_COLUMNS} FROM clients WHERE email = %s LIMIT 1")
+db_operations.prepare_statement('product_by_id', f"SELECT {PRODUCT_COLUMNS} FROM products p WHERE p.id = %s LIMIT 1", ('bigint',))
+db_operations.prepare_statement('product_by_barcode', f"SELECT {PRODUCT_COLUMNS} FROM products p WHERE p.barcode = %s LIMIT 1")
+db_operations.prepare_statement('order_by_id', "SELECT id, created_at, status, client_id, item_count, total_value, updated_at FROM orders WHERE id = %s LIMIT 1", ('bigint',))
+db_operations.prepare_statement('section_name_by_id', "SELECT name FROM sections WHERE id = %s LIMIT 1", ('bigint',))
+
 class ObjectNotFound(Exception):
     pass
 
@@ -14,16 +40,20 @@ class OrderCantBeChanged(Exception):
 
 class User():
     def __init__(self, db_cursor = None, id:int = -1, username:str = '', password:str = "", role:int = -1, disabled:bool = False):
+        # A connection opened here goes back to the pool as soon as the user is loaded
+        db_connection = None
         if db_cursor == None:
             db_connection = db_operations.postgres_connection()
             db_cursor = db_connection.cursor()
-        if username != '':
-            query = """SELECT * FROM users WHERE username = %s limit 1"""
-            arg = username
-        elif id != -1:
-            query = """SELECT * FROM users WHERE id = %s limit 1"""
-            arg = id
-        existing_user = db_operations.select(db_cursor, query, (arg,), 1)
+        try:
+            if username != '':
+                existing_user = db_operations.select_prepared(db_cursor, 'user_by_username', (username,), 1)
+            elif id != -1:
+                existing_user = db_operations.select(db_cursor, """SELECT * FROM users WHERE id = %s limit 1""", (id,), 1)
+        finally:
+            if db_connection != None:
+                db_cursor.close()
+                db_connection.close()
         if existing_user==None:
             raise ObjectNotFound
         self.id = int(existing_user[0])
@@ -36,27 +66,61 @@ class User():
 
 class Client():
     def __init__(self, db_cursor = None, id:int = None, name:str = '', email:str = "", cpf:str = ""):
+        # A connection opened here goes back to the pool as soon as the client is loaded
+        db_connection = None
         if db_cursor == None:
             db_connection = db_operations.postgres_connection()
             db_cursor = db_connection.cursor()
         if cpf != '':
-            query = """SELECT * FROM clients WHERE cpf = %s limit 1"""
+            statement = 'client_by_cpf'
             arg = cpf
         elif id != None:
-            query = """SELECT * FROM clients WHERE id = %s limit 1"""
+            statement = 'client_by_id'
             arg = id
         elif email != '':
-            query = """SELECT * FROM clients WHERE email = %s limit 1"""
+            statement = 'client_by_email'
             arg = email
-        existing_client = db_operations.select(db_cursor, query, (arg,), 1)
+        try:
+            existing_client = db_operations.select_prepared(db_cursor, statement, (arg,), 1)
+        finally:
+            if db_connection != None:
+                db_cursor.close()
+                db_connection.close()
         if existing_client==None:
             raise ObjectNotFound
-        self.id = int(existing_client[0])
-        self.name = existing_client[1]
-        self.email = existing_client[2]
-        self.cpf = existing_client[3]
-        self.db_cursor = db_cursor
+        self.load_row(db_cursor, existing_client)
         return
+
+    def load_row(self, db_cursor, row):
+        self.id = int(row[0])
+        self.name = row[1]
+        self.email = row[2]
+        self.cpf = row[3]
+        self.db_cursor = db_cursor
+
+    @classmethod
+    def from_row(cls, db_cursor, row) -> 'Client':
+        '''Builds a client from a row already selected with CLIENT_COLUMNS, without querying again.
+        '''
+        client = cls.__new__(cls)
+        client.load_row(db_cursor, row)
+        return client
+
+    @classmethod
+    def from_rows(cls, db_cursor, rows) -> list:
+        '''Builds one client per row of a result set selected with CLIENT_COLUMNS, keeping the order of the rows.
+        '''
+        return [cls.from_row(db_cursor, row) for row in rows]
+
+    @classmethod
+    def load_many(cls, db_cursor, ids: list) -> dict:
+        '''Loads several clients with a single query. Returns a dict by id, missing ids are left out.
+        '''
+        if len(ids) == 0:
+            return {}
+        rows = db_operations.select(db_cursor, f"SELECT {CLIENT_COLUMNS} FROM clients WHERE id = ANY(%s)", (list(ids),))
+        return {client.id: client for client in cls.from_rows(db_cursor, rows)}
+
     def get_info(self):
         return {
             'id': self.id,
@@ -71,23 +135,44 @@ class Product():
             db_connection = db_operations.postgres_connection()
             db_cursor = db_connection.cursor()
         if id != None:
-            query = """SELECT * FROM products WHERE id = %s limit 1"""
+            statement = 'product_by_id'
             arg = id
         else:
-            query = """SELECT * FROM products WHERE barcode = %s limit 1"""
+            statement = 'product_by_barcode'
             arg = barcode
-        existing_product = db_operations.select(db_cursor, query, (arg,), 1)
+        existing_product = db_operations.select_prepared(db_cursor, statement, (arg,), 1)
         if existing_product==None:
             raise ObjectNotFound
-        self.id = int(existing_product[0])
-        self.description = existing_product[1]
-        self.sell_value = existing_product[2]
-        self.barcode = existing_product[3]
-        self.section_id = existing_product[4]
-        self.stock = existing_product[5]
-        self.expiration_date = existing_product[6]
-        self.db_cursor = db_cursor
+        self.load_row(db_cursor, existing_product)
         return
+
+    def load_row(self, db_cursor, row, section_name: str = None):
+        self.id = int(row[0])
+        self.description = row[1]
+        self.sell_value = row[2]
+        self.barcode = row[3]
+        self.section_id = row[4]
+        self.stock = row[5]
+        self.expiration_date = row[6]
+        self.stock_shards = row[7]
+        self.section_name = section_name
+        self.db_cursor = db_cursor
+
+    @classmethod
+    def load_many(cls, db_cursor, ids: list) -> dict:
+        '''Loads several products, with their section names, in a single query. Returns a dict by id, missing ids are left out.
+        '''
+        if len(ids) == 0:
+            return {}
+        rows = db_operations.select(db_cursor,
+            f"SELECT {PRODUCT_COLUMNS}, s.name FROM products p JOIN sections s ON p.section_id = s.id WHERE p.id = ANY(%s)",
+            (list(ids),))
+        products = {}
+        for row in rows:
+            product = cls.__new__(cls)
+            product.load_row(db_cursor, row, row[8])
+            products[product.id] = product
+        return products
     
     def get_info(self):
         return {
@@ -112,7 +197,9 @@ class Product():
         }
     
     def get_section_name(self):
-        return db_operations.select(self.db_cursor, "SELECT name FROM sections where id = %s limit 1", (self.section_id,), 1)[0]
+        if self.section_name != None:
+            return self.section_name
+        return db_operations.select_prepared(self.db_cursor, 'section_name_by_id', (self.section_id,), 1)[0]
 
     def get_images(self) -> dict:
         '''
@@ -145,19 +232,225 @@ class Product():
 
 
 
+def record_product_changes(db_cursor, product_ids: list, deleted: bool = False):
+    '''Records that products were created, changed or (if deleted) removed, for get(/products/changes). Commit is up to the caller.
+    '''
+    db_operations.insert(db_cursor,
+        "INSERT INTO product_changes (product_id, deleted) SELECT unnest(%s::int[]), %s",
+        (list(product_ids), deleted,))
+
+def get_changes_watermark(db_cursor) -> int:
+    '''Returns the oldest transaction still running. Every transaction before it had finished, so passing it as the next
+    since of get_product_changes never skips a change. Changes of transactions still running may show up twice, which is harmless for a sync.
+    '''
+    return db_operations.select(db_cursor, "SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint", fetch=1)[0]
+
+def get_product_changes(db_cursor, since: int, until: int, after: int = 0) -> list:
+    '''Returns (product_id, deleted) of up to CHANGES_PAGE_SIZE products changed by transactions from since to until (excluded),
+    by id after the given one. A product is deleted if any of its changes deleted it, as ids are never reused.
+    See get_changes_watermark.
+    '''
+    return db_operations.select(db_cursor,
+        """
+        SELECT product_id, bool_or(deleted) FROM product_changes
+        WHERE txid >= %s::text::xid8 AND txid < %s::text::xid8 AND product_id > %s
+        GROUP BY product_id
+        ORDER BY product_id
+        LIMIT %s
+        """,
+        (str(since), str(until), after, CHANGES_PAGE_SIZE,))
+
+def adjust_stock(db_cursor, product_id: int, delta: int, reason: str, order_id: int = None) -> int:
+    '''
+    Adds delta (negative to subtract) to a product's stock and returns the new stock.
+    The change is appended to stock_movements instead of updating products, and folded into products.stock later by stock_ledger.compact().
+    Sharded products also take the units from a random shard with enough stock, sweeping all shards only when no single one can cover it.
+    Raises ValueError if a sharded product lacks stock.
+
+    reason: why the stock changed, one of the reasons in stock_ledger.
+    order_id: order causing the change, if any.
+    '''
+    # The movement inserted by the CTE isn't visible to the outer SELECT, so its delta is added explicitly
+    result = db_operations.select(db_cursor,
+        f"""
+        WITH movement AS (
+            INSERT INTO stock_movements (product_id, delta, reason, order_id) VALUES (%s, %s, %s, %s) RETURNING product_id, delta
+        ), change AS (
+            INSERT INTO product_changes (product_id) SELECT product_id FROM movement
+        )
+        SELECT p.stock_shards,
+            p.stock + {PENDING_STOCK} + (SELECT delta FROM movement)
+        FROM products p WHERE p.id = %s
+        """,
+        (product_id, delta, reason, order_id, product_id,), 1)
+    if result == None:
+        raise ObjectNotFound
+    if result[0] == 0:
+        return result[1]
+    return adjust_stock_shards(db_cursor, product_id, delta)
+
+def adjust_stocks(db_cursor, movements: list, reason: str, order_id: int = None):
+    '''
+    Same as adjust_stock for several products at once, appending all movements in a single statement.
+
+    movements: list of (product_id, delta) tuples.
+    '''
+    if len(movements) == 0:
+        return
+    values = ", ".join(["(%s, %s, %s, %s)"] * len(movements))
+    args = []
+    for product_id, delta in movements:
+        args += [product_id, delta, reason, order_id]
+    sharded = db_operations.select(db_cursor,
+        f"""
+        WITH movement AS (
+            INSERT INTO stock_movements (product_id, delta, reason, order_id) VALUES {values} RETURNING product_id, delta
+        ), change AS (
+            INSERT INTO product_changes (product_id) SELECT DISTINCT product_id FROM movement
+        )
+        SELECT m.product_id, m.delta FROM movement m JOIN products p ON p.id = m.product_id WHERE p.stock_shards > 0
+        """,
+        args)
+    for product_id, delta in sharded:
+        adjust_stock_shards(db_cursor, product_id, delta)
+
+def adjust_stock_shards(db_cursor, product_id: int, delta: int) -> int:
+    '''
+    Applies delta to the shards of a sharded product and returns its new stock (the sum of the shards).
+    '''
+    if delta >= 0:
+        result = db_operations.select(db_cursor,
+            """
+            UPDATE product_stock_shards SET stock = stock + %s
+            WHERE product_id = %s AND slot = (SELECT floor(random() * stock_shards)::smallint FROM products WHERE id = %s)
+            RETURNING stock
+            """,
+            (delta, product_id, product_id,), 1)
+        if result == None:
+            raise ObjectNotFound
+    else:
+        # SKIP LOCKED moves on to another shard instead of waiting for a concurrent order
+        result = db_operations.select(db_cursor,
+            """
+            WITH chosen AS (
+                SELECT slot FROM product_stock_shards WHERE product_id = %s AND stock >= %s
+                ORDER BY random() LIMIT 1 FOR UPDATE SKIP LOCKED
+            )
+            UPDATE product_stock_shards s SET stock = s.stock - %s FROM chosen
+            WHERE s.product_id = %s AND s.slot = chosen.slot
+            RETURNING s.stock
+            """,
+            (product_id, -delta, -delta, product_id,), 1)
+        if result == None:
+            sweep_stock_shards(db_cursor, product_id, -delta)
+    return db_operations.select(db_cursor,
+        "SELECT COALESCE(SUM(stock), 0) FROM product_stock_shards WHERE product_id = %s", (product_id,), 1)[0]
+
+def sweep_stock_shards(db_cursor, product_id: int, quantity: int):
+    '''
+    Takes quantity units from as many shards as needed, locking them in slot order. Raises ValueError if all shards together lack stock.
+    '''
+    shards = db_operations.select(db_cursor,
+        "SELECT slot, stock FROM product_stock_shards WHERE product_id = %s ORDER BY slot FOR UPDATE",
+        (product_id,))
+    if sum(stock for _, stock in shards) < quantity:
+        raise ValueError
+    for slot, stock in shards:
+        taken = min(stock, quantity)
+        if taken <= 0:
+            continue
+        db_operations.insert(db_cursor,
+            "UPDATE product_stock_shards SET stock = stock - %s WHERE product_id = %s AND slot = %s",
+            (taken, product_id, slot,))
+        quantity -= taken
+        if quantity == 0:
+            break
+
+def set_stock(db_cursor, product_id: int, stock: int = None, shards: int = None, reason: str = stock_ledger.ADJUSTMENT) -> int:
+    '''
+    Sets a product's stock, spreading it evenly over the shards when sharded, and returns it.
+    The difference to the current stock is recorded in stock_movements. Raises ObjectNotFound if the product does not exist.
+
+    stock: new stock. If None, keeps the current stock.
+    shards: new number of shards (0 to stop sharding). If None, keeps the current number.
+    '''
+    # Locking the product waits for transactions still appending movements to it (their foreign key holds a share lock)
+    if db_operations.select(db_cursor, "SELECT id FROM products WHERE id = %s FOR UPDATE", (product_id,), 1) == None:
+        raise ObjectNotFound
+    db_operations.select(db_cursor, "SELECT slot FROM product_stock_shards WHERE product_id = %s FOR UPDATE", (product_id,))
+    product = Product(db_cursor, product_id)
+    if stock == None:
+        stock = product.stock
+    if shards == None:
+        shards = product.stock_shards
+    if stock != product.stock:
+        db_operations.insert(db_cursor,
+            "INSERT INTO stock_movements (product_id, delta, reason) VALUES (%s, %s, %s)",
+            (product_id, stock - product.stock, reason,))
+    db_operations.insert(db_cursor, "DELETE FROM product_stock_shards WHERE product_id = %s", (product_id,))
+    if shards > 0:
+        db_operations.insert(db_cursor,
+            """
+            INSERT INTO product_stock_shards (product_id, slot, stock)
+            SELECT %s, slot, %s / %s + CASE WHEN slot < %s %% %s THEN 1 ELSE 0 END FROM generate_series(0, %s - 1) slot
+            """,
+            (product_id, stock, shards, stock, shards, shards,))
+    # The pending movements, including the one above, are left to the compactor and taken out of products.stock instead
+    db_operations.insert(db_cursor,
+        f"UPDATE products p SET stock = CASE WHEN %s > 0 THEN 0 ELSE %s - {PENDING_STOCK} END, stock_shards = %s WHERE id = %s",
+        (shards, stock, shards, product_id,))
+    record_product_changes(db_cursor, [product_id])
+    return stock
+
+def set_stocks(db_cursor, stocks: list, reason: str = stock_ledger.ADJUSTMENT):
+    '''
+    Same as set_stock for many products at once, with a handful of statements instead of a few per product.
+    Sharded products still go through set_stock one by one.
+
+    stocks: list of (product_id, stock) tuples, one per product.
+    '''
+    if len(stocks) == 0:
+        return
+    ids = [product_id for product_id, _ in stocks]
+    locked = db_operations.select(db_cursor,
+        "SELECT id, stock_shards FROM products WHERE id = ANY(%s) ORDER BY id FOR UPDATE", (ids,))
+    sharded = {product_id for product_id, shards in locked if shards > 0}
+    for product_id, stock in stocks:
+        if product_id in sharded:
+            set_stock(db_cursor, product_id, stock, reason=reason)
+    stocks = [(product_id, stock) for product_id, stock in stocks if product_id not in sharded]
+    if len(stocks) == 0:
+        return
+    record_product_changes(db_cursor, [product_id for product_id, _ in stocks])
+    new_stock = "unnest(%s::int[], %s::int[]) AS n (product_id, stock)"
+    args = ([product_id for product_id, _ in stocks], [stock for _, stock in stocks],)
+    # The movement alone sets the stock of unsharded products, products.stock is left to the compactor
+    db_operations.insert(db_cursor,
+        f"""
+        INSERT INTO stock_movements (product_id, delta, reason)
+        SELECT p.id, n.stock - {PRODUCT_STOCK}, %s
+        FROM products p JOIN {new_stock} ON p.id = n.product_id
+        WHERE n.stock <> {PRODUCT_STOCK}
+        """,
+        (reason,) + args)
+
 class Order():
     def __init__ (self, db_cursor = None, id:int = None):
         if db_cursor == None:
             db_connection = db_operations.postgres_connection()
             db_cursor = db_connection.cursor()
-        existing_order = db_operations.select(db_cursor, "SELECT * FROM orders WHERE id = %s limit 1", (id,), 1)
+        existing_order = db_operations.select_prepared(db_cursor, 'order_by_id', (id,), 1)
         if existing_order == None:
             raise ObjectNotFound
         self.id = existing_order[0]
         self.created_at = existing_order[1]
         self.__status = existing_order[2]
         self.client_id = existing_order[3]
+        self.item_count = existing_order[4]
+        self.total_value = existing_order[5]
         self.db_cursor = db_cursor
+        # Units sold (negative when given back) by this instance, left out of the leaderboard until record_sales
+        self.sales = []
     
     def get_info(self):
         return{
@@ -165,6 +458,8 @@ class Order():
             'client_id': self.client_id,
             'created_at': self.created_at,
             'status': self.get_status_description(self.__status),
+            'item_count': self.item_count,
+            'total_value': self.total_value,
             'products': self.get_products()
         }
     
@@ -184,8 +479,22 @@ class Order():
             product = Product(self.db_cursor, id = result_raw[i][2])
             products[i+1] = product.get_info_without_image()
             products[i+1]['quantity'] = result_raw[i][3]
+            products[i+1]['unit_price'] = result_raw[i][4]
         return products
 
+    def update_totals(self, item_delta: int, value_delta):
+        '''
+        Applies a delta to the stored order totals (item_count and total_value) instead of recalculating them from the order lines.
+        '''
+        result = db_operations.select(self.db_cursor,
+            "UPDATE orders SET item_count = item_count + %s, total_value = total_value + %s, updated_at = NOW() WHERE id = %s RETURNING item_count, total_value",
+            (item_delta, value_delta, self.id,), 1
+        )
+        if result == None:
+            raise ObjectNotFound
+        self.item_count = result[0]
+        self.total_value = result[1]
+
     def include_product(self, product_id:int, quantity: int) -> int:
         if self.__status == 1 or self.__status == 5:
             raise OrderCantBeChanged
@@ -200,23 +509,24 @@ class Order():
                 product_in_order = product_list[item]
                 break
         if product_in_order == None:
+            unit_price = product.sell_value
             result = db_operations.insert(self.db_cursor, 
-                "INSERT INTO orders_products (order_id, product_id, quantity) VALUES (%s, %s, %s)",
-                (self.id, product_id, quantity),
+                "INSERT INTO orders_products (order_id, product_id, quantity, unit_price) VALUES (%s, %s, %s, %s)",
+                (self.id, product_id, quantity, unit_price),
                 'id'
             )
         else:
+            # Keeps the price the item was first sold at
+            unit_price = product_in_order['unit_price']
             result = db_operations.insert(self.db_cursor, 
                 "UPDATE orders_products SET quantity = quantity + %s WHERE order_id = %s AND product_id = %s",
                 (quantity, self.id, product_in_order['id'],)
             )
         if result == None:
             raise ObjectNotFound
-        result = db_operations.insert(self.db_cursor, 
-            "UPDATE products SET stock = stock-%s WHERE id = %s",
-            (quantity, product.id, ),
-            'stock'
-        )
+        self.update_totals(quantity, quantity * unit_price)
+        result = adjust_stock(self.db_cursor, product.id, -quantity, stock_ledger.ORDER_INCLUDED, self.id)
+        self.sales.append((product.id, quantity))
         return result
     
     def remove_product(self, product_id:int, quantity: int) -> int:
@@ -245,42 +555,73 @@ class Order():
             )
         if result == None:
             raise ObjectNotFound
-        result = db_operations.insert(self.db_cursor, 
-            "UPDATE products SET stock = stock + %s WHERE id = %s",
-            (quantity, product_in_order['id'], ),
-            'stock'
-        )
+        self.update_totals(-quantity, -quantity * product_in_order['unit_price'])
+        result = adjust_stock(self.db_cursor, product_in_order['id'], quantity, stock_ledger.ORDER_REMOVED, self.id)
+        self.sales.append((product_in_order['id'], -quantity))
         return result
     
     def cancel_order(self):
         if self.__status == 1 or self.__status == 5:
             raise OrderCantBeChanged
         product_list = self.get_products()
-        product_in_order = None
-        for item in product_list:
-            result = db_operations.insert(self.db_cursor, 
-                "UPDATE products SET stock = stock + %s WHERE id = %s",
-                (product_list[item]['quantity'], product_list[item]['id'],),
-                'stock'
-            )
+        adjust_stocks(self.db_cursor,
+            [(product_list[item]['id'], product_list[item]['quantity']) for item in product_list],
+            stock_ledger.ORDER_CANCELLED, self.id)
+        self.sales += [(product_list[item]['id'], -product_list[item]['quantity']) for item in product_list]
         self.__status = 1
 
-        result = db_operations.insert(self.db_cursor, 
-            "UPDATE orders SET status = %s WHERE id = %s",
-            (1, self.id,), "status"
+        # Lines are kept on cancelled orders, so the totals are settled against them one last time
+        result = db_operations.select(self.db_cursor, 
+            """
+            UPDATE orders SET status = %s,
+                item_count = COALESCE((SELECT SUM(quantity) FROM orders_products WHERE order_id = %s), 0),
+                total_value = COALESCE((SELECT SUM(quantity * unit_price) FROM orders_products WHERE order_id = %s), 0),
+                updated_at = NOW()
+            WHERE id = %s RETURNING status, item_count, total_value
+            """,
+            (1, self.id, self.id, self.id,), 1
         )
         if result == None:
             raise ObjectNotFound
+        self.item_count = result[1]
+        self.total_value = result[2]
+        self.publish_event('status_changed')
         return
     
+    def record_sales(self):
+        '''
+        Applies the units sold by include_product, remove_product and cancel_order to the leaderboard.
+        Call it once they are committed, so a rolled back change never reaches it.
+        '''
+        for product_id, quantity in self.sales:
+            leaderboard.board.record(product_id, quantity, self.created_at)
+        self.sales = []
+
     def change_status(self, new_status):
         if self.__status == 1 or self.__status == 5:
             raise OrderCantBeChanged
         self.__status = new_status
         result = db_operations.insert(self.db_cursor, 
-            "UPDATE orders SET status = %s WHERE id = %s",
+            "UPDATE orders SET status = %s, updated_at = NOW() WHERE id = %s",
             (new_status, self.id),
             "status"
         )
+        self.publish_event('status_changed')
+
+    def publish_event(self, event: str):
+        '''
+        Publishes the order's current status to the order event stream. Delivered only if the transaction is committed.
+
+        event: event name, such as "created" or "status_changed".
+        '''
+        order_events.notify(self.db_cursor, {
+            'event': event,
+            'order_id': self.id,
+            'client_id': self.client_id,
+            'status_id': self.__status,
+            'status': self.get_status_description(self.__status),
+            'item_count': self.item_count,
+            'total_value': float(self.total_value),
+        })
     def is_open(self):
         return not (self.__status == 1 or self.__status == 5)
\ No newline at end of file
@@ -1,13 +1,163 @@
+import os
+import queue
+import sys
+import time
+
 import psycopg2
+import psycopg2.extensions
 
-def postgres_connection():
+# Called after every statement run through select and insert with (query, args, duration in seconds, rowcount, caller).
+# Empty by default, so statements cost nothing extra unless something is listening (see query_stats).
+hooks = []
+# Called with the seconds taken by each postgres_connection call (see metrics)
+connection_hooks = []
+
+# Idle connections kept for reuse by postgres_connection. Connections closed while the pool is full are really closed.
+POOL_SIZE = 20
+
+# Statements prepared on every pooled connection when it's checked out, by name: (PREPARE statement, query, EXECUTE statement)
+prepared_statements = {}
+
+pool = queue.LifoQueue()
+# Pools of the parent process in a forked child. Their connections are kept referenced, as closing them would end the parent's sessions.
+inherited_pools = []
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''
+    Connection given by postgres_connection. close() rolls back what wasn't committed and puts it back in the pool,
+    closing it again does nothing. Connections left in autocommit (like the LISTEN of order_events) may carry session
+    state, so they are really closed.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.checked_out = False
+        self.idle = False
+
+    def close(self):
+        if self.idle:
+            return
+        if not self.checked_out or self.closed:
+            return super().close()
+        self.checked_out = False
+        if self.autocommit or pool.qsize() >= POOL_SIZE:
+            return super().close()
+        try:
+            self.rollback()
+        except psycopg2.Error:
+            return super().close()
+        self.idle = True
+        pool.put(self)
+
+def reset_pool():
+    global pool
+    inherited_pools.append(pool)
+    pool = queue.LifoQueue()
+
+os.register_at_fork(after_in_child=reset_pool)
+
+def connect():
     try:
-        return psycopg2.connect(host = 'localhost', port = 5431, user = "admin", password = "admin", dbname = "infog2")
+        return psycopg2.connect(host = 'localhost', port = 5431, user = "admin", password = "admin", dbname = "infog2", connection_factory = PooledConnection)
     except:
-        return psycopg2.connect(host = 'db', port = 5432, user = "admin", password = "admin", dbname = "infog2")
+        return psycopg2.connect(host = 'db', port = 5432, user = "admin", password = "admin", dbname = "infog2", connection_factory = PooledConnection)
+
+def prepare_statement(name: str, query: str, types: tuple = ()):
+    '''Registers a statement to be prepared on every pooled connection and run with select_prepared.
+    The query takes %s placeholders, like select, and must not have other % signs.
+    Parameters without a type take the one Postgres infers from the query, like integer for an id: give bigint for ids
+    coming from requests, or a value past the integer range fails instead of finding nothing.
+    '''
+    parts = query.split('%s')
+    numbered = parts[0] + ''.join(f"${index}{part}" for index, part in enumerate(parts[1:], 1))
+    placeholders = ', '.join(['%s'] * (len(parts) - 1))
+    prepared_statements[name] = (f"PREPARE {name}" + (f" ({', '.join(types)})" if len(types) > 0 else '') + f" AS {numbered}", query, f"EXECUTE {name}" + (f" ({placeholders})" if placeholders != '' else ''))
+
+def prepare(db_connection: PooledConnection):
+    '''Prepares the registered statements the connection doesn't have yet, in a single round trip.
+    '''
+    names = [name for name in prepared_statements if name not in db_connection.prepared]
+    if len(names) == 0:
+        return
+    db_cursor = db_connection.cursor()
+    try:
+        db_cursor.execute('; '.join(prepared_statements[name][0] for name in names))
+        db_connection.commit()
+    finally:
+        db_cursor.close()
+    db_connection.prepared.update(names)
+
+def checkout() -> PooledConnection:
+    '''Returns an idle connection of the pool, or a new one if there is none, with the registered statements prepared.
+    '''
+    while True:
+        try:
+            db_connection = pool.get_nowait()
+        except queue.Empty:
+            db_connection = connect()
+            break
+        db_connection.idle = False
+        if not db_connection.closed:
+            break
+    try:
+        prepare(db_connection)
+    except psycopg2.Error:
+        db_connection.close()
+        raise
+    db_connection.checked_out = True
+    return db_connection
+
+def postgres_connection():
+    if len(connection_hooks) == 0:
+        return checkout()
+    start = time.perf_counter()
+    try:
+        return checkout()
+    finally:
+        duration = time.perf_counter() - start
+        for hook in connection_hooks:
+            hook(duration)
+
+def get_caller() -> str:
+    '''Returns "file:line function" of the code that called select or insert.
+    '''
+    frame = sys._getframe(1)
+    while frame != None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame == None:
+        return ''
+    return f"{frame.f_code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno} {frame.f_code.co_name}"
+
+def execute(db_cursor, query: str, args, hook_query: str = None):
+    '''Runs the query. Hooks receive hook_query instead when given, like the query of a prepared statement run by name.
+    '''
+    if len(hooks) == 0:
+        db_cursor.execute(query, args,)
+        return
+    start = time.perf_counter()
+    try:
+        db_cursor.execute(query, args,)
+    finally:
+        duration = time.perf_counter() - start
+        caller = get_caller()
+        for hook in hooks:
+            hook(query if hook_query == None else hook_query, args, duration, db_cursor.rowcount, caller)
 
 def select(db_cursor, query:str, args:tuple = [], fetch = 0):
-    db_cursor.execute(query, args,)
+    execute(db_cursor, query, args)
+    return fetch_result(db_cursor, fetch)
+
+def select_prepared(db_cursor, name: str, args: tuple, fetch = 0):
+    '''Runs the statement registered with prepare_statement by name, like select.
+    Connections that didn't prepare it (not from the pool, or checked out before it was registered) run its query instead.
+    '''
+    _, query, run = prepared_statements[name]
+    if name not in getattr(db_cursor.connection, 'prepared', ()):
+        return select(db_cursor, query, args, fetch)
+    execute(db_cursor, run, args, query)
+    return fetch_result(db_cursor, fetch)
+
+def fetch_result(db_cursor, fetch = 0):
     try:
         if fetch == 0:
             result = db_cursor.fetchall()
@@ -22,7 +172,7 @@ def select(db_cursor, query:str, args:tuple = [], fetch = 0):
 def insert(cursor, query:str, args:tuple, return_field=''):
     if len(return_field) > 0:
         query += f""" RETURNING {return_field}"""
-    cursor.execute(query, args,)
+    execute(cursor, query, args)
     if len(return_field) > 0:
         result = cursor.fetchone()[0]
     else:
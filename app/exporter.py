@@ -0,0 +1,144 @@
+import csv
+import io
+import json
+import logging
+from datetime import date, datetime
+from decimal import Decimal
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Rows fetched from the server side cursor and encoded at a time
+FETCH_SIZE = 2000
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+PARQUET = 'parquet'
+MEDIA_TYPES = {
+    CSV: 'text/csv',
+    NDJSON: 'application/x-ndjson',
+    PARQUET: 'application/vnd.apache.parquet',
+}
+
+logger = logging.getLogger(__name__)
+
+def is_available(format: str) -> bool:
+    '''Returns whether the format can be exported. Parquet needs the optional pyarrow package.
+    '''
+    if format == PARQUET:
+        return pyarrow != None
+    return format in MEDIA_TYPES
+
+def encode_value(value):
+    '''Converts database values to what the JSON routes return: floats for decimals and ISO 8601 for dates.
+    '''
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def get_arrow_type(kind: str):
+    return {
+        'int': pyarrow.int64(),
+        'float': pyarrow.float64(),
+        'string': pyarrow.string(),
+        'date': pyarrow.date32(),
+        'timestamp': pyarrow.timestamp('us', tz='UTC'),
+    }[kind]
+
+class ChunkSink(io.RawIOBase):
+    '''
+    Write only file that keeps what was written until taken, so the Parquet writer output can be streamed.
+    '''
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def encode_csv(columns: list, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in columns])
+    for rows in batches:
+        writer.writerows([[encode_value(value) for value in row] for row in rows])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell() > 0:
+        yield buffer.getvalue().encode()
+
+def encode_ndjson(columns: list, batches):
+    names = [name for name, _ in columns]
+    for rows in batches:
+        yield ''.join(
+            json.dumps({name: encode_value(value) for name, value in zip(names, row)}, ensure_ascii=False) + '\n'
+            for row in rows
+        ).encode()
+
+def encode_parquet(columns: list, batches):
+    schema = pyarrow.schema([(name, get_arrow_type(kind)) for name, kind in columns])
+    float_columns = {index for index, (_, kind) in enumerate(columns) if kind == 'float'}
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for rows in batches:
+        # Each fetch becomes a row group, so memory stays bounded by FETCH_SIZE
+        data = [
+            [float(row[index]) if index in float_columns and row[index] != None else row[index] for row in rows]
+            for index in range(len(columns))
+        ]
+        writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(values, type=field.type) for values, field in zip(data, schema)], schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+ENCODERS = {
+    CSV: encode_csv,
+    NDJSON: encode_ndjson,
+    PARQUET: encode_parquet,
+}
+
+def stream(db_connection, query: str, args: list, columns: list, format: str):
+    '''Runs the query in a server side cursor and yields the result encoded in format, FETCH_SIZE rows at a time.
+    Takes ownership of the connection, closing it when done.
+
+    columns: list of (name, kind) tuples in the order of the query columns. kind is one of int, float, string, date or timestamp.
+    '''
+    db_cursor = db_connection.cursor(name='export')
+    db_cursor.itersize = FETCH_SIZE
+    try:
+        db_cursor.execute(query, args)
+
+        def batches():
+            while True:
+                rows = db_cursor.fetchmany(FETCH_SIZE)
+                if len(rows) == 0:
+                    return
+                yield rows
+
+        yield from ENCODERS[format](columns, batches())
+    except Exception:
+        logger.exception("Export failed")
+        raise
+    finally:
+        # Closing the connection discards the cursor and the read only transaction
+        db_connection.close()
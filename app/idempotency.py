@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import random
+
+import jwt
+from fastapi import status
+from fastapi.responses import JSONResponse, Response
+from jwt.exceptions import InvalidTokenError
+from starlette.middleware.base import BaseHTTPMiddleware
+
+import db_operations
+import metrics
+import utils
+
+HEADER = 'Idempotency-Key'
+# Routes whose responses are recorded when the header is sent
+IDEMPOTENT_ROUTES = {
+    ('POST', '/orders'),
+    ('POST', '/clients'),
+    ('POST', '/products'),
+}
+# How long a recorded response is replayed
+KEY_TTL = '24 hours'
+# A request still in flight after this long is considered lost (e.g. the worker died) and can be claimed again
+IN_FLIGHT_TIMEOUT = '60 seconds'
+# How long a duplicate waits for the original request before giving up, in seconds
+WAIT_TIMEOUT = 30
+WAIT_POLL_INTERVAL = 0.1
+# Chance of purging expired keys on each claim
+PURGE_PROBABILITY = 0.01
+# Statuses that depend on the caller's credentials rather than on the request, so they are never replayed
+NOT_RECORDED = {status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN}
+
+def get_username(authorization: str | None) -> str | None:
+    '''Returns the username of a bearer token without checking it against the database, or None if the token is invalid.
+    The route itself still authenticates the request.
+    '''
+    if authorization == None or not authorization.lower().startswith('bearer '):
+        return None
+    try:
+        return jwt.decode(authorization[7:], utils.SECRET_KEY, algorithms=[utils.ALGORITHM]).get("sub")
+    except InvalidTokenError:
+        return None
+
+def claim(username: str, key: str, route: str, request_hash: str):
+    '''Tries to register a new request for the key. Returns None if claimed, or the existing
+    (route, request_hash, status_code, content_type, response) row otherwise.
+    Expired keys and requests lost in flight are claimed again.
+    '''
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    try:
+        if random.random() < PURGE_PROBABILITY:
+            db_operations.insert(db_cursor, "DELETE FROM idempotency_keys WHERE expires_at < NOW()", ())
+        query = f"""
+            INSERT INTO idempotency_keys (username, key, route, request_hash, expires_at)
+            VALUES (%s, %s, %s, %s, NOW() + INTERVAL '{KEY_TTL}')
+            ON CONFLICT (username, key) DO UPDATE SET
+                route = EXCLUDED.route, request_hash = EXCLUDED.request_hash, status_code = NULL, content_type = NULL,
+                response = NULL, created_at = NOW(), expires_at = EXCLUDED.expires_at
+            WHERE idempotency_keys.expires_at < NOW()
+                OR (idempotency_keys.status_code IS NULL AND idempotency_keys.created_at < NOW() - INTERVAL '{IN_FLIGHT_TIMEOUT}')
+            RETURNING key
+        """
+        while True:
+            claimed = db_operations.select(db_cursor, query, (username, key, route, request_hash,), 1)
+            db_connection.commit()
+            if claimed != None:
+                return None
+            record = get_record(db_cursor, username, key)
+            # The holder may have released the key between both statements, in which case it's claimed again
+            if record != None:
+                return record
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+def get_record(db_cursor, username: str, key: str):
+    return db_operations.select(db_cursor,
+        "SELECT route, request_hash, status_code, content_type, response FROM idempotency_keys WHERE username = %s AND key = %s",
+        (username, key,), 1)
+
+def complete(username: str, key: str, status_code: int, content_type: str, body: bytes):
+    '''Records the response of a claimed key, or releases the key if the response must not be replayed.
+    '''
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    try:
+        if status_code >= 500 or status_code in NOT_RECORDED:
+            db_operations.insert(db_cursor, "DELETE FROM idempotency_keys WHERE username = %s AND key = %s", (username, key,))
+        else:
+            db_operations.insert(db_cursor,
+                "UPDATE idempotency_keys SET status_code = %s, content_type = %s, response = %s WHERE username = %s AND key = %s",
+                (status_code, content_type, body, username, key,))
+        db_connection.commit()
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+def replay(record) -> Response:
+    return Response(
+        content=bytes(record[4]),
+        status_code=record[2],
+        media_type=record[3],
+        headers={'Idempotent-Replayed': 'true'}
+    )
+
+class IdempotencyMiddleware(BaseHTTPMiddleware):
+    '''
+    Replays the recorded response when a request to one of IDEMPOTENT_ROUTES is retried with the same Idempotency-Key,
+    so retries never create another order, client or product. Keys are scoped by user.
+    A duplicate arriving while the original is still running waits for its response.
+    '''
+    def __init__(self, app):
+        super().__init__(app)
+        # Requests in flight on this worker, so local duplicates are woken up without polling
+        self.in_flight = {}
+
+    async def dispatch(self, request, call_next):
+        key = request.headers.get(HEADER)
+        if key == None or (request.method, request.url.path) not in IDEMPOTENT_ROUTES:
+            return await call_next(request)
+        username = get_username(request.headers.get('Authorization'))
+        if username == None:
+            return await call_next(request)
+        if len(key) == 0 or len(key) > 255:
+            return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"detail": "Idempotency-Key inválida"})
+        route = f"{request.method} {request.url.path}"
+        body = await request.body()
+        request_hash = hashlib.sha256(route.encode() + b'\n' + body).hexdigest()
+
+        while True:
+            record = await asyncio.to_thread(claim, username, key, route, request_hash)
+            if record == None:
+                metrics.record_cache('idempotency', False)
+                break
+            replayed = await self.wait_for_original(username, key, route, request_hash, record)
+            if replayed != None:
+                metrics.record_cache('idempotency', True)
+                return replayed
+
+        finished = asyncio.Event()
+        self.in_flight[(username, key)] = finished
+        try:
+            response = await call_next(request)
+            response_body = b''.join([chunk async for chunk in response.body_iterator])
+            await asyncio.to_thread(complete, username, key, response.status_code, response.media_type or response.headers.get('content-type'), response_body)
+        except Exception:
+            await asyncio.to_thread(complete, username, key, status.HTTP_500_INTERNAL_SERVER_ERROR, None, b'')
+            raise
+        finally:
+            finished.set()
+            self.in_flight.pop((username, key), None)
+        return Response(
+            content=response_body,
+            status_code=response.status_code,
+            headers=dict(response.headers),
+            media_type=response.media_type
+        )
+
+    async def wait_for_original(self, username: str, key: str, route: str, request_hash: str, record):
+        '''Waits for the request holding the key and returns its response to be replayed.
+        Returns None if the original released the key (it failed), so the caller claims it again.
+        '''
+        if record[0] != route or record[1] != request_hash:
+            return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, content={"detail": "Idempotency-Key já utilizada em outra requisição"})
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WAIT_TIMEOUT
+        while record[2] == None:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return JSONResponse(status_code=status.HTTP_409_CONFLICT, content={"detail": "Requisição com a mesma Idempotency-Key em andamento"})
+            local = self.in_flight.get((username, key))
+            if local != None:
+                try:
+                    await asyncio.wait_for(local.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(min(WAIT_POLL_INTERVAL, remaining))
+            record = await asyncio.to_thread(self.load_record, username, key)
+            if record == None:
+                return None
+        return replay(record)
+
+    def load_record(self, username: str, key: str):
+        db_connection = db_operations.postgres_connection()
+        db_cursor = db_connection.cursor()
+        try:
+            return get_record(db_cursor, username, key)
+        finally:
+            db_cursor.close()
+            db_connection.close()
@@ -0,0 +1,121 @@
+import asyncio
+import heapq
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+import pytz
+
+import db_operations
+
+# Size of each counting bucket. Windows start on bucket boundaries.
+BUCKET_SECONDS = 3600
+# Buckets older than this are discarded (a week plus the current day)
+RETENTION_SECONDS = 8 * 24 * 3600
+# Seconds between two reconciliations against the database
+RECONCILE_INTERVAL = 300
+LEADERBOARD_TIMEZONE = 'America/Sao_Paulo'
+
+logger = logging.getLogger(__name__)
+
+class Leaderboard():
+    '''
+    Units sold per product, counted in time buckets so any recent window can be summed without touching the database.
+    Each worker process keeps its own instance, updated by the order write paths and periodically replaced by reconcile().
+    '''
+    def __init__(self, bucket_seconds:int = BUCKET_SECONDS, retention_seconds:int = RETENTION_SECONDS):
+        self.bucket_seconds = bucket_seconds
+        self.retention_seconds = retention_seconds
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, when: datetime) -> int:
+        return int(when.timestamp()) // self.bucket_seconds
+
+    def record(self, product_id: int, quantity: int, when: datetime):
+        '''
+        Adds (or subtracts, if negative) units sold of a product to the bucket of the order date.
+        Orders older than the retention are ignored.
+        '''
+        bucket = self.get_bucket(when)
+        if bucket < (int(time.time()) - self.retention_seconds) // self.bucket_seconds:
+            return
+        with self.lock:
+            counter = self.buckets.setdefault(bucket, Counter())
+            counter[product_id] += quantity
+            if counter[product_id] == 0:
+                del counter[product_id]
+
+    def top(self, limit: int, since: datetime) -> list:
+        '''
+        Returns up to limit (product_id, units) tuples with most units sold since the specified date, sorted by units.
+        '''
+        first_bucket = self.get_bucket(since)
+        totals = Counter()
+        with self.lock:
+            for bucket, counter in self.buckets.items():
+                if bucket >= first_bucket:
+                    totals.update(counter)
+        return heapq.nlargest(limit, ((product_id, units) for product_id, units in totals.items() if units > 0), key=itemgetter(1))
+
+    def replace(self, buckets: dict):
+        '''
+        Replaces every bucket at once, discarding buckets older than the retention.
+        '''
+        oldest = (int(time.time()) - self.retention_seconds) // self.bucket_seconds
+        with self.lock:
+            self.buckets = {bucket: counter for bucket, counter in buckets.items() if bucket >= oldest}
+
+    def reconcile(self, db_cursor):
+        '''
+        Rebuilds the buckets from orders and orders_products, fixing drift from rolled back transactions and other workers.
+        Cancelled orders are not counted.
+        '''
+        since = datetime.fromtimestamp(time.time() - self.retention_seconds, pytz.utc)
+        query = """
+            SELECT FLOOR(EXTRACT(EPOCH FROM o.created_at) / %s)::bigint, op.product_id, SUM(op.quantity)
+            FROM orders o
+            JOIN orders_products op ON o.id = op.order_id
+            WHERE o.created_at >= %s AND o.status <> 1
+            GROUP BY 1, 2
+        """
+        buckets = {}
+        for bucket, product_id, units in db_operations.select(db_cursor, query, (self.bucket_seconds, since,)):
+            buckets.setdefault(bucket, Counter())[product_id] = int(units)
+        self.replace(buckets)
+
+board = Leaderboard()
+
+def get_window_start(window: str) -> datetime:
+    '''
+    Returns the start of a leaderboard window: "today" starts at local midnight and "week" covers the last 7 days.
+    Raises ValueError for unknown windows.
+    '''
+    now = datetime.now(pytz.timezone(LEADERBOARD_TIMEZONE))
+    if window == 'today':
+        return now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if window == 'week':
+        return now - timedelta(days=7)
+    raise ValueError
+
+def reconcile_now():
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    try:
+        board.reconcile(db_cursor)
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+async def reconcile_loop():
+    '''Reconciles the leaderboard on startup and then every RECONCILE_INTERVAL seconds.
+    '''
+    while True:
+        try:
+            await asyncio.to_thread(reconcile_now)
+        except Exception:
+            logger.exception("Leaderboard reconciliation failed")
+        await asyncio.sleep(RECONCILE_INTERVAL)
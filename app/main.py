@@ -1,14 +1,58 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
-from routers import clients, orders, products, users
+from fastapi.responses import PlainTextResponse
+from routers import clients, diagnostics, export, orders, products, reports, search, users
+import idempotency
+import leaderboard
+import metrics
+import order_events
+import order_intake
+import profiler
+import query_stats
+import sales_rollups
+import slow_queries
+import stock_ledger
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    slow_queries.start()
+    background_tasks = [
+        asyncio.create_task(sales_rollups.refresh_loop()),
+        asyncio.create_task(leaderboard.reconcile_loop()),
+        asyncio.create_task(stock_ledger.compact_loop()),
+        asyncio.create_task(metrics.flush_loop()),
+    ] + [
+        asyncio.create_task(order_intake.worker()) for _ in range(order_intake.WORKERS)
+    ]
+    yield
+    for task in background_tasks:
+        task.cancel()
+    order_events.broker.stop()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(idempotency.IdempotencyMiddleware)
+app.add_middleware(query_stats.QueryStatsMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(profiler.ProfilerMiddleware)
 
 app.include_router(users.router)
 app.include_router(clients.router)
 app.include_router(products.router)
 app.include_router(orders.router)
+app.include_router(reports.router)
+app.include_router(search.router)
+app.include_router(export.router)
+app.include_router(diagnostics.router)
 
 @app.get("/")
 def index():
     return {"message":"Lu Estilo"}
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    '''
+    Metrics of all worker processes in the Prometheus text format.
+    '''
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
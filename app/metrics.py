@@ -0,0 +1,231 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from starlette.middleware.base import BaseHTTPMiddleware
+
+import db_operations
+
+# Each worker process saves its metrics here, and /metrics sums the files of every live worker
+METRICS_DIR = os.path.join(tempfile.gettempdir(), 'lu_estilo_metrics')
+# Seconds between two saves. Other workers' numbers on /metrics may be this old.
+FLUSH_INTERVAL = 5
+
+REQUEST_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+
+logger = logging.getLogger(__name__)
+
+class Metric():
+    '''
+    Values of a metric by label values. Counters and gauges keep a number, histograms keep the bucket counts followed by sum and count.
+    '''
+    def __init__(self, name: str, help: str, type: str, labels: tuple, buckets: tuple = ()):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_values: tuple, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def set(self, label_values: tuple, value: float):
+        with self.lock:
+            self.values[label_values] = value
+
+    def observe(self, label_values: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts == None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            # Buckets are stored non cumulative and accumulated when rendered
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def dump(self) -> list:
+        with self.lock:
+            return [[list(label_values), value if type(value) != list else list(value)] for label_values, value in self.values.items()]
+
+registry = {}
+
+def counter(name: str, help: str, labels: tuple = ()) -> Metric:
+    return registry.setdefault(name, Metric(name, help, 'counter', labels))
+
+def gauge(name: str, help: str, labels: tuple = ()) -> Metric:
+    return registry.setdefault(name, Metric(name, help, 'gauge', labels))
+
+def histogram(name: str, help: str, labels: tuple = (), buckets: tuple = REQUEST_BUCKETS) -> Metric:
+    return registry.setdefault(name, Metric(name, help, 'histogram', labels, buckets))
+
+request_duration = histogram('http_request_duration_seconds', "Time to respond to HTTP requests, by route template and status.", ('method', 'route', 'status'))
+request_in_progress = gauge('http_requests_in_progress', "HTTP requests being handled.")
+query_duration = histogram('db_query_duration_seconds', "Time running statements, by statement family.", ('family',), QUERY_BUCKETS)
+connection_wait = histogram('db_connection_wait_seconds', "Time to get a database connection, from the pool or a new one.", (), QUERY_BUCKETS)
+pool_idle = gauge('db_pool_idle_connections', "Idle connections left in the pool after the last checkout.")
+cache_requests = counter('cache_requests_total', "Lookups in in-memory caches, by cache and result (hit or miss).", ('cache', 'result'))
+
+STATEMENT_VERB = re.compile(r'\s*([a-z]+)', re.IGNORECASE)
+STATEMENT_TABLE = re.compile(r'\b(?:from|into|update|copy)\s+([a-z_][a-z0-9_]*)', re.IGNORECASE)
+
+def get_family(query: str) -> str:
+    '''Returns the kind of statement and its first table, like "select products", to group query metrics without one series per statement.
+    '''
+    verb = STATEMENT_VERB.match(query)
+    if verb == None:
+        return 'other'
+    # The table of the statement itself, not of a subquery in its columns, unless all of them are in parentheses (like CTEs)
+    tables = list(STATEMENT_TABLE.finditer(query, verb.start(1)))
+    if len(tables) == 0:
+        return verb.group(1).lower()
+    table = next((table for table in tables if query.count('(', 0, table.start()) == query.count(')', 0, table.start())), tables[0])
+    return f"{verb.group(1).lower()} {table.group(1).lower()}"
+
+def record_query(query: str, args, duration: float, rowcount: int, caller: str):
+    query_duration.observe((get_family(query),), duration)
+
+def record_connection(duration: float):
+    connection_wait.observe((), duration)
+    pool_idle.set((), db_operations.pool.qsize())
+
+def record_cache(cache: str, hit: bool):
+    cache_requests.inc((cache, 'hit' if hit else 'miss'))
+
+def get_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"metrics_{pid}.json")
+
+def dump() -> dict:
+    return {name: metric.dump() for name, metric in registry.items()}
+
+def flush():
+    '''Saves this worker's metrics for the other workers' /metrics.
+    '''
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = get_path(os.getpid())
+    with open(path + '.tmp', 'w') as file:
+        json.dump(dump(), file)
+    os.replace(path + '.tmp', path)
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def collect() -> dict:
+    '''Returns the metrics of every live worker, this one included, summed by series.
+    Files of finished workers are removed, so their counters restart like in a process restart.
+    '''
+    dumps = [dump()]
+    if os.path.isdir(METRICS_DIR):
+        for file_name in os.listdir(METRICS_DIR):
+            match = re.fullmatch(r'metrics_(\d+)\.json', file_name)
+            if match == None or int(match.group(1)) == os.getpid():
+                continue
+            path = os.path.join(METRICS_DIR, file_name)
+            if not is_alive(int(match.group(1))):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as file:
+                    dumps.append(json.load(file))
+            except (OSError, ValueError):
+                logger.warning("Could not read metrics of %s", file_name)
+    totals = {}
+    for worker in dumps:
+        for name, values in worker.items():
+            series = totals.setdefault(name, {})
+            for label_values, value in values:
+                key = tuple(label_values)
+                if type(value) == list:
+                    current = series.get(key, [0] * len(value))
+                    series[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    series[key] = series.get(key, 0) + value
+    return totals
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra != '':
+        labels.append(extra)
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(labels) + '}'
+
+def render() -> str:
+    '''Returns the metrics of all workers in the Prometheus text format.
+    '''
+    totals = collect()
+    lines = []
+    for name, metric in registry.items():
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.type}")
+        for label_values, value in sorted(totals.get(name, {}).items()):
+            if metric.type != 'histogram':
+                lines.append(f"{name}{format_labels(metric.labels, label_values)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets, value):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{name}_bucket{format_labels(metric.labels, label_values, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{name}_bucket{format_labels(metric.labels, label_values, le)} {value[-1]}")
+            lines.append(f"{name}_sum{format_labels(metric.labels, label_values)} {value[-2]}")
+            lines.append(f"{name}_count{format_labels(metric.labels, label_values)} {value[-1]}")
+    return '\n'.join(lines) + '\n'
+
+async def flush_loop():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(flush)
+        except Exception:
+            logger.exception("Saving metrics failed")
+
+class MetricsMiddleware(BaseHTTPMiddleware):
+    '''
+    Records the latency of every request by route template (like /orders/{id}), so ids don't create one series each.
+    '''
+    def __init__(self, app):
+        super().__init__(app)
+        if record_query not in db_operations.hooks:
+            db_operations.hooks.append(record_query)
+        if record_connection not in db_operations.connection_hooks:
+            db_operations.connection_hooks.append(record_connection)
+
+    async def dispatch(self, request, call_next):
+        request_in_progress.inc(())
+        start = time.perf_counter()
+        status_code = 500
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+            return response
+        finally:
+            route = request.scope.get('route')
+            request_duration.observe(
+                (request.method, route.path if route != None else 'unmatched', str(status_code)),
+                time.perf_counter() - start)
+            request_in_progress.inc((), -1)
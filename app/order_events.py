@@ -0,0 +1,87 @@
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+
+import psycopg2.extensions
+
+import db_operations
+
+CHANNEL = 'order_events'
+# Events kept for a subscriber that is not reading. Older events are dropped past this size.
+SUBSCRIBER_QUEUE_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
+def notify(db_cursor, payload: dict):
+    '''
+    Publishes an order event with NOTIFY. Postgres only delivers it when the current transaction commits,
+    so listeners never see events of rolled back writes.
+    '''
+    db_operations.select(db_cursor, "SELECT pg_notify(%s, %s)", (CHANNEL, json.dumps(payload, default=str),), 1)
+
+class OrderEventBroker():
+    '''
+    Fans order events out to every subscriber of this worker. A single connection LISTENs for the whole process,
+    in a background thread, no matter how many streams are open.
+    '''
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+    def subscribe(self) -> asyncio.Queue:
+        '''
+        Returns a queue receiving the payload (str) of every event published from now on. Starts the listener if needed.
+        '''
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers[queue] = asyncio.get_running_loop()
+            if self.thread == None or not self.thread.is_alive():
+                self.running = True
+                self.thread = threading.Thread(target=self.listen, name="order-events-listener", daemon=True)
+                self.thread.start()
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self.lock:
+            self.subscribers.pop(queue, None)
+
+    def stop(self):
+        self.running = False
+
+    def publish(self, payload: str):
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+        for queue, loop in subscribers:
+            loop.call_soon_threadsafe(self.deliver, queue, payload)
+
+    def deliver(self, queue: asyncio.Queue, payload: str):
+        # A stalled subscriber loses its oldest events instead of holding memory for everyone
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(payload)
+
+    def listen(self):
+        while self.running:
+            try:
+                db_connection = db_operations.postgres_connection()
+                db_connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                db_cursor = db_connection.cursor()
+                db_cursor.execute(f"LISTEN {CHANNEL};")
+                while self.running:
+                    if select.select([db_connection], [], [], 5) == ([], [], []):
+                        continue
+                    db_connection.poll()
+                    while db_connection.notifies:
+                        self.publish(db_connection.notifies.pop(0).payload)
+                db_cursor.close()
+                db_connection.close()
+            except Exception:
+                logger.exception("Order events listener lost its connection, reconnecting")
+                time.sleep(1)
+
+broker = OrderEventBroker()
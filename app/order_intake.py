@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+
+from psycopg2.extras import Json
+
+import db_operations
+from db_classes import ObjectNotFound, Client, Order
+
+# Background tasks draining the intake queue on each worker process
+WORKERS = 2
+# Intake entries processed per transaction
+BATCH_SIZE = 50
+# Seconds to wait before looking again when the queue is empty
+POLL_INTERVAL = 0.5
+
+PENDING = 'pendente'
+PROCESSED = 'processada'
+REJECTED = 'rejeitada'
+
+logger = logging.getLogger(__name__)
+
+def enqueue(db_cursor, username: str, client_id: int, products: list) -> int:
+    '''Saves an order to be created in background and returns its tracking id. Commit is up to the caller.
+
+    products: list of {'product_id': int, 'quantity': int} dicts.
+    '''
+    return db_operations.insert(db_cursor,
+        "INSERT INTO order_intake (username, client_id, products) VALUES (%s, %s, %s)",
+        (username, client_id, Json(products),),
+        'id'
+    )
+
+def get_intake(db_cursor, id: int) -> dict:
+    '''Returns the processing state of an intake entry. Raises ObjectNotFound if it does not exist.
+    '''
+    result = db_operations.select(db_cursor,
+        "SELECT id, status, order_id, error, created_at, processed_at FROM order_intake WHERE id = %s",
+        (id,), 1)
+    if result == None:
+        raise ObjectNotFound
+    return {
+        'tracking_id': result[0],
+        'status': result[1],
+        'order_id': result[2],
+        'error': result[3],
+        'created_at': result[4],
+        'processed_at': result[5],
+    }
+
+def create_order(db_cursor, client_id: int, products: list) -> Order:
+    '''Creates the order through Order.include_product, the same path used by post(/orders).
+    Raises ObjectNotFound for a missing product and ValueError for insufficient stock.
+    Units sold are left out of the leaderboard until order.record_sales is called, once the order is saved.
+    '''
+    new_id = db_operations.insert(db_cursor, "INSERT INTO orders (client_id) VALUES (%s)", (client_id,), 'id')
+    order = Order(db_cursor, new_id)
+    for item in products:
+        order.include_product(item['product_id'], item['quantity'])
+    order.publish_event('created')
+    return order
+
+def process_entry(db_cursor, id: int, client_id: int, products: list, clients: dict):
+    '''Processes one intake entry inside a savepoint, so a rejected entry doesn't undo the rest of the batch.
+
+    clients: the clients of the batch by id, see Client.load_many.
+    '''
+    db_operations.insert(db_cursor, "SAVEPOINT order_intake_entry", ())
+    error = None
+    try:
+        if client_id not in clients:
+            error = {'message': "Cliente não localizado"}
+        if error == None:
+            order = create_order(db_cursor, client_id, products)
+    except ObjectNotFound:
+        error = {'message': "Um ou mais produtos não localizado"}
+    except ValueError:
+        error = {'message': "Um ou mais produtos não possui estoque sucifiente"}
+    except Exception:
+        # Anything else (like a psycopg2.DataError for values out of range of the columns) rejects only this entry,
+        # otherwise the batch would be rolled back and claimed again forever
+        logger.exception("Order intake entry %s failed", id)
+        error = {'message': "Não foi possível criar a ordem"}
+    if error != None:
+        db_operations.insert(db_cursor, "ROLLBACK TO SAVEPOINT order_intake_entry", ())
+        db_operations.insert(db_cursor,
+            "UPDATE order_intake SET status = %s, error = %s, processed_at = NOW() WHERE id = %s",
+            (REJECTED, Json(error), id,))
+    else:
+        db_operations.insert(db_cursor,
+            "UPDATE order_intake SET status = %s, order_id = %s, processed_at = NOW() WHERE id = %s",
+            (PROCESSED, order.id, id,))
+    db_operations.insert(db_cursor, "RELEASE SAVEPOINT order_intake_entry", ())
+    if error == None:
+        order.record_sales()
+
+def process_batch() -> int:
+    '''Claims up to BATCH_SIZE pending entries and processes them in one transaction. Returns the number of entries processed.
+    SKIP LOCKED lets several workers (and processes) drain the queue without waiting on each other.
+    '''
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    try:
+        entries = db_operations.select(db_cursor,
+            "SELECT id, client_id, products FROM order_intake WHERE status = %s ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED",
+            (PENDING, BATCH_SIZE,))
+        # The clients of the whole batch are checked with one query instead of one per entry
+        clients = Client.load_many(db_cursor, {entry[1] for entry in entries})
+        for id, client_id, products in entries:
+            if type(products) == str:
+                products = json.loads(products)
+            process_entry(db_cursor, id, client_id, products, clients)
+        db_connection.commit()
+        return len(entries)
+    except:
+        db_connection.rollback()
+        raise
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+async def worker():
+    while True:
+        try:
+            processed = await asyncio.to_thread(process_batch)
+        except Exception:
+            logger.exception("Order intake batch failed")
+            processed = 0
+        if processed < BATCH_SIZE:
+            await asyncio.sleep(POLL_INTERVAL)
@@ -0,0 +1,216 @@
+import hashlib
+import hmac
+import html
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from fastapi import status
+from fastapi.responses import JSONResponse, Response
+from starlette.middleware.base import BaseHTTPMiddleware
+
+import utils
+
+# Requests carrying this header, signed by create_signature, are profiled
+HEADER = 'X-Profile'
+# Where the profile goes: "file" (default, saved in PROFILES_DIR), "collapsed" or "svg" (returned instead of the response)
+OUTPUT_HEADER = 'X-Profile-Output'
+# Fraction of all requests profiled without the header, saved in PROFILES_DIR. 0 disables sampling.
+SAMPLE_RATE = 0.0
+# Seconds between two stack samples
+SAMPLE_INTERVAL = 0.005
+# Longest a request is sampled, for streams left open (like get(/orders/stream))
+MAX_DURATION = 60
+# Seconds a signature is accepted for
+SIGNATURE_TTL = 600
+PROFILES_DIR = os.path.join(tempfile.gettempdir(), 'lu_estilo_profiles')
+
+FILE = 'file'
+COLLAPSED = 'collapsed'
+SVG = 'svg'
+
+FLAMEGRAPH_WIDTH = 1200
+FLAMEGRAPH_ROW_HEIGHT = 16
+
+logger = logging.getLogger(__name__)
+
+def sign(method: str, path: str, expires: int) -> str:
+    message = f"{method.upper()} {path} {expires}".encode()
+    return hmac.new(utils.SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+def create_signature(method: str, path: str, ttl: int = SIGNATURE_TTL) -> str:
+    '''Returns the HEADER value allowing method and path (without query string) to be profiled for ttl seconds.
+    '''
+    expires = int(time.time()) + ttl
+    return f"{expires}:{sign(method, path, expires)}"
+
+def verify(signature: str, method: str, path: str) -> bool:
+    expires, _, digest = signature.partition(':')
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(digest, sign(method, path, int(expires)))
+
+def get_stack(frame) -> str:
+    '''Returns the stack of a frame, outermost call first, as "file:function" entries joined by ";".
+    '''
+    names = []
+    while frame != None:
+        names.append(f"{frame.f_code.co_filename.rsplit('/', 1)[-1]}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+class Sampler():
+    '''
+    Statistical profiler: a thread recording the stack of another thread every interval seconds, counted by stack.
+    The profiled code runs unchanged, so the cost is the same whatever it does.
+    '''
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL, max_duration: float = MAX_DURATION):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_duration = max_duration
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval) and time.perf_counter() - self.started_at < self.max_duration:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame != None:
+                self.stacks[get_stack(frame)] += 1
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self.thread.start()
+
+    def stop(self) -> Counter:
+        self.stopped.set()
+        self.thread.join()
+        self.duration = min(time.perf_counter() - self.started_at, self.max_duration)
+        return self.stacks
+
+def collapse(stacks: Counter) -> str:
+    '''Returns the stacks in the collapsed format read by flamegraph.pl and speedscope: one "stack count" line each.
+    '''
+    return ''.join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+def get_color(name: str) -> str:
+    shade = int(hashlib.md5(name.encode()).hexdigest()[:4], 16)
+    return f"rgb({205 + shade % 50},{80 + shade % 120},{shade % 55})"
+
+def flamegraph(stacks: Counter, title: str = '') -> str:
+    '''Returns an SVG flame graph of the stacks: each box is a function, as wide as the samples it appears in, on top of its caller.
+    '''
+    tree = {'count': 0, 'children': {}}
+    depth = 0
+    for stack, count in stacks.items():
+        node = tree
+        node['count'] += count
+        names = stack.split(';')
+        depth = max(depth, len(names))
+        for name in names:
+            node = node['children'].setdefault(name, {'count': 0, 'children': {}})
+            node['count'] += count
+    height = (depth + 2) * FLAMEGRAPH_ROW_HEIGHT
+    boxes = []
+
+    def draw(node: dict, x: float, level: int):
+        for name, child in sorted(node['children'].items()):
+            width = child['count'] / tree['count'] * FLAMEGRAPH_WIDTH
+            if width >= 0.5:
+                y = height - (level + 1) * FLAMEGRAPH_ROW_HEIGHT
+                label = html.escape(name)
+                text = label if len(name) * 7 < width else ''
+                boxes.append(
+                    f'<g><title>{label} ({child["count"]} samples, {child["count"] / tree["count"]:.1%})</title>'
+                    f'<rect x="{x:.1f}" y="{y}" width="{width:.1f}" height="{FLAMEGRAPH_ROW_HEIGHT - 1}" fill="{get_color(name)}"/>'
+                    f'<text x="{x + 3:.1f}" y="{y + FLAMEGRAPH_ROW_HEIGHT - 4}">{text}</text></g>'
+                )
+                draw(child, x, level + 1)
+            x += width
+
+    if tree['count'] > 0:
+        draw(tree, 0, 0)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{FLAMEGRAPH_WIDTH}" height="{height}" font-family="monospace" font-size="11">'
+        f'<text x="3" y="12">{html.escape(title)} ({tree["count"]} samples)</text>'
+        + ''.join(boxes) + '</svg>\n'
+    )
+
+def get_path(name: str) -> str:
+    '''Returns where the profile of a request is saved, without extension.
+    '''
+    return os.path.join(PROFILES_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')}")
+
+def save(stacks: Counter, name: str, path: str | None = None) -> str:
+    '''Writes the collapsed stacks and flame graph to PROFILES_DIR. Returns the path without extension.
+    '''
+    os.makedirs(PROFILES_DIR, exist_ok=True)
+    if path == None:
+        path = get_path(name)
+    with open(path + '.folded', 'w') as file:
+        file.write(collapse(stacks))
+    with open(path + '.svg', 'w') as file:
+        file.write(flamegraph(stacks, name))
+    return path
+
+class ProfilerMiddleware(BaseHTTPMiddleware):
+    '''
+    Samples the stacks of the event loop thread while a signed (see create_signature) or randomly sampled request runs.
+    Other requests only pay for a header lookup.
+    Routes run on the event loop, so requests handled at the same time show up in the profile too, and work sent to other threads doesn't.
+    '''
+    async def dispatch(self, request, call_next):
+        signature = request.headers.get(HEADER)
+        if signature == None:
+            if SAMPLE_RATE == 0 or random.random() >= SAMPLE_RATE:
+                return await call_next(request)
+            output = FILE
+        else:
+            if not verify(signature, request.method, request.url.path):
+                return JSONResponse(status_code=status.HTTP_403_FORBIDDEN, content={"detail": "Assinatura de profiling inválida"})
+            output = request.headers.get(OUTPUT_HEADER, FILE)
+            if output not in (FILE, COLLAPSED, SVG):
+                return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"detail": "Saída de profiling inválida"})
+
+        sampler = Sampler(threading.get_ident())
+        sampler.start()
+        try:
+            response = await call_next(request)
+        except:
+            sampler.stop()
+            raise
+        name = f"{request.method} {request.url.path}"
+        # Event streams never end, so they can't be returned inline: they are profiled to a file until the client leaves
+        if output == FILE or response.headers.get('content-type', '').startswith('text/event-stream'):
+            path = get_path(name)
+            response.body_iterator = profile_body(response.body_iterator, sampler, name, path)
+            if signature != None:
+                response.headers['X-Profile-File'] = path + '.svg'
+            return response
+        # The body of streamed responses is produced while it is read, so it is read here to be profiled too
+        try:
+            async for _ in response.body_iterator:
+                pass
+        finally:
+            stacks = sampler.stop()
+        if output == COLLAPSED:
+            return Response(content=collapse(stacks), media_type='text/plain', headers={'X-Profile-Status': str(response.status_code)})
+        return Response(content=flamegraph(stacks, name), media_type='image/svg+xml', headers={'X-Profile-Status': str(response.status_code)})
+
+async def profile_body(body_iterator, sampler: Sampler, name: str, path: str):
+    '''Passes the body of a profiled response through, saving the profile once it's sent or the client goes away.
+    The sampler stops on its own after MAX_DURATION.
+    '''
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        stacks = sampler.stop()
+        save(stacks, name, path)
+        logger.info("Profiled %s in %.1f ms: %s.svg", name, sampler.duration * 1000, path)
@@ -0,0 +1,53 @@
+import difflib
+
+import pytest
+
+import budgets
+import query_stats
+
+# Query and latency budgets of budgets.BUDGETS: a test fails if a request it makes goes over its route's budget.
+# The statements of the last request of each route within budget are kept in the pytest cache, to show what changed when one goes over.
+
+def pytest_addoption(parser):
+    group = parser.getgroup('budgets')
+    group.addoption('--budget-dataset', default=budgets.DEFAULT_DATASET,
+        help="Dataset loaded in the database, selecting the latency budgets (sample or large).")
+    group.addoption('--no-budgets', action='store_true', help="Don't check query and latency budgets.")
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', "no_budget: don't check the query and latency budgets of the requests of this test.")
+
+def get_cache_key(method: str, route: str) -> str:
+    return f"budgets/{method} {route}"
+
+def get_report(config, method: str, route: str, stats, duration: float, problems: list) -> str:
+    lines = [f"{method} {route} went over its budget: {', '.join(problems)}"]
+    previous = config.cache.get(get_cache_key(method, route), None) if config.cache != None else None
+    if previous != None:
+        lines.append("Statements compared with the last run within budget:")
+        lines += difflib.unified_diff(previous, budgets.describe(stats, callers=False), 'within budget', 'this test', lineterm='')
+    lines.append("Statements of this request:")
+    lines += [f"  {line}" for line in budgets.describe(stats)]
+    return '\n'.join(lines)
+
+@pytest.hookimpl(wrapper=True)
+def pytest_runtest_call(item):
+    requests = []
+    listener = lambda method, route, stats, duration: requests.append((method, route, stats, duration))
+    query_stats.listeners.append(listener)
+    try:
+        result = yield
+    finally:
+        query_stats.listeners.remove(listener)
+    if item.config.getoption('no_budgets') or item.get_closest_marker('no_budget') != None:
+        return result
+    reports = []
+    for method, route, stats, duration in requests:
+        problems = budgets.check(method, route, stats, duration, item.config.getoption('budget_dataset'))
+        if len(problems) > 0:
+            reports.append(get_report(item.config, method, route, stats, duration, problems))
+        elif (method, route) in budgets.BUDGETS and item.config.cache != None:
+            item.config.cache.set(get_cache_key(method, route), budgets.describe(stats, callers=False))
+    if len(reports) > 0:
+        pytest.fail('\n\n'.join(reports), pytrace=False)
+    return result
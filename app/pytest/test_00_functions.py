@@ -2,10 +2,21 @@ import pytest
 from fastapi import FastAPI, HTTPException
 from fastapi.testclient import TestClient
 from datetime import datetime
+import asyncio
+import threading
 
 from ..main import app
 from ..utils import *
 from ..db_classes import *
+from ..leaderboard import Leaderboard
+from ..text_search import ResultCache, like_pattern
+from ..query_stats import RequestStats, normalize
+from ..metrics import Metric, get_family
+from ..profiler import Sampler, collapse, create_signature, flamegraph, get_path, profile_body, verify
+from ..budgets import check, describe
+from ..slow_queries import SLOW_QUERY_THRESHOLD, get_entries, is_read_only, record
+from ..benchmarks.plans import compare, get_combinations, get_shape
+from ..query_builder import statement, update, where
 
 client = TestClient(app)
 
@@ -77,4 +88,194 @@ def test_validade_email_fail_01():
     assert not validate_email('abcxyz.jkl')
     assert not validate_email('asd@fdsfus')
     assert not validate_email('me@dot.jp.com')
-    assert not validate_email('@uai.com')
\ No newline at end of file
+    assert not validate_email('@uai.com')
+
+def test_leaderboard_01():
+    board = Leaderboard()
+    now = datetime.now().astimezone()
+    board.record(1, 10, now)
+    board.record(2, 5, now)
+    board.record(3, 7, now)
+    board.record(1, -4, now)
+    assert board.top(2, now) == [(3, 7), (1, 6)]
+
+def test_leaderboard_02():
+    board = Leaderboard()
+    now = datetime.now().astimezone()
+    board.record(1, 3, now)
+    board.record(1, -3, now)
+    assert board.top(10, now) == []
+
+def test_like_pattern_01():
+    assert like_pattern('Ana') == '%ana%'
+    assert like_pattern('50%_off', prefix=True) == '50\\%\\_off%'
+
+def test_result_cache_01():
+    cache = ResultCache(ttl=60, max_size=2)
+    cache.set('a', [1])
+    cache.set('b', [2])
+    assert cache.get('a') == [1]
+    cache.set('c', [3])
+    assert cache.get('b') == None
+    assert cache.get('a') == [1]
+    expired = ResultCache(ttl=-1)
+    expired.set('a', [1])
+    assert expired.get('a') == None
+
+def test_validate_cpfs_01():
+    cpfs = [generate_cpf() for _ in range(100)] + ['59375349055', '59375349056', '11111111111', '123', '5937534905a']
+    assert list(validate_cpfs(cpfs)) == [True] * 101 + [False] * 4
+
+def test_validate_emails_01():
+    emails = ['laurence.howe@gmail.com', 'laurence.howe', '@gmail.com', 'laurence@gmail.com.br', None]
+    assert list(validate_emails(emails)) == [True, False, False, False, False]
+
+def test_normalize_query_01():
+    assert normalize("SELECT * FROM products p\n  WHERE p.id = %s limit 1") == "SELECT * FROM products p WHERE p.id = ? limit ?"
+    assert normalize("SELECT id FROM orders WHERE status = '2' AND id IN (%s, %s, %s)") == "SELECT id FROM orders WHERE status = ? AND id IN (?)"
+
+def test_request_stats_01():
+    stats = RequestStats()
+    for id in range(12):
+        stats.add(f"SELECT name FROM sections where id = {id} limit 1", 0.001, 1, "db_classes.py:1 get_section_name")
+    stats.add("SELECT id FROM products", 0.002, 20, "products.py:1 get_products")
+    assert stats.count == 13
+    repeated = stats.get_repeated(10)
+    assert len(repeated) == 1
+    assert repeated[0][0] == "SELECT name FROM sections where id = ? limit ?"
+    assert repeated[0][1].count == 12
+    assert repeated[0][1].rows == 12
+
+def test_get_family_01():
+    assert get_family("SELECT * FROM products p WHERE p.id = %s") == "select products"
+    assert get_family("\n    UPDATE clients SET name = %s") == "update clients"
+    assert get_family("WITH moved AS (INSERT INTO stock_movements (product_id) VALUES (%s)) SELECT 1") == "with stock_movements"
+    assert get_family("BEGIN") == "begin"
+
+def test_metric_histogram_01():
+    metric = Metric('test_seconds', "Test.", 'histogram', ('route',), (.1, 1))
+    metric.observe(('/orders',), .05)
+    metric.observe(('/orders',), .5)
+    metric.observe(('/orders',), 5)
+    assert metric.dump() == [[['/orders'], [1, 1, 5.55, 3]]]
+
+def test_profile_signature_01():
+    signature = create_signature('GET', '/products')
+    assert verify(signature, 'GET', '/products')
+    assert not verify(signature, 'GET', '/orders')
+    assert not verify(create_signature('GET', '/products', ttl=-1), 'GET', '/products')
+
+def test_flamegraph_01():
+    stacks = {'main.py:index;db_classes.py:get_images': 3, 'main.py:index': 1}
+    assert collapse(stacks) == "main.py:index 1\nmain.py:index;db_classes.py:get_images 3\n"
+    svg = flamegraph(stacks, 'GET /')
+    assert '(4 samples)' in svg
+    assert 'db_classes.py:get_images (3 samples, 75.0%)' in svg
+
+def test_profile_body_01():
+    async def body():
+        yield b'data: 1\n\n'
+        yield b'data: 2\n\n'
+    async def read():
+        sampler = Sampler(threading.get_ident())
+        sampler.start()
+        path = get_path('GET /orders/stream')
+        chunks = [chunk async for chunk in profile_body(body(), sampler, 'GET /orders/stream', path)]
+        return chunks, sampler, path
+    chunks, sampler, path = asyncio.run(read())
+    # The body passes through unchanged and the sampler is stopped once it ends
+    assert chunks == [b'data: 1\n\n', b'data: 2\n\n']
+    assert not sampler.thread.is_alive()
+    with open(path + '.svg') as file:
+        assert 'GET /orders/stream' in file.read()
+
+def test_slow_queries_01():
+    assert is_read_only("SELECT id FROM products WHERE stock > %s")
+    assert not is_read_only("SELECT stock FROM products WHERE id = %s FOR UPDATE")
+    assert not is_read_only("WITH moved AS (INSERT INTO stock_movements (product_id) VALUES (%s)) SELECT 1")
+    record("SELECT id FROM products WHERE stock > %s", (10,), 0.001, 5, "test")
+    record("SELECT id\n  FROM orders WHERE client_id = %s", (3,), SLOW_QUERY_THRESHOLD, 2, "test")
+    entry = get_entries(1)[0]
+    assert entry['query'] == "SELECT id FROM orders WHERE client_id = %s"
+    assert entry['params'] == [3]
+    assert entry['analyzed']
+
+def test_generate_cpfs_01():
+    numbers = [0, 123456789, 987654321, 10**9 + 5, 5]
+    cpfs = generate_cpfs(numbers)
+    assert cpfs == [generate_cpf(number) for number in numbers]
+    assert cpfs[1] == '12345678909'
+    assert cpfs[3] == cpfs[4]
+    assert list(validate_cpfs(cpfs[1:])) == [True] * 4
+
+def test_budgets_01():
+    stats = RequestStats()
+    for id in range(5):
+        stats.add(f"SELECT image from images where product_id = {id}", 0.001, 1, "db_classes.py:1 get_images")
+    assert check('GET', '/products/{id}', stats, 0.01) == ["5 statements, budget is 4"]
+    assert check('GET', '/products/{id}', stats, 10, 'large') == ["5 statements, budget is 4", "10000 ms, budget is 300 ms on the large dataset"]
+    assert check('GET', '/unknown', stats, 10) == []
+    assert describe(stats, callers=False) == ["5x SELECT image from images where product_id = ?"]
+
+def test_budgets_02():
+    # A page of get(/orders) on the sample data: 20 orders with 50 lines
+    stats = RequestStats()
+    stats.add("EXECUTE user_by_username ('test_op')", 0.001, 1, "utils.py:1 get_user")
+    stats.add("SELECT o.id FROM orders o LIMIT 20 OFFSET 0", 0.001, 20, "routers/orders.py:1 get_orders")
+    for id in range(20):
+        stats.add(f"EXECUTE order_by_id ({id})", 0.001, 1, "db_classes.py:1 __init__")
+        stats.add(f"SELECT description from order_status where id = {id} LIMIT 1", 0.001, 1, "db_classes.py:1 get_status_description")
+        stats.add(f"SELECT * FROM orders_products WHERE order_id = {id}", 0.001, 3, "db_classes.py:1 get_products")
+    for id in range(50):
+        stats.add(f"EXECUTE product_by_id ({id})", 0.001, 1, "db_classes.py:1 __init__")
+        stats.add(f"EXECUTE section_name_by_id ({id})", 0.001, 1, "db_classes.py:1 get_section_name")
+    assert check('GET', '/orders', stats, 0.1) == []
+    # Loading the images of each line is one statement more per line
+    for id in range(50):
+        stats.add(f"SELECT image from images where product_id = {id}", 0.001, 1, "db_classes.py:1 get_images")
+    assert check('GET', '/orders', stats, 0.1) == ["212 statements, budget is 165"]
+
+def test_query_plans_01():
+    assert get_combinations({'a': [1], 'b': [2, 3]}) == [{}, {'a': 1}, {'b': 2}, {'b': 3}, {'a': 1, 'b': 2}, {'a': 1, 'b': 3}]
+    plan = {'Node Type': 'Limit', 'Plans': [{'Node Type': 'Nested Loop', 'Join Type': 'Inner', 'Plans': [
+        {'Node Type': 'Index Scan', 'Relation Name': 'orders', 'Index Name': 'orders_pkey'},
+        {'Node Type': 'Seq Scan', 'Relation Name': 'sections'}
+    ]}]}
+    shape = get_shape(plan)
+    assert shape == ['Limit', '  Nested Loop (Inner)', '    Index Scan on orders using orders_pkey', '    Seq Scan on sections']
+    assert compare({'GET /orders': shape}, {'GET /orders': shape}) == ([], [])
+    degraded = [line.replace('Index Scan on orders using orders_pkey', 'Seq Scan on orders') for line in shape]
+    degradations, changes = compare({'GET /orders': shape}, {'GET /orders': degraded})
+    assert degradations == ["GET /orders: orders read by Seq Scan, was Index Scan"]
+    assert len(changes) == 1
+
+def test_query_builder_01():
+    template = """
+        SELECT id FROM clients
+        {filters}
+        ORDER BY {order} LIMIT 20
+    """
+    query = statement(template, filters=where(('name ILIKE %s', 'email ILIKE %s')), order='id')
+    assert query == "SELECT id FROM clients WHERE name ILIKE %s AND email ILIKE %s ORDER BY id LIMIT 20"
+    assert statement(template, filters=where(()), order='id') == "SELECT id FROM clients ORDER BY id LIMIT 20"
+    assert statement(template, filters=where(('name ILIKE %s', 'email ILIKE %s')), order='id') is query
+    assert update('products', ('description', 'barcode')) == "UPDATE products SET description = %s, barcode = %s WHERE id = %s"
+
+def test_prepared_statements_01():
+    # db_operations as imported by db_classes, where the statements are registered
+    assert db_operations.prepared_statements['section_name_by_id'] == (
+        "PREPARE section_name_by_id (bigint) AS SELECT name FROM sections WHERE id = $1 LIMIT 1",
+        "SELECT name FROM sections WHERE id = %s LIMIT 1",
+        "EXECUTE section_name_by_id (%s)"
+    )
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    assert db_operations.select_prepared(db_cursor, 'section_name_by_id', (1,), 1)[0] == 'Laticínios'
+    # Ids past the integer range find nothing, as in the plain query
+    assert db_operations.select_prepared(db_cursor, 'client_by_id', (99999999999,), 1) == None
+    db_cursor.close()
+    db_connection.close()
+    reused = db_operations.postgres_connection()
+    assert reused is db_connection
+    assert 'user_by_username' in reused.prepared
+    reused.close()
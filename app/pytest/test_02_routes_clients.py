@@ -1,3 +1,4 @@
+import json
 import pytest
 from fastapi import FastAPI, HTTPException
 from fastapi.testclient import TestClient
@@ -54,6 +55,32 @@ def test_get_clients_04():
         })
     assert response.status_code == 204
 
+def test_get_clients_05():
+    response = client.get(
+        "/clients",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'filter': 'vicente cameron'
+        })
+    assert response.status_code == 200
+    assert response.json()[0]['id'] == 14
+
+def test_get_clients_06():
+    response = client.get(
+        "/clients",
+        headers={"Authorization": f"Bearer {operator}"},)
+    assert response.status_code == 200
+    ids = [entry['id'] for entry in response.json()]
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    try:
+        clients = Client.load_many(db_cursor, ids + [-1])
+    finally:
+        db_cursor.close()
+        db_connection.close()
+    assert [clients[id].get_info() for id in ids] == response.json()
+    assert -1 not in clients
+
 def test_create_client_ok_01():
     name = f'test{datetime.now()}'
     email = f'test{datetime.now()}@test.com'
@@ -311,6 +338,62 @@ def test_update_client_fail_05():
     assert response.status_code == 400
     assert response.json()["detail"] == 'E-mail já existe'
 
+def test_create_clients_bulk_ok_01():
+    stamp = datetime.now().timestamp()
+    cpf = generate_cpf()
+    content = "\n".join([
+        "name,email,cpf",
+        f"Bulk One,bulk1_{stamp}@test.com,{cpf}",
+        f"Bulk Two,bulk2_{stamp}@test.com,123",
+        f"Bulk Three,bulk3_{stamp}@test.com,{cpf}",
+        "Bulk Four,laurence.howe@gmail.com," + generate_cpf(),
+    ])
+    response = client.post(
+        "/clients:bulk",
+        headers={"Authorization": f"Bearer {operator}", "Content-Type": "text/csv"},
+        content=content)
+    assert response.status_code == 200
+    assert response.json()['received'] == 4
+    assert response.json()['inserted'] == 1
+    assert response.json()['errors'] == [
+        {'row': 2, 'detail': 'CPF inválido'},
+        {'row': 3, 'detail': 'CPF já existe'},
+        {'row': 4, 'detail': 'Email já existe'},
+    ]
+    assert Client(cpf = cpf).email == f"bulk1_{stamp}@test.com"
+
+def test_create_clients_bulk_ok_02():
+    stamp = datetime.now().timestamp()
+    content = "\n".join([
+        json.dumps({'name': 'Bulk Json', 'email': f'bulkjson_{stamp}@test.com', 'cpf': generate_cpf()}),
+        "not json",
+        json.dumps({'name': '', 'email': f'bulkjson2_{stamp}@test.com', 'cpf': generate_cpf()}),
+    ])
+    response = client.post(
+        "/clients:bulk",
+        headers={"Authorization": f"Bearer {operator}", "Content-Type": "application/x-ndjson"},
+        content=content)
+    assert response.status_code == 200
+    assert response.json()['inserted'] == 1
+    assert response.json()['errors'] == [
+        {'row': 2, 'detail': 'Linha inválida'},
+        {'row': 3, 'detail': 'Nome não pode ser vazio'},
+    ]
+
+def test_create_clients_bulk_fail_01():
+    response = client.post(
+        "/clients:bulk",
+        headers={"Authorization": f"Bearer {operator}", "Content-Type": "application/json"},
+        content="[]")
+    assert response.status_code == 415
+
+def test_create_clients_bulk_fail_02():
+    response = client.post(
+        "/clients:bulk",
+        headers={"Authorization": f"Bearer {operator}", "Content-Type": "text/csv"},
+        content="name,email\nBulk,bulk@test.com")
+    assert response.status_code == 400
+
 def test_delete_client_ok_01():
     name = f'test{datetime.now()}'
     email = f'test{datetime.now()}@test.com'
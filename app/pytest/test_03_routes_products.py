@@ -1,3 +1,4 @@
+import json
 import pytest
 from fastapi import FastAPI, HTTPException
 from fastapi.testclient import TestClient
@@ -98,6 +99,25 @@ def test_get_products_06():
             break
     assert not has_wrong_products
 
+def test_get_products_07():
+    response = client.get(
+        "/products",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'q': 'feijão carioca'
+        })
+    assert response.status_code == 200
+    assert response.json()[0]['id'] == 3
+
+def test_get_products_08():
+    response = client.get(
+        "/products",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'q': '100%'
+        })
+    assert response.status_code == 204
+
 def test_create_products_ok_01():
     response = client.post(
         "/products",
@@ -344,4 +364,245 @@ def test_delete_product_fail_02():
         "/products/-1",
         headers={"Authorization": f"Bearer {admin}"},
     )
-    assert response.status_code == 204
\ No newline at end of file
+    assert response.status_code == 204
+
+def test_put_product_stock_shards_ok_01():
+    initial_stock = Product(id = 6).stock
+    response = client.put(
+        "/products/6/stock-shards",
+        headers={"Authorization": f"Bearer {admin}"},
+        json={
+            "shards": 4
+        })
+    assert response.status_code == 200
+    assert response.json()['stock'] == initial_stock
+    assert Product(id = 6).stock == initial_stock
+    create_response = client.post(
+        "/orders",
+        headers={"Authorization": f"Bearer {admin}"},
+        json={
+            "client_id": 10,
+            "products": [
+                {
+                    "product_id": 6,
+                    "quantity": 2
+                }
+            ]
+        })
+    assert create_response.status_code == 200
+    assert Product(id = 6).stock == initial_stock - 2
+    response = client.put(
+        "/products/6/stock-shards",
+        headers={"Authorization": f"Bearer {admin}"},
+        json={
+            "shards": 0
+        })
+    assert response.status_code == 200
+    assert Product(id = 6).stock == initial_stock - 2
+
+def test_put_product_stock_shards_fail_01():
+    response = client.put(
+        "/products/6/stock-shards",
+        headers={"Authorization": f"Bearer {operator}"},
+        json={
+            "shards": 4
+        })
+    assert response.status_code == 403
+
+def test_get_product_stock_history_ok_01():
+    initial_stock = Product(id = 7).stock
+    create_response = client.post(
+        "/orders",
+        headers={"Authorization": f"Bearer {admin}"},
+        json={
+            "client_id": 10,
+            "products": [
+                {
+                    "product_id": 7,
+                    "quantity": 3
+                }
+            ]
+        })
+    assert create_response.status_code == 200
+    response = client.get(
+        "/products/7/stock-history",
+        headers={"Authorization": f"Bearer {operator}"},)
+    assert response.status_code == 200
+    assert response.json()[0]['delta'] == -3
+    assert response.json()[0]['reason'] == 'inclusao_ordem'
+    assert Product(id = 7).stock == initial_stock - 3
+    from ..stock_ledger import compact_now
+    compact_now()
+    assert Product(id = 7).stock == initial_stock - 3
+
+def test_compact_stock_ledger_ok_01():
+    # A movement committed after movements with higher ids were folded still counts, and is folded on the next run
+    # without the compactor rewriting it
+    from ..stock_ledger import compact_now
+    compact_now()
+    initial_stock = Product(id = 9).stock
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    try:
+        movement = db_operations.insert(db_cursor,
+            "INSERT INTO stock_movements (id, product_id, delta, reason) SELECT MIN(id) - 1, 9, -1, 'ajuste' FROM stock_movements",
+            (), 'xmin::text')
+        db_connection.commit()
+        assert Product(id = 9).stock == initial_stock - 1
+        compact_now()
+        assert Product(id = 9).stock == initial_stock - 1
+        assert db_operations.select(db_cursor, "SELECT COUNT(*) FROM stock_movements WHERE product_id = 9 AND xmin::text = %s", (movement,), 1)[0] == 1
+        db_operations.insert(db_cursor, "INSERT INTO stock_movements (product_id, delta, reason) VALUES (9, 1, 'ajuste')", ())
+        db_connection.commit()
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+def test_get_product_stock_history_fail_01():
+    response = client.get(
+        "/products/-1/stock-history",
+        headers={"Authorization": f"Bearer {operator}"},)
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Produto não localizado'
+
+def test_upsert_products_bulk_ok_01():
+    barcode = ''.join([str(random.randint(0, 9)) for _ in range(13)])
+    response = client.post(
+        "/products:bulk",
+        headers={"Authorization": f"Bearer {admin}", "Content-Type": "text/csv"},
+        content="\n".join([
+            "description,sell_value,barcode,section,stock,expiration_date",
+            f"Bulk Product,4.50,{barcode},Marcearia,30,12/06/2030",
+            f"Bulk Product,4.50,{barcode}1,Inexistente,30,",
+        ]))
+    assert response.status_code == 200
+    assert response.json()['inserted'] == 1
+    assert response.json()['errors'] == [{'row': 2, 'detail': 'Categoria não localizada'}]
+    product = Product(barcode = barcode)
+    assert product.stock == 30
+    response = client.post(
+        "/products:bulk",
+        headers={"Authorization": f"Bearer {admin}", "Content-Type": "application/x-ndjson"},
+        content="\n".join([
+            json.dumps({'description': 'Bulk Product', 'sell_value': 4.5, 'barcode': barcode, 'section': 'marcearia', 'stock': 40}),
+            json.dumps({'description': 'Bulk Product 2', 'sell_value': 5.5, 'barcode': barcode, 'section': 'marcearia', 'stock': 25}),
+        ]))
+    assert response.status_code == 200
+    assert response.json()['inserted'] == 0
+    assert response.json()['updated'] == 1
+    assert response.json()['errors'] == [{'row': 1, 'detail': 'Código de barras repetido no arquivo'}]
+    product = Product(barcode = barcode)
+    assert product.description == 'Bulk Product 2'
+    assert product.stock == 25
+
+def test_upsert_products_bulk_fail_01():
+    response = client.post(
+        "/products:bulk",
+        headers={"Authorization": f"Bearer {operator}", "Content-Type": "text/csv"},
+        content="description,sell_value,barcode,section,stock,expiration_date")
+    assert response.status_code == 403
+
+def test_get_products_changes_ok_01():
+    first_response = client.get(
+        "/products/changes",
+        headers={"Authorization": f"Bearer {operator}"},)
+    assert first_response.status_code == 200
+    assert len(first_response.json()['upserts']) >= 20
+    assert first_response.json()['next_page'] == None
+    create_response = client.post(
+        "/orders",
+        headers={"Authorization": f"Bearer {admin}"},
+        json={
+            "client_id": 10,
+            "products": [
+                {
+                    "product_id": 8,
+                    "quantity": 1
+                }
+            ]
+        })
+    assert create_response.status_code == 200
+    response = client.get(
+        "/products/changes",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'since': first_response.json()['next_since']
+        })
+    assert response.status_code == 200
+    upserts = {product['id']: product for product in response.json()['upserts']}
+    assert upserts[8]['stock'] == Product(id = 8).stock
+    assert response.json()['next_since'] >= first_response.json()['next_since']
+
+def test_get_products_changes_ok_02():
+    barcode = ''.join([str(random.randint(0, 9)) for _ in range(12)])
+    create_response = client.post(
+        "/products",
+        headers={"Authorization": f"Bearer {admin}"},
+        json={
+            "description": "Produto Temporário",
+            "sell_value": 1.5,
+            "barcode": barcode,
+            "section_id": 1,
+            "stock": 5
+        })
+    assert create_response.status_code == 200
+    product_id = create_response.json()['details']['id']
+    since = client.get(
+        "/products/changes",
+        headers={"Authorization": f"Bearer {operator}"},).json()['next_since']
+    client.delete(
+        f"/products/{product_id}",
+        headers={"Authorization": f"Bearer {admin}"},)
+    response = client.get(
+        "/products/changes",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'since': since
+        })
+    assert product_id in response.json()['deletes']
+
+def test_get_products_changes_ok_03():
+    # Superseded changes are pruned, leaving the latest one for the syncs that haven't seen it
+    from ..stock_ledger import compact_now
+    since = client.get(
+        "/products/changes",
+        headers={"Authorization": f"Bearer {operator}"},).json()['next_since']
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    try:
+        record_product_changes(db_cursor, [8])
+        record_product_changes(db_cursor, [8])
+        db_connection.commit()
+        compact_now()
+        assert db_operations.select(db_cursor,
+            "SELECT COUNT(*) FROM product_changes WHERE product_id = 8 AND NOT deleted", (), 1)[0] == 1
+        db_connection.commit()
+    finally:
+        db_cursor.close()
+        db_connection.close()
+    response = client.get(
+        "/products/changes",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'since': since
+        })
+    assert response.status_code == 200
+    assert 8 in [product['id'] for product in response.json()['upserts']]
+
+def test_get_products_server_timing_01():
+    response = client.get(
+        "/products",
+        headers={"Authorization": f"Bearer {operator}"},)
+    assert response.status_code == 200
+    assert response.headers['Server-Timing'].startswith('db;dur=')
+    assert 'queries' in response.headers['Server-Timing']
+
+def test_get_metrics_01():
+    response = client.get(
+        "/products",
+        headers={"Authorization": f"Bearer {operator}"},)
+    assert response.status_code == 200
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'http_request_duration_seconds_count{method="GET",route="/products",status="200"}' in response.text
+    assert 'db_query_duration_seconds_count{family="select products"}' in response.text
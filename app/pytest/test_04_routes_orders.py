@@ -6,6 +6,7 @@ from datetime import datetime
 from ..main import app
 from ..utils import *
 from ..db_classes import *
+from ..order_intake import enqueue, get_intake, process_batch
 from .tokens import admin, operator
 
 client = TestClient(app)
@@ -178,6 +179,55 @@ def test_get_orders_fail_05():
     assert response.json()['detail'] == "Cliente não localizado, por favor redefina o filtro"
 
 
+def test_get_orders_ok_11():
+    response = client.get(
+        "/orders",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'min_total': 100,
+            'max_total': 300,
+        })
+    assert response.status_code == 200
+    assert all(100 <= order["total_value"] <= 300 for order in response.json())
+
+def test_get_orders_ok_12():
+    response = client.get(
+        "/orders",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'sort_by': '-total_value',
+        })
+    assert response.status_code == 200
+    totals = [order["total_value"] for order in response.json()]
+    assert totals == sorted(totals, reverse=True)
+
+def test_get_orders_fail_06():
+    response = client.get(
+        "/orders",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'sort_by': 'client_name',
+        })
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Ordenação inválida"
+
+
+def test_stream_orders_fail_01():
+    response = client.get(
+        "/orders/stream",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'order_status': "aaaa",
+        })
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Status não localizado, por favor redefina o filtro"
+
+def test_stream_orders_fail_02():
+    response = client.get(
+        "/orders/stream",
+        )
+    assert response.status_code == 401
+
 def test_create_orders_ok_01():
     response = client.post(
         "/orders",
@@ -198,6 +248,143 @@ def test_create_orders_ok_01():
     assert response.status_code == 200
     assert response.json()["message"] == "Ordem criada com sucesso"
 
+def test_create_orders_ok_02():
+    product = Product(id = 3)
+    initial_stock = product.stock
+    idempotency_key = f"test-create-orders-{datetime.now().timestamp()}"
+    request = {
+        "client_id": 10,
+        "products": [
+            {
+                "product_id": 3,
+                "quantity": 2
+            }
+        ]
+    }
+    first_response = client.post(
+        "/orders",
+        headers={"Authorization": f"Bearer {operator}", "Idempotency-Key": idempotency_key},
+        json=request)
+    second_response = client.post(
+        "/orders",
+        headers={"Authorization": f"Bearer {operator}", "Idempotency-Key": idempotency_key},
+        json=request)
+    assert first_response.status_code == 200
+    assert second_response.status_code == 200
+    assert second_response.json() == first_response.json()
+    assert second_response.headers['Idempotent-Replayed'] == 'true'
+    assert Product(id = 3).stock == initial_stock - 2
+
+def test_create_orders_fail_05():
+    idempotency_key = f"test-create-orders-{datetime.now().timestamp()}"
+    first_response = client.post(
+        "/orders",
+        headers={"Authorization": f"Bearer {operator}", "Idempotency-Key": idempotency_key},
+        json={
+            "client_id": 10,
+            "products": [
+                {
+                    "product_id": 3,
+                    "quantity": 1
+                }
+            ]
+        })
+    second_response = client.post(
+        "/orders",
+        headers={"Authorization": f"Bearer {operator}", "Idempotency-Key": idempotency_key},
+        json={
+            "client_id": 10,
+            "products": [
+                {
+                    "product_id": 3,
+                    "quantity": 5
+                }
+            ]
+        })
+    assert first_response.status_code == 200
+    assert second_response.status_code == 422
+    assert second_response.json()["detail"] == "Idempotency-Key já utilizada em outra requisição"
+
+def test_create_orders_ok_03():
+    response = client.post(
+        "/orders",
+        headers={"Authorization": f"Bearer {operator}", "Prefer": "respond-async"},
+        json={
+            "client_id": 10,
+            "products": [
+                {
+                    "product_id": 4,
+                    "quantity": 1
+                }
+            ]
+        })
+    assert response.status_code == 202
+    tracking_id = response.json()["tracking_id"]
+    process_batch()
+    intake_response = client.get(
+        f"/orders/intake/{tracking_id}",
+        headers={"Authorization": f"Bearer {operator}"},
+        )
+    assert intake_response.status_code == 200
+    assert intake_response.json()["status"] == "processada"
+    order = Order(id = intake_response.json()["order_id"])
+    assert order.client_id == 10
+
+def test_create_orders_fail_06():
+    response = client.post(
+        "/orders",
+        headers={"Authorization": f"Bearer {operator}", "Prefer": "respond-async"},
+        json={
+            "client_id": 10,
+            "products": [
+                {
+                    "product_id": 4,
+                    "quantity": 30000
+                }
+            ]
+        })
+    assert response.status_code == 202
+    tracking_id = response.json()["tracking_id"]
+    process_batch()
+    intake_response = client.get(
+        f"/orders/intake/{tracking_id}",
+        headers={"Authorization": f"Bearer {operator}"},
+        )
+    assert intake_response.json()["status"] == "rejeitada"
+    assert intake_response.json()["error"]["message"] == "Um ou mais produtos não possui estoque sucifiente"
+
+def test_create_orders_fail_07():
+    response = client.post(
+        "/orders",
+        headers={"Authorization": f"Bearer {operator}", "Prefer": "respond-async"},
+        json={
+            "client_id": 10,
+            "products": [
+                {
+                    "product_id": 4,
+                    "quantity": 40000
+                }
+            ]
+        })
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Quantidade inválida"
+
+def test_create_orders_fail_08():
+    # An entry failing unexpectedly is rejected alone, instead of rolling back its batch and holding the queue
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    try:
+        bad_id = enqueue(db_cursor, 'test_op', 10, [{'product_id': 4, 'quantity': 'x'}])
+        good_id = enqueue(db_cursor, 'test_op', 10, [{'product_id': 4, 'quantity': 1}])
+        db_connection.commit()
+        process_batch()
+        assert get_intake(db_cursor, bad_id)['status'] == "rejeitada"
+        assert get_intake(db_cursor, bad_id)['error']['message'] == "Não foi possível criar a ordem"
+        assert get_intake(db_cursor, good_id)['status'] == "processada"
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
 def test_create_orders_fail_01():
     response = client.post(
         "/orders",
@@ -287,6 +474,16 @@ def test_get_order_ok_02():
     assert response.json()['id'] == 2
     assert response.json()['client_id'] == 12
 
+def test_get_order_ok_03():
+    response = client.get(
+        "/orders/2",
+        headers={"Authorization": f"Bearer {operator}"},
+        )
+    assert response.status_code == 200
+    order = response.json()
+    assert order['item_count'] == sum(product['quantity'] for product in order['products'].values())
+    assert round(order['total_value'], 2) == round(sum(product['quantity'] * product['unit_price'] for product in order['products'].values()), 2)
+
 def test_get_order_fail_01():
     response = client.get(
         "/orders/-1",
@@ -362,4 +559,44 @@ def test_delete_order_fail_02():
         "/orders/-1",
         headers={"Authorization": f"Bearer {admin}"},
     )
-    assert response.status_code == 204
\ No newline at end of file
+    assert response.status_code == 204
+def test_update_order_fail_01():
+    # A rejected change leaves the leaderboard as it was
+    create_response = client.post(
+        "/orders",
+        headers={"Authorization": f"Bearer {admin}"},
+        json={
+            "client_id": 10,
+            "products": [
+                {
+                    "product_id": 2,
+                    "quantity": 1
+                }
+            ]
+        })
+    assert create_response.status_code == 200
+    id = create_response.json()['id']
+    since = datetime.fromtimestamp(0)
+    units = dict(leaderboard.board.top(1000, since)).get(2, 0)
+    response = client.put(
+        f"/orders/{id}",
+        headers={"Authorization": f"Bearer {operator}"},
+        json={
+            "products_to_include": [
+                {
+                    "product_id": 2,
+                    "quantity": 1
+                },
+                {
+                    "product_id": 99999999,
+                    "quantity": 1
+                }
+            ]
+        })
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Um ou mais produto não foi localizado"
+    assert dict(leaderboard.board.top(1000, since)).get(2, 0) == units
+    client.delete(
+        f"/orders/{id}",
+        headers={"Authorization": f"Bearer {admin}"},
+    )
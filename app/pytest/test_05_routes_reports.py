@@ -0,0 +1,122 @@
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from datetime import datetime
+
+from ..main import app
+from ..utils import *
+from ..db_classes import *
+from .tokens import admin, operator
+
+client = TestClient(app)
+
+def test_refresh_reports_ok_01():
+    response = client.post(
+        "/reports/refresh",
+        headers={"Authorization": f"Bearer {admin}"},)
+    assert response.status_code == 200
+    assert response.json()['message'] == "Relatórios atualizados com sucesso"
+
+def test_refresh_reports_fail_01():
+    response = client.post(
+        "/reports/refresh",
+        headers={"Authorization": f"Bearer {operator}"},)
+    assert response.status_code == 403
+    assert response.json()['detail'] == "Apenas Admins podem atualizar relatórios"
+
+def test_get_daily_sales_ok_01():
+    client.post("/reports/refresh", headers={"Authorization": f"Bearer {admin}"},)
+    response = client.get(
+        "/reports/sales/daily",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'start_date': "01/04/2025",
+            'end_date': "30/04/2025",
+        })
+    assert response.status_code == 200
+    assert len(response.json()) > 0
+    assert all(day["day"][:7] == "2025-04" for day in response.json())
+
+def test_get_sales_by_section_ok_01():
+    client.post("/reports/refresh", headers={"Authorization": f"Bearer {admin}"},)
+    response = client.get(
+        "/reports/sales/sections",
+        headers={"Authorization": f"Bearer {operator}"},)
+    assert response.status_code == 200
+    revenues = [section["revenue"] for section in response.json()]
+    assert revenues == sorted(revenues, reverse=True)
+
+def test_get_sales_by_product_ok_01():
+    response = client.get(
+        "/reports/sales/products",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'limit': 5,
+        })
+    assert response.status_code == 200
+    assert len(response.json()) <= 5
+
+def test_get_sales_by_client_ok_01():
+    response = client.get(
+        "/reports/sales/clients",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'client_id': 12,
+        })
+    assert response.status_code == 200
+    assert all(entry["client_id"] == 12 for entry in response.json())
+
+def test_get_daily_sales_fail_01():
+    response = client.get(
+        "/reports/sales/daily",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'start_date': "31/02/2025",
+        })
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Data de início inválida"
+
+def test_get_sales_by_product_fail_01():
+    response = client.get(
+        "/reports/sales/products",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'section': "aaaa",
+        })
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Categoria não localizada, por favor redefina o filtro"
+
+def test_get_top_products_ok_01():
+    create_response = client.post(
+        "/orders",
+        headers={"Authorization": f"Bearer {operator}"},
+        json={
+            "client_id": 10,
+            "products": [
+                {
+                    "product_id": 2,
+                    "quantity": 1
+                }
+            ]
+        })
+    assert create_response.status_code == 200
+    response = client.get(
+        "/reports/top-products",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'window': 'today',
+        })
+    assert response.status_code == 200
+    assert any(product["product_id"] == 2 for product in response.json())
+    units = [product["units"] for product in response.json()]
+    assert units == sorted(units, reverse=True)
+
+def test_get_top_products_fail_01():
+    response = client.get(
+        "/reports/top-products",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'window': 'year',
+        })
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Janela inválida"
@@ -0,0 +1,61 @@
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from datetime import datetime
+
+from ..main import app
+from ..utils import *
+from ..db_classes import *
+from .tokens import admin, operator
+
+client = TestClient(app)
+
+def test_autocomplete_ok_01():
+    response = client.get(
+        "/search/autocomplete",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'q': 'Vicente'
+        })
+    assert response.status_code == 200
+    assert {'id': 14, 'label': 'Vicente Cameron'} in response.json()
+
+def test_autocomplete_ok_02():
+    response = client.get(
+        "/search/autocomplete",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'q': '789100000003',
+            'scope': 'products'
+        })
+    assert response.status_code == 200
+    assert response.json() == [{'id': 3, 'label': 'Feijão Carioca'}]
+
+def test_autocomplete_fail_01():
+    response = client.get(
+        "/search/autocomplete",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'q': 'V'
+        })
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Termo de busca muito curto'
+
+def test_autocomplete_fail_02():
+    response = client.get(
+        "/search/autocomplete",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'q': 'Vicente',
+            'scope': 'orders'
+        })
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Escopo de busca inválido'
+
+def test_autocomplete_fail_03():
+    response = client.get(
+        "/search/autocomplete",
+        params={
+            'q': 'Vicente'
+        })
+    assert response.status_code == 401
@@ -0,0 +1,65 @@
+import json
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from datetime import datetime
+
+from ..main import app
+from ..utils import *
+from ..db_classes import *
+from .tokens import admin, operator
+
+client = TestClient(app)
+
+def test_export_orders_ok_01():
+    response = client.get(
+        "/export/orders",
+        headers={"Authorization": f"Bearer {operator}"},)
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/csv')
+    lines = response.text.splitlines()
+    assert lines[0] == 'id,created_at,status,client_id,client_name,item_count,total_value,updated_at'
+    assert len(lines) > 20
+
+def test_export_orders_fail_01():
+    response = client.get(
+        "/export/orders",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'start_date': '31/31/2025'
+        })
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Data de início inválida'
+
+def test_export_products_ok_01():
+    response = client.get(
+        "/export/products",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'format': 'ndjson',
+            'q': '789100000003'
+        })
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert rows[0]['id'] == 3
+    assert rows[0]['section_name'] == 'Marcearia'
+
+def test_export_clients_ok_01():
+    response = client.get(
+        "/export/clients",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'filter': 'vicente.cameron'
+        })
+    assert response.status_code == 200
+    assert response.text.splitlines()[1] == '14,Vicente Cameron,vicente.cameron@gmail.com,11860140084'
+
+def test_export_clients_fail_01():
+    response = client.get(
+        "/export/clients",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'format': 'xlsx'
+        })
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Formato inválido'
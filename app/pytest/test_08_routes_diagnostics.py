@@ -0,0 +1,91 @@
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from datetime import datetime
+
+from ..main import app
+from ..utils import *
+from ..db_classes import *
+from .tokens import admin, operator
+
+client = TestClient(app)
+
+def test_profile_signature_ok_01():
+    response = client.get(
+        "/diagnostics/profile-signature",
+        headers={"Authorization": f"Bearer {admin}"},
+        params={
+            'path': '/products'
+        })
+    assert response.status_code == 200
+    assert response.json()['header'] == 'X-Profile'
+    response = client.get(
+        "/products",
+        headers={
+            "Authorization": f"Bearer {operator}",
+            "X-Profile": response.json()['value'],
+            "X-Profile-Output": "collapsed"
+        })
+    assert response.status_code == 200
+    assert response.headers['X-Profile-Status'] == '200'
+    assert response.headers['content-type'].startswith('text/plain')
+
+def test_profile_signature_ok_02():
+    response = client.get(
+        "/diagnostics/profile-signature",
+        headers={"Authorization": f"Bearer {admin}"},
+        params={
+            'path': '/products'
+        })
+    response = client.get(
+        "/products",
+        headers={
+            "Authorization": f"Bearer {operator}",
+            "X-Profile": response.json()['value']
+        })
+    assert response.status_code == 200
+    assert response.headers['X-Profile-File'].endswith('.svg')
+    assert len(response.json()) > 0
+
+def test_profile_signature_fail_01():
+    response = client.get(
+        "/diagnostics/profile-signature",
+        headers={"Authorization": f"Bearer {operator}"},
+        params={
+            'path': '/products'
+        })
+    assert response.status_code == 403
+    assert response.json()['detail'] == 'Apenas Admins podem fazer profiling'
+
+def test_profile_signature_fail_02():
+    response = client.get(
+        "/diagnostics/profile-signature",
+        headers={"Authorization": f"Bearer {admin}"},
+        params={
+            'path': '/orders'
+        })
+    response = client.get(
+        "/products",
+        headers={
+            "Authorization": f"Bearer {operator}",
+            "X-Profile": response.json()['value']
+        })
+    assert response.status_code == 403
+    assert response.json()['detail'] == 'Assinatura de profiling inválida'
+
+def test_slow_queries_ok_01():
+    response = client.get(
+        "/diagnostics/slow-queries",
+        headers={"Authorization": f"Bearer {admin}"},
+        params={
+            'limit': 5
+        })
+    assert response.status_code == 200
+    assert len(response.json()) <= 5
+
+def test_slow_queries_fail_01():
+    response = client.get(
+        "/diagnostics/slow-queries",
+        headers={"Authorization": f"Bearer {operator}"})
+    assert response.status_code == 403
+    assert response.json()['detail'] == 'Apenas Admins podem ver consultas lentas'
@@ -0,0 +1,26 @@
+import pytest
+
+from ..benchmarks.plans import ROUTES, compare, explain_route, load_snapshot
+from .. import db_operations
+
+# Plans depend on the data, so they are only compared on the large dataset of benchmarks/dataset.py:
+# python -m pytest --budget-dataset large
+
+def test_query_plans_ok_01(pytestconfig):
+    if pytestconfig.getoption('budget_dataset') != 'large':
+        pytest.skip("Query plans are only compared on the large dataset")
+    snapshots = {route: load_snapshot(route) for route in ROUTES}
+    missing = [route for route, snapshot in snapshots.items() if snapshot == None]
+    if len(missing) > 0:
+        pytest.fail(f"No plan snapshot for {', '.join(missing)}, save them with python -m benchmarks.plans --update")
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    degradations = []
+    try:
+        for route, snapshot in snapshots.items():
+            degradations += compare(snapshot, explain_route(db_cursor, route))[0]
+    finally:
+        db_connection.rollback()
+        db_cursor.close()
+        db_connection.close()
+    assert degradations == []
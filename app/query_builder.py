@@ -0,0 +1,34 @@
+from functools import lru_cache
+
+# Statements with optional clauses are built from templates and the clauses in use. Each combination is built once and
+# cached, so requests only pick the statement and its args: the text of a statement is always the same for the same
+# filters, as prepared statements and the plan cache of Postgres need.
+# Values always go in args with %s placeholders, never in the text, or every value would make a new statement.
+
+@lru_cache(maxsize=None)
+def statement(template: str, **parts) -> str:
+    '''Fills the {fields} of a template with parts and collapses its whitespace into single spaces.
+    Templates must not have string literals with repeated whitespace.
+
+        Example:
+            statement("SELECT id FROM clients {where} LIMIT 20", where="WHERE id = %s")
+            -> "SELECT id FROM clients WHERE id = %s LIMIT 20"
+    '''
+    return ' '.join(template.format(**parts).split())
+
+@lru_cache(maxsize=None)
+def where(conditions: tuple) -> str:
+    '''Returns a WHERE clause joining the conditions with AND, '' without conditions.
+    '''
+    if len(conditions) == 0:
+        return ''
+    return "WHERE " + " AND ".join(conditions)
+
+@lru_cache(maxsize=None)
+def update(table: str, columns: tuple, key: str = 'id') -> str:
+    '''Returns an UPDATE of the columns of the row with the key, taking the new values then the key as args.
+
+        Example:
+            update('clients', ('name', 'email')) -> "UPDATE clients SET name = %s, email = %s WHERE id = %s"
+    '''
+    return f"UPDATE {table} SET " + ", ".join(f"{column} = %s" for column in columns) + f" WHERE {key} = %s"
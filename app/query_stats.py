@@ -0,0 +1,107 @@
+import logging
+import re
+import time
+from contextvars import ContextVar
+
+from starlette.middleware.base import BaseHTTPMiddleware
+
+import db_operations
+
+# A request running the same statement shape more times than this is reported as a probable N+1
+N_PLUS_ONE_THRESHOLD = 10
+
+logger = logging.getLogger(__name__)
+
+# Statistics of the request being handled, if any. Shared with the threads the request starts, so their statements count too.
+current = ContextVar('query_stats', default=None)
+# Called after each request with (method, route template, RequestStats, duration in seconds), see pytest/conftest.py
+listeners = []
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLACEHOLDER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+VALUES_LIST = re.compile(r"\(\?\)(?:\s*,\s*\(\?\))+")
+WHITESPACE = re.compile(r"\s+")
+
+def normalize(query: str) -> str:
+    '''Returns the shape of a statement: literals and placeholders become ?, lists of them collapse into one and whitespace is squeezed.
+    Statements differing only by their values have the same shape.
+    '''
+    shape = STRING_LITERAL.sub('?', query)
+    shape = shape.replace('%s', '?')
+    shape = NUMBER_LITERAL.sub('?', shape)
+    shape = PLACEHOLDER_LIST.sub('?', shape)
+    shape = VALUES_LIST.sub('(?)', shape)
+    return WHITESPACE.sub(' ', shape).strip()
+
+class StatementStats():
+    def __init__(self, caller: str):
+        self.count = 0
+        self.duration = 0.0
+        self.rows = 0
+        # First place running the statement, enough to find a loop
+        self.caller = caller
+
+class RequestStats():
+    '''
+    Statements run while handling a request, aggregated by shape.
+    '''
+    def __init__(self):
+        self.statements = {}
+        self.count = 0
+        self.duration = 0.0
+
+    def add(self, query: str, duration: float, rowcount: int, caller: str):
+        shape = normalize(query)
+        statement = self.statements.get(shape)
+        if statement == None:
+            statement = self.statements[shape] = StatementStats(caller)
+        statement.count += 1
+        statement.duration += duration
+        statement.rows += max(rowcount, 0)
+        self.count += 1
+        self.duration += duration
+
+    def get_repeated(self, threshold: int = N_PLUS_ONE_THRESHOLD) -> list:
+        '''Returns (shape, StatementStats) of the statements run more than threshold times, most repeated first.
+        '''
+        repeated = [(shape, statement) for shape, statement in self.statements.items() if statement.count > threshold]
+        return sorted(repeated, key=lambda item: item[1].count, reverse=True)
+
+def record(query: str, args, duration: float, rowcount: int, caller: str):
+    stats = current.get()
+    if stats != None:
+        stats.add(query, duration, rowcount, caller)
+
+class QueryStatsMiddleware(BaseHTTPMiddleware):
+    '''
+    Counts the statements of each request, reporting them in the Server-Timing header and logging probable N+1 queries.
+    '''
+    def __init__(self, app):
+        super().__init__(app)
+        if record not in db_operations.hooks:
+            db_operations.hooks.append(record)
+
+    async def dispatch(self, request, call_next):
+        stats = RequestStats()
+        token = current.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            current.reset(token)
+        total = time.perf_counter() - start
+        response.headers.append('Server-Timing',
+            f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries", app;dur={total * 1000:.2f}')
+        route = request.scope.get('route')
+        path = route.path if route != None else request.url.path
+        for listener in listeners:
+            listener(request.method, path, stats, total)
+        for shape, statement in stats.get_repeated():
+            logger.warning("Probable N+1 in %s %s: %d runs (%.2f ms) of %s, first from %s",
+                request.method, path, statement.count, statement.duration * 1000, shape, statement.caller)
+        if logger.isEnabledFor(logging.DEBUG):
+            for shape, statement in sorted(stats.statements.items(), key=lambda item: item[1].duration, reverse=True):
+                logger.debug("%s %s: %d runs, %.2f ms, %d rows, %s (%s)",
+                    request.method, path, statement.count, statement.duration * 1000, statement.rows, shape, statement.caller)
+        return response
@@ -1,20 +1,57 @@
 from fastapi import APIRouter
 from typing import Annotated, Optional
-import re
 
-from fastapi import Depends, HTTPException, status, Query
+from fastapi import Depends, HTTPException, status, Query, Request
+from psycopg2.errors import UniqueViolation
 
+import bulk_import
 import db_operations
+import query_builder
+import sales_rollups
+import text_search
 import utils
 
 from base_models import User, NewClient, UpdateClient
-from db_classes import ObjectNotFound, Client, admin_role_id
+from db_classes import ObjectNotFound, Client, CLIENT_COLUMNS, admin_role_id
 
 router = APIRouter()
 
+# Error messages by violated unique constraint
+CREATE_CONFLICTS = {
+    'clients_cpf_key': "CPF já existe",
+    'clients_email_key': "Email já existe",
+}
+UPDATE_CONFLICTS = {
+    'clients_cpf_key': "CPF já existe",
+    'clients_email_key': "E-mail já existe",
+}
+# Columns read from each row of post(/clients:bulk)
+BULK_COLUMNS = ('name', 'email', 'cpf')
+# Page of get(/clients), with the WHERE clause of get_client_filters and the sort
+CLIENTS_QUERY = f"SELECT {CLIENT_COLUMNS} FROM clients {{filters}} ORDER BY {{order}} LIMIT 20 OFFSET %s"
+
 # CLIENTS ROUTES ------------------------------------------------------------------------------------------------
 
 
+def get_client_filters(filter: str | None) -> tuple:
+    '''Builds the WHERE clause shared by get(/clients) and get(/export/clients). Returns the clause ('' without filter) and its args.
+    '''
+    if filter == None or filter == '':
+        return '', []
+    pattern = text_search.like_pattern(filter)
+    return "WHERE name ILIKE %s OR email ILIKE %s", [pattern, pattern]
+
+def get_clients_query(offset: int = 0, filter: str | None = None) -> tuple:
+    '''Builds the query of get(/clients), selecting a page of clients. Returns the query and its args.
+    '''
+    filters, args = get_client_filters(filter)
+    order = 'id'
+    if filter != None and filter != '':
+        order = text_search.CLIENT_RANK
+        args += [filter.lower(), filter.lower()]
+    args.append(offset)
+    return query_builder.statement(CLIENTS_QUERY, filters=filters, order=order), args
+
 @router.get("/clients")
 async def get_clients(
     current_user: Annotated[User, Depends(utils.get_current_active_user)],
@@ -25,7 +62,7 @@ async def get_clients(
     Returns client list, limit of 20 entries.
     
         offset: (int, optional, default = 0) Sets the offset for the resulting list.
-        filter: (str, optional, default = None) Filter results by name and email using the specified keyword.
+        filter: (str, optional, default = None) Filter results by name and email using the specified keyword. Best matches come first.
 
         Example parameters:
             offset: 10
@@ -47,25 +84,14 @@ async def get_clients(
                 }
             ]
     '''
-    additional_string = ''
-    if filter != None and filter != '':
-        filter = '%'+filter.lower()+'%'
-        additional_string = "WHERE name ILIKE %s OR email ILIKE %s"
-        args = (filter, filter, offset,)
-    else:
-        args = (offset,)
-    query = f"""SELECT id FROM clients {additional_string} LIMIT 20 OFFSET %s"""
+    query, args = get_clients_query(offset, filter)
     try:
         db_connection = db_operations.postgres_connection();
         db_cursor = db_connection.cursor()
         result_raw = db_operations.select(db_cursor, query, args)
         if len(result_raw) == 0:
             raise HTTPException(status_code=status.HTTP_204_NO_CONTENT)
-        result = []
-        for entry in result_raw:
-            client = Client(db_cursor, entry[0])
-            result.append(client.get_info())
-        return result
+        return [client.get_info() for client in Client.from_rows(db_cursor, result_raw)]
     except:
         raise
     finally:
@@ -81,6 +107,8 @@ async def create_client(
     
     All three request values are required. Email and CPF must be valid and unique.
 
+    Send an optional Idempotency-Key header to retry safely: a request repeated with the same key within 24 hours returns the recorded response instead of running again.
+
         name (str): Client's name.
         email (str): Client's email (must be valid and unique).
         cpf (str): Client's cpf (numbers only, must be valid and unique).
@@ -104,27 +132,115 @@ async def create_client(
         raise HTTPException(status_code=400, detail= "CPF inválido")
     if not utils.validate_email(new_client.email):
         raise HTTPException(status_code=400, detail= "E-mail inválido")
+    query = """
+        INSERT INTO clients (name, email, cpf)
+        VALUES (%s, %s, %s)
+    """
+    args = (new_client.name, new_client.email, new_client.cpf,)
     try:
-        utils.get_client(new_client.cpf)
-        raise HTTPException(status_code=400, detail= "CPF já existe")
-    except ObjectNotFound:
-        pass
-    try: 
-        utils.get_client(new_client.email)
-        raise HTTPException(status_code=400, detail= "Email já existe")
-    except ObjectNotFound:
-        query = """
-            INSERT INTO clients (name, email, cpf)
-            VALUES (%s, %s, %s)
-        """
-        args = (new_client.name, new_client.email, new_client.cpf,)
         db_connection = db_operations.postgres_connection();
         db_cursor = db_connection.cursor()
-        result = db_operations.insert(db_cursor, query, args, 'id')
+        # The unique constraints check CPF and email in the same statement, without a lookup before
+        try:
+            result = db_operations.insert(db_cursor, query, args, 'id')
+        except UniqueViolation as error:
+            db_connection.rollback()
+            raise HTTPException(status_code=400, detail= CREATE_CONFLICTS.get(error.diag.constraint_name, "Cliente já existe"))
         db_connection.commit()
+    finally:
         db_cursor.close()
         db_connection.close()
-        return {"message": "Cliente cadastrado com sucesso", "id": result}
+    return {"message": "Cliente cadastrado com sucesso", "id": result}
+
+@router.post("/clients:bulk")
+async def create_clients_bulk(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    request: Request
+):
+    """ Registers many clients from a CSV (Content-Type: text/csv) or NDJSON (Content-Type: application/x-ndjson) body.
+
+    The body is read as it arrives, so files with tens of thousands of clients can be sent at once.
+    CSV files need a header with the columns name, email and cpf. NDJSON files need one object per line with those keys.
+
+    Rows are validated like in post(/clients). Valid rows are registered and invalid ones are reported with their row number
+    (counting from 1, not counting the header). Rows repeating a CPF or email, of the file or already registered, are rejected.
+
+        Example request (CSV):
+            name,email,cpf
+            Anna Kendrick,my_only_email@me.com,12345678909
+
+        Example return:
+            {
+                "message": "Importação de clientes concluída",
+                "received": 3,
+                "inserted": 2,
+                "rejected": 1,
+                "errors": [
+                    {
+                        "row": 2,
+                        "detail": "CPF inválido"
+                    }
+                ]
+            }
+    """
+    format = bulk_import.get_format(request.headers.get('content-type'))
+    if format == None:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail= "Formato não suportado, envie CSV ou NDJSON")
+    report = bulk_import.Report()
+    try:
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
+        db_operations.insert(db_cursor,
+            "CREATE TEMP TABLE clients_import (file_row INT NOT NULL, name VARCHAR(50), email VARCHAR(50), cpf CHAR(11)) ON COMMIT DROP", ())
+        try:
+            async for batch in bulk_import.iter_batches(request, format, BULK_COLUMNS):
+                report.received += len(batch)
+                records = [(row, record) for row, record in batch if record != None]
+                for row, record in batch:
+                    if record == None:
+                        report.reject(row, "Linha inválida")
+                valid_cpfs = utils.validate_cpfs([record['cpf'] for _, record in records])
+                valid_emails = utils.validate_emails([record['email'] for _, record in records])
+                rows = []
+                for (row, record), valid_cpf, valid_email in zip(records, valid_cpfs, valid_emails):
+                    if type(record['name']) != str or len(record['name']) < 1:
+                        report.reject(row, "Nome não pode ser vazio")
+                    elif len(record['name']) > 50:
+                        report.reject(row, "Nome inválido")
+                    elif not valid_cpf:
+                        report.reject(row, "CPF inválido")
+                    elif not valid_email or len(record['email']) > 50:
+                        report.reject(row, "E-mail inválido")
+                    else:
+                        rows.append((row, record['name'], record['email'], record['cpf']))
+                bulk_import.copy_rows(db_cursor, 'clients_import', ('file_row',) + BULK_COLUMNS, rows)
+        except bulk_import.InvalidFile:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Arquivo inválido, verifique a codificação (UTF-8) e o cabeçalho")
+        # Rows are inserted in file order, so the first of repeated CPFs or emails is the one kept
+        inserted = db_operations.select(db_cursor,
+            """
+            WITH inserted AS (
+                INSERT INTO clients (name, email, cpf)
+                SELECT name, email, cpf FROM clients_import ORDER BY file_row
+                ON CONFLICT DO NOTHING
+                RETURNING email, cpf
+            )
+            SELECT MIN(s.file_row) FROM inserted i JOIN clients_import s ON s.cpf = i.cpf AND s.email = i.email GROUP BY i.cpf
+            """, ())
+        inserted_rows = [row[0] for row in inserted]
+        conflicts = db_operations.select(db_cursor,
+            """
+            SELECT s.file_row, EXISTS (SELECT 1 FROM clients c WHERE c.cpf = s.cpf)
+            FROM clients_import s
+            WHERE NOT s.file_row = ANY(%s)
+            """, (inserted_rows,))
+        for row, cpf_exists in conflicts:
+            report.reject(row, "CPF já existe" if cpf_exists else "Email já existe")
+        db_connection.commit()
+    finally:
+        db_cursor.close()
+        db_connection.close()
+    return {"message": "Importação de clientes concluída", "inserted": len(inserted_rows), **report.get_info()}
 
 @router.get("/clients/{id}")
 async def get_client_by_id(
@@ -205,38 +321,30 @@ async def put_client(
         except ObjectNotFound:
             raise HTTPException(status_code=status.HTTP_204_NO_CONTENT)
         
+        columns = []
         values = []
-        name_field = ''
-        cpf_field = ''
-        email_field = ''
         if new_information.name != None:
             if new_information.name == '':
                 raise HTTPException(status_code=400, detail= "Nome inválido")
-            name_field = 'name = %s,'
+            columns.append('name')
             values.append(new_information.name)
         if new_information.cpf != None:
             if not utils.validate_cpf(new_information.cpf):
                 raise HTTPException(status_code=400, detail= "CPF inválido")
-            try:
-                utils.get_client(new_information.cpf)
-                raise HTTPException(status_code=400, detail= "CPF já existe")
-            except ObjectNotFound:
-                cpf_field = 'cpf = %s,'
-                values.append(new_information.cpf)
+            columns.append('cpf')
+            values.append(new_information.cpf)
         if new_information.email != None:
             if not utils.validate_email(new_information.email):
                 raise HTTPException(status_code=400, detail= "E-mail inválido")
-            try:
-                utils.get_client(new_information.email)
-                raise HTTPException(status_code=400, detail= "E-mail já existe")
-            except ObjectNotFound:
-                email_field = 'email = %s,'
-                values.append(new_information.email)
-        query = f"""UPDATE clients SET {name_field} {cpf_field} {email_field} where id = %s """
-        query = re.sub(' +', ' ', query)
-        query = query.replace(", where", " where")
+            columns.append('email')
+            values.append(new_information.email)
+        query = query_builder.update('clients', tuple(columns))
         values.append(id)
-        result = db_operations.insert(db_cursor, query, values, "id")
+        try:
+            result = db_operations.insert(db_cursor, query, values, "id")
+        except UniqueViolation as error:
+            db_connection.rollback()
+            raise HTTPException(status_code=400, detail= UPDATE_CONFLICTS.get(error.diag.constraint_name, "Cliente já existe"))
         updated_client = Client(db_cursor, id = result)
         if updated_client.get_info() == client.get_info():
             raise
@@ -280,6 +388,7 @@ async def delete_client(
             client = Client(db_cursor, id = id)
         except ObjectNotFound:
             raise HTTPException(status_code=status.HTTP_204_NO_CONTENT)
+        sales_rollups.mark_dirty_days(db_cursor, "SELECT day FROM sales_daily_clients WHERE client_id = %s", (id,))
         query = """
             DELETE FROM clients WHERE id = %s
         """
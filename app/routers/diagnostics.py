@@ -0,0 +1,85 @@
+from fastapi import APIRouter
+from datetime import datetime, timezone
+from typing import Annotated, Optional
+
+from fastapi import Depends, HTTPException, status, Query
+
+import profiler
+import slow_queries
+import utils
+
+from base_models import User
+from db_classes import admin_role_id
+
+router = APIRouter()
+
+# DIAGNOSTICS ROUTES ------------------------------------------------------------------------------------------------
+
+@router.get("/diagnostics/profile-signature")
+async def get_profile_signature(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    path: str = Query(...),
+    method: Optional[str] = Query('GET')
+):
+    '''Returns the header that makes a request to the route be profiled, for finding slow spots of a route with real data.
+    Only Admins can request it.
+
+    Send the header in the request to profile, with "X-Profile-Output" set to:
+        "file" (default): the response is unchanged and the profile is saved on the server, in the path of the "X-Profile-File" header.
+        "collapsed": the response is replaced by the collapsed stacks (the format read by flamegraph.pl and speedscope).
+        "svg": the response is replaced by a flame graph.
+
+        path (str): Path of the request to profile, without the query string, e.g. "/products".
+        method (str, default = "GET"): HTTP method of the request to profile.
+
+        Example return:
+            {
+                "header": "X-Profile",
+                "value": "1718804220:3f1c...",
+                "expires_at": "2024-06-19T13:37:00+00:00"
+            }
+    '''
+    if current_user.role > admin_role_id:
+        raise HTTPException(status_code=403, detail= "Apenas Admins podem fazer profiling")
+    if not path.startswith('/') or '?' in path:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Caminho inválido")
+    value = profiler.create_signature(method, path)
+    return {
+        "header": profiler.HEADER,
+        "value": value,
+        "expires_at": datetime.fromtimestamp(int(value.split(':')[0]), timezone.utc).isoformat()
+    }
+
+@router.get("/diagnostics/slow-queries")
+async def get_slow_queries(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    limit: Optional[int] = Query(20, ge=1, le=slow_queries.BUFFER_SIZE),
+    min_duration_ms: Optional[float] = Query(0, ge=0)
+):
+    '''Returns the latest statements slower than 200 ms run by this worker process, most recent first, with their parameters and plan.
+
+    Read only statements are explained with EXPLAIN (ANALYZE, BUFFERS), running them again; the others are only planned.
+    The plan is captured in the background and is null until ready. Statements of the same shape are explained once a minute at most.
+    Only Admins can see them.
+
+        limit (int, default = 20): Number of statements to return.
+        min_duration_ms (float, default = 0): Only statements taking at least this long.
+
+        Example return:
+            [
+                {
+                    "id": 3,
+                    "query": "SELECT o.id, o.created_at, ... WHERE o.created_at >= %s ...",
+                    "params": ["2024-01-01", "2024-06-30"],
+                    "duration_ms": 412.37,
+                    "rows": 20,
+                    "caller": "orders.py:151 get_orders",
+                    "recorded_at": "2024-06-19T13:27:00.512000+00:00",
+                    "analyzed": true,
+                    "plan": "Limit  (cost=1021.33..1021.38 rows=20 width=64) (actual time=410.2..410.3 rows=20 loops=1) ..."
+                }
+            ]
+    '''
+    if current_user.role > admin_role_id:
+        raise HTTPException(status_code=403, detail= "Apenas Admins podem ver consultas lentas")
+    return slow_queries.get_entries(limit, min_duration_ms / 1000)
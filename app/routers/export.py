@@ -0,0 +1,169 @@
+from fastapi import APIRouter
+from typing import Annotated, Optional
+
+from fastapi import Depends, HTTPException, status, Query
+from fastapi.responses import StreamingResponse
+
+import db_operations
+import exporter
+import query_builder
+import utils
+
+from base_models import User
+from db_classes import PRODUCT_STOCK
+from routers.clients import get_client_filters
+from routers.orders import get_order_filters
+from routers.products import get_product_filters
+
+router = APIRouter()
+
+# EXPORT ROUTES ------------------------------------------------------------------------------------------------
+
+ORDER_COLUMNS = [
+    ('id', 'int'),
+    ('created_at', 'timestamp'),
+    ('status', 'string'),
+    ('client_id', 'int'),
+    ('client_name', 'string'),
+    ('item_count', 'int'),
+    ('total_value', 'float'),
+    ('updated_at', 'timestamp'),
+]
+PRODUCT_COLUMNS = [
+    ('id', 'int'),
+    ('description', 'string'),
+    ('sell_value', 'float'),
+    ('barcode', 'string'),
+    ('section_name', 'string'),
+    ('stock', 'int'),
+    ('expiration_date', 'date'),
+]
+CLIENT_COLUMNS = [
+    ('id', 'int'),
+    ('name', 'string'),
+    ('email', 'string'),
+    ('cpf', 'string'),
+]
+
+# Exports with the WHERE clause of the filters of each list route
+ORDERS_QUERY = """
+    SELECT o.id, o.created_at, st.description, o.client_id, c.name, o.item_count, o.total_value, o.updated_at
+    FROM orders o
+    JOIN clients c ON o.client_id = c.id
+    LEFT JOIN order_status st ON o.status = st.id
+    {filters}
+    ORDER BY o.id
+"""
+PRODUCTS_QUERY = f"""
+    SELECT p.id, p.description, p.sell_value, p.barcode, s.name, {PRODUCT_STOCK}, p.expiration_date
+    FROM products p
+    JOIN sections s ON p.section_id = s.id
+    {{filters}}
+    ORDER BY p.id
+"""
+CLIENTS_QUERY = "SELECT id, name, email, cpf FROM clients {filters} ORDER BY id"
+
+def check_format(format: str):
+    '''Raises HTTPException with status 400 if the format is unknown or unavailable.
+    '''
+    if format not in exporter.MEDIA_TYPES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Formato inválido")
+    if not exporter.is_available(format):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Formato parquet indisponível no servidor")
+
+def export_response(db_connection, query: str, args: list, columns: list, format: str, name: str) -> StreamingResponse:
+    return StreamingResponse(
+        exporter.stream(db_connection, query, args, columns, format),
+        media_type=exporter.MEDIA_TYPES[format],
+        headers={'Content-Disposition': f'attachment; filename="{name}.{format}"'}
+    )
+
+@router.get("/export/orders")
+async def export_orders(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    format: Optional[str] = Query('csv'),
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None),
+    section: Optional[str] = Query(None),
+    id: Optional[int] = Query(0, ge=0),
+    order_status: Optional[str] = Query(None),
+    client_id: Optional[int] = Query(0, ge=0),
+    min_total: Optional[float] = Query(None, ge=0),
+    max_total: Optional[float] = Query(None, ge=0)
+):
+    '''Exports every order matching the filters, one row per order, sorted by id.
+    The file is produced while it's downloaded, without paging.
+
+    Accepts the same filters of get(/orders).
+
+        format (str, default = "csv"): "csv", "ndjson" or "parquet".
+
+        Example return (csv):
+            id,created_at,status,client_id,client_name,item_count,total_value,updated_at
+            1,2025-05-25T16:29:13.177126+00:00,Nova,12,Christine Melton,4,35.96,2025-05-25T16:29:13.177126+00:00
+    '''
+    check_format(format)
+    db_connection = db_operations.postgres_connection()
+    try:
+        db_cursor = db_connection.cursor()
+        filters, args = get_order_filters(db_cursor, start_date, end_date, section, id, order_status, client_id, min_total, max_total)
+        db_cursor.close()
+    except:
+        db_connection.close()
+        raise
+    query = query_builder.statement(ORDERS_QUERY, filters=filters)
+    return export_response(db_connection, query, args, ORDER_COLUMNS, format, 'orders')
+
+@router.get("/export/products")
+async def export_products(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    format: Optional[str] = Query('csv'),
+    category: Optional[str] = Query(None),
+    sell_value: Optional[float] = Query(0, ge=0),
+    available: Optional[bool] = Query(False),
+    q: Optional[str] = Query(None)
+):
+    '''Exports every product matching the filters, sorted by id. Images are not exported.
+    The file is produced while it's downloaded, without paging.
+
+    Accepts the same filters of get(/products).
+
+        format (str, default = "csv"): "csv", "ndjson" or "parquet".
+
+        Example return (csv):
+            id,description,sell_value,barcode,section_name,stock,expiration_date
+            3,Feijão Carioca,8.7,789100000003,Marcearia,150,2025-06-12
+    '''
+    check_format(format)
+    db_connection = db_operations.postgres_connection()
+    try:
+        db_cursor = db_connection.cursor()
+        filters, args = get_product_filters(db_cursor, category, sell_value, available, q)
+        db_cursor.close()
+    except:
+        db_connection.close()
+        raise
+    query = query_builder.statement(PRODUCTS_QUERY, filters=filters)
+    return export_response(db_connection, query, args, PRODUCT_COLUMNS, format, 'products')
+
+@router.get("/export/clients")
+async def export_clients(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    format: Optional[str] = Query('csv'),
+    filter: Optional[str] = Query(None)
+):
+    '''Exports every client matching the filter, sorted by id.
+    The file is produced while it's downloaded, without paging.
+
+    Accepts the same filter of get(/clients).
+
+        format (str, default = "csv"): "csv", "ndjson" or "parquet".
+
+        Example return (csv):
+            id,name,email,cpf
+            14,Vicente Cameron,vicente.cameron@gmail.com,11860140084
+    '''
+    check_format(format)
+    filters, args = get_client_filters(filter)
+    query = query_builder.statement(CLIENTS_QUERY, filters=filters)
+    return export_response(db_operations.postgres_connection(), query, args, CLIENT_COLUMNS, format, 'clients')
@@ -1,21 +1,116 @@
 from fastapi import APIRouter
 from datetime import datetime
 from typing import Annotated, Optional
-import re
+import asyncio
+import json
 import pytz
 
-from fastapi import Depends, HTTPException, status, Query
+from fastapi import Depends, HTTPException, status, Query, Request, Header
+from fastapi.responses import JSONResponse, StreamingResponse
 
 import db_operations
+import order_events
+import order_intake
+import query_builder
+import sales_rollups
 import utils
 
-from base_models import User, NewOrder, UpdateOrder
+from base_models import User, NewOrder, UpdateOrder, MAX_QUANTITY
 from db_classes import ObjectNotFound, ItemNotFound, OrderCantBeChanged, Client, Product, Order, admin_role_id
 
 router = APIRouter()
 
+# Page of get(/orders), with the WHERE clause of get_order_filters and the sort
+ORDERS_QUERY = "SELECT o.id FROM orders o {filters} {sort} LIMIT 20 OFFSET %s"
+# Orders with a line of a section, checked without joining the lines into the page
+SECTION_FILTER = "EXISTS (SELECT 1 FROM orders_products op JOIN products p ON op.product_id = p.id WHERE op.order_id = o.id AND p.section_id = %s)"
+
 # ORDERS ROUTES ------------------------------------------------------------------------------------------------
 
+def get_order_filters(db_cursor, start_date: str | None, end_date: str | None, section: str | None, id: int | None,
+        order_status: str | None, client_id: int | None, min_total: float | None, max_total: float | None) -> tuple:
+    '''Builds the WHERE clause shared by get(/orders) and get(/export/orders), for a query on orders o.
+    Only conditions on orders o are used, so the stored totals can be filtered and sorted on without joins.
+    Returns the clause and its args.
+    Raises HTTPException with status 400 if a filter is invalid.
+    '''
+    conditions = ["o.created_at BETWEEN %s AND %s"]
+    args = []
+    if min_total != None and max_total != None and min_total > max_total:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Valor mínimo não pode ser maior que valor máximo")
+    if start_date != None:
+        try:
+            start_date = datetime.strptime(start_date, "%d/%m/%Y")
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Data de início inválida")
+    else:
+        start_date = datetime.strptime('01/01/1900', "%d/%m/%Y")
+    if end_date != None:
+        try:
+            end_date = datetime.strptime(end_date, "%d/%m/%Y")
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Data de fim inválida")
+    else:
+        end_date = datetime.now(pytz.timezone('America/Sao_Paulo'))
+    start_date = start_date.strftime("%Y-%m-%d") + " 00:00:00+00"
+    end_date = end_date.strftime("%Y-%m-%d") + " 23:59:59+00"
+    if start_date > end_date:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Data de fim início não pode ser maior que data de fim")
+    args.append(start_date)
+    args.append(end_date)
+    if section != None and section != '':
+        try:
+            section_id = utils.get_section_id(db_cursor, section)
+            conditions.append(SECTION_FILTER)
+            args.append(section_id)
+        except utils.ObjectNotFound:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Categoria não localizada, por favor redefina o filtro")
+
+    if id != None and id > 0:
+        conditions.append("o.id = %s")
+        args.append(id)
+
+    if order_status != None and order_status != '':
+        try:
+            order_status_id = utils.get_status_id(db_cursor, order_status)
+            conditions.append("o.status = %s")
+            args.append(order_status_id)
+        except utils.ObjectNotFound:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Status não localizado, por favor redefina o filtro")
+
+    if client_id != None and client_id > 0:
+        try:
+            client = Client(db_cursor, id = client_id)
+            conditions.append("o.client_id = %s")
+            args.append(client_id)
+        except ObjectNotFound:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Cliente não localizado, por favor redefina o filtro")
+
+    if min_total != None:
+        conditions.append("o.total_value >= %s")
+        args.append(min_total)
+
+    if max_total != None:
+        conditions.append("o.total_value <= %s")
+        args.append(max_total)
+    return query_builder.where(tuple(conditions)), args
+
+def get_orders_query(db_cursor, offset: int = 0, start_date: str | None = None, end_date: str | None = None, section: str | None = None,
+        id: int | None = None, order_status: str | None = None, client_id: int | None = None, min_total: float | None = None,
+        max_total: float | None = None, sort_by: str | None = None) -> tuple:
+    '''Builds the query of get(/orders), selecting the ids of a page of orders. Returns the query and its args.
+    Raises HTTPException with status 400 if a filter or the sort is invalid.
+    '''
+    sort = ''
+    if sort_by != None and sort_by != '':
+        sort_column = sort_by.lstrip('-')
+        if sort_column not in ('id', 'created_at', 'item_count', 'total_value'):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Ordenação inválida")
+        sort = f"ORDER BY o.{sort_column} {'DESC' if sort_by.startswith('-') else 'ASC'}"
+    filters, args = get_order_filters(db_cursor, start_date, end_date, section, id, order_status, client_id, min_total, max_total)
+    args.append(offset)
+    return query_builder.statement(ORDERS_QUERY, filters=filters, sort=sort), args
+
 @router.get("/orders")
 async def get_orders(
     current_user: Annotated[User, Depends(utils.get_current_active_user)],
@@ -25,7 +120,10 @@ async def get_orders(
     section: Optional[str] = Query(None),
     id: Optional[int] = Query(0, ge=0),
     order_status: Optional[str] = Query(None),
-    client_id: Optional[int] = Query(0, ge=0)
+    client_id: Optional[int] = Query(0, ge=0),
+    min_total: Optional[float] = Query(None, ge=0),
+    max_total: Optional[float] = Query(None, ge=0),
+    sort_by: Optional[str] = Query(None)
 ):
     '''
     Returns order list, limit of 20 entries.
@@ -38,6 +136,9 @@ async def get_orders(
         id (int, default = 0): Filters order by ID. Note that depending on other filters, it may not be returned. If the exact order is needed, it's recommended to use get(/orders/{id}).
         order_status (str, default = None): Filters by status. Must exist in orders_product database and be exact match (case insensitive).
         client_id (int, default = 0): Filters orders by client ID.
+        min_total (float, default = None): Filters orders with total value greater or equal to the specified value.
+        max_total (float, default = None): Filters orders with total value lower or equal to the specified value.
+        sort_by (str, default = None): Sorts results by "id", "created_at", "item_count" or "total_value". Prefix with "-" for descending order.
 
         Example parameters:
             offset: 10
@@ -47,6 +148,9 @@ async def get_orders(
             id: 10
             order_status: "Em transporte"
             client_id: 3
+            min_total: 50
+            max_total: 500
+            sort_by: "-total_value"
 
         Example return:
             [
@@ -54,6 +158,8 @@ async def get_orders(
                     "id": 1,
                     "created_at": "2025-05-25T16:29:13.177126+00:00",
                     "status": "Em separação",
+                    "item_count": 33,
+                    "total_value": 294.15,
                     "products": {
                         "1": {
                             "id": 12,
@@ -66,7 +172,8 @@ async def get_orders(
                             "images": {
                                 "0": "UklGRn..."
                             },
-                            "quantity": 5
+                            "quantity": 5,
+                            "unit_price": 8.99
                         },
                         "2": {
                             "id": 7,
@@ -79,7 +186,8 @@ async def get_orders(
                             "images": {
                                 "0": "UklGRs..."
                             },
-                            "quantity": 28
+                            "quantity": 28,
+                            "unit_price": 8.9
                         }
                         [...]
                     }
@@ -88,87 +196,17 @@ async def get_orders(
                     "id": 2,
                     "created_at": "2025-05-25T16:29:13.177126+00:00",
                     "status": "Nova",
+                    "item_count": 4,
+                    "total_value": 35.96,
                     "products": {...}
                 }
             ]
                     
     '''
-    args = []
-    date_field = "o.created_at BETWEEN %s AND %s"
-    section_field = ''
-    id_field = ''
-    order_status_field = ''
-    client_id_field = ''
-    if start_date != None:
-        try:
-            start_date = datetime.strptime(start_date, "%d/%m/%Y")
-        except ValueError:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Data de início inválida")
-    else:
-        start_date = datetime.strptime('01/01/1900', "%d/%m/%Y")
-    if end_date != None:
-        try:
-            end_date = datetime.strptime(end_date, "%d/%m/%Y")
-        except ValueError:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Data de fim inválida")
-    else:
-        end_date = datetime.now(pytz.timezone('America/Sao_Paulo'))
-    start_date = start_date.strftime("%Y-%m-%d") + " 00:00:00+00"
-    end_date = end_date.strftime("%Y-%m-%d") + " 23:59:59+00"
-    if start_date > end_date:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Data de fim início não pode ser maior que data de fim")
-    args.append(start_date)
-    args.append(end_date)
     try:
         db_connection = db_operations.postgres_connection();
         db_cursor = db_connection.cursor()
-        if section != None and section != '':
-            try:
-                section_id = utils.get_section_id(db_cursor, section)
-                section_field = "AND s.id = '%s' "
-                args.append(section_id)
-            except utils.ObjectNotFound:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Categoria não localizada, por favor redefina o filtro")
-
-        if id != None and id > 0:
-            id_field = "AND o.id = '%s' "
-            args.append(id)
-
-        if order_status != None and order_status != '':
-            try:
-                order_status_id = utils.get_status_id(db_cursor, order_status)
-                order_status_field = "AND o.status = '%s' "
-                args.append(order_status_id)
-            except utils.ObjectNotFound:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Status não localizado, por favor redefina o filtro")
-
-        if client_id != None and client_id > 0:
-            try:
-                client = Client(db_cursor, id = client_id)
-                client_id_field = "AND c.id = '%s' "
-                args.append(client_id)
-            except ObjectNotFound:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Cliente não localizado, por favor redefina o filtro")
-        args.append(offset)
-        
-        query = f"""
-            SELECT o.id
-            FROM orders o
-            JOIN orders_products op ON o.id = op.order_id
-            JOIN products p ON op.product_id = p.id
-            JOIN sections s ON p.section_id = s.id
-            JOIN clients c ON o.client_id = c.id
-            WHERE
-            {date_field}
-            {section_field}
-            {id_field}
-            {order_status_field}
-            {client_id_field}
-            GROUP BY o.id
-            LIMIT 20 OFFSET %s;
-        """
-        query = re.sub('\n+', ' ', query)
-        query = re.sub(' +', ' ', query)
+        query, args = get_orders_query(db_cursor, offset, start_date, end_date, section, id, order_status, client_id, min_total, max_total, sort_by)
         result_raw = db_operations.select(db_cursor, query, args)
         if len(result_raw) == 0:
             raise HTTPException(status_code=status.HTTP_204_NO_CONTENT)
@@ -187,7 +225,8 @@ async def get_orders(
 @router.post("/orders")
 async def create_order(
     current_user: Annotated[User, Depends(utils.get_current_active_user)],
-    new_order: NewOrder
+    new_order: NewOrder,
+    prefer: Optional[str] = Header(None)
 ):
     ''' Registers new order. Returns a success message and the ID of the new order.
     If user_id is not found, returns 400 with detail.
@@ -198,6 +237,11 @@ async def create_order(
     
     All request values are required, at least one product is required.
 
+    Send an optional Idempotency-Key header to retry safely: a request repeated with the same key within 24 hours returns the recorded response instead of running again.
+
+    Send the header "Prefer: respond-async" to have the order created in background: the request is saved and 202 is returned right away with a
+    tracking ID, to be followed at get(/orders/intake/{tracking_id}). Client, products and stock are then checked when the order is processed.
+
         client_id(int): ID of the order's client (postive non-zero).
         products(list): A list of dictionaries containing two key-values pair: 'product_id'(int) and 'quantity'(int).
         
@@ -222,9 +266,35 @@ async def create_order(
                 "id": order.id
             }
 
+        Example return (Prefer: respond-async, status 202):
+            {
+                "message": "Ordem recebida para processamento",
+                "tracking_id": 15
+            }
+
     '''
     if len(new_order.products)<1:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Ao menos um item obrigatório")
+    if any(item.quantity < 1 for item in new_order.products):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Quantidade inválida")
+    if prefer != None and 'respond-async' in prefer.lower():
+        # Checked here as the stock isn't, a quantity the column can't hold would fail in the background instead
+        if any(item.quantity > MAX_QUANTITY for item in new_order.products):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Quantidade inválida")
+        try:
+            db_connection = db_operations.postgres_connection();
+            db_cursor = db_connection.cursor()
+            tracking_id = order_intake.enqueue(db_cursor, current_user.username, new_order.client_id,
+                [{'product_id': item.product_id, 'quantity': item.quantity} for item in new_order.products])
+            db_connection.commit()
+            return JSONResponse(
+                status_code=status.HTTP_202_ACCEPTED,
+                content={"message": "Ordem recebida para processamento", "tracking_id": tracking_id},
+                headers={"Location": f"/orders/intake/{tracking_id}", "Preference-Applied": "respond-async"}
+            )
+        finally:
+            db_cursor.close()
+            db_connection.close()
     try:
         db_connection = db_operations.postgres_connection();
         db_cursor = db_connection.cursor()
@@ -257,14 +327,17 @@ async def create_order(
                 )
         if len(insufficient_items)>0:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= {'message':"Um ou mais produtos não possui estoque sucifiente", 'details': insufficient_items})
+        if any(item['quantity'] > MAX_QUANTITY for item in product_list):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Quantidade inválida")
 
-        query = "INSERT INTO orders (client_id) VALUES (%s)"
-        new_id = db_operations.insert(db_cursor, query, (new_order.client_id,), 'id')
-        order = Order(db_cursor, new_id)
-
-        for item in product_list:
-            order.include_product(item['product'].id, item['quantity'])
+        products = [{'product_id': item['product'].id, 'quantity': item['quantity']} for item in product_list]
+        try:
+            order = order_intake.create_order(db_cursor, new_order.client_id, products)
+        except ValueError:
+            # Stock taken by a concurrent order after the check above
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= {'message':"Um ou mais produtos não possui estoque sucifiente", 'details': []})
         db_connection.commit()
+        order.record_sales()
         return {"message": "Ordem criada com sucesso", "id": order.id}
     except:
         raise
@@ -272,6 +345,89 @@ async def create_order(
         db_cursor.close()
         db_connection.close()
 
+@router.get("/orders/stream")
+async def stream_orders(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    request: Request,
+    order_status: Optional[str] = Query(None)
+):
+    '''Streams order events as Server-Sent Events, instead of polling get(/orders).
+
+    An event is sent when an order is created ("created") or its status changes, including cancellations ("status_changed").
+    A comment is sent every 15 seconds to keep the connection alive.
+
+        order_status (str, default = None): Only sends events of orders that are now in this status (case insensitive).
+
+        Example event:
+            event: status_changed
+            data: {"event": "status_changed", "order_id": 6, "client_id": 6, "status_id": 4, "status": "Em transporte", "item_count": 34, "total_value": 136.2}
+    '''
+    status_id = None
+    if order_status != None and order_status != '':
+        try:
+            db_connection = db_operations.postgres_connection();
+            db_cursor = db_connection.cursor()
+            status_id = utils.get_status_id(db_cursor, order_status)
+        except utils.ObjectNotFound:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Status não localizado, por favor redefina o filtro")
+        finally:
+            db_cursor.close()
+            db_connection.close()
+
+    async def event_stream():
+        queue = order_events.broker.subscribe()
+        try:
+            yield ": conectado\n\n"
+            while not await request.is_disconnected():
+                try:
+                    payload = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                event = json.loads(payload)
+                if status_id != None and event['status_id'] != status_id:
+                    continue
+                yield f"event: {event['event']}\ndata: {payload}\n\n"
+        finally:
+            order_events.broker.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/orders/intake/{tracking_id}")
+async def get_order_intake(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    tracking_id: int
+):
+    '''Returns the processing state of an order sent with "Prefer: respond-async".
+
+    Status is "pendente" while waiting, "processada" once the order is created (see order_id) or "rejeitada" with the reason in error.
+
+        tracking_id (int): ID returned by post(/orders).
+
+        Example return:
+            {
+                "tracking_id": 15,
+                "status": "processada",
+                "order_id": 57,
+                "error": null,
+                "created_at": "2025-05-25T16:29:13.177126+00:00",
+                "processed_at": "2025-05-25T16:29:13.652303+00:00"
+            }
+    '''
+    try:
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
+        return order_intake.get_intake(db_cursor, tracking_id)
+    except ObjectNotFound:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Pedido de ordem não localizado")
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
 @router.get("/orders/{id}")
 async def get_order(
     current_user: Annotated[User, Depends(utils.get_current_active_user)],
@@ -285,6 +441,8 @@ async def get_order(
                 "id": 5,
                 "created_at": "2025-05-25T16:29:13.177126+00:00",
                 "status": "Cancelada",
+                "item_count": 13,
+                "total_value": 161.5,
                 "products": {
                     "1": {
                         "id": 6,
@@ -297,7 +455,8 @@ async def get_order(
                         "images": {
                             "0": "UklGRn..."
                         },
-                        "quantity": 4
+                        "quantity": 4,
+                        "unit_price": 14.5
                     }, 
                     "2": {...},
                     [...]
@@ -356,6 +515,8 @@ async def update_order(
                     "id": 6,
                     "created_at": "2025-05-25T16:29:13.177126+00:00",
                     "status": "Em transporte",
+                    "item_count": 42,
+                    "total_value": 310.5,
                     "products": {
                         "1": {
                             "id": 1,
@@ -368,7 +529,8 @@ async def update_order(
                             "images": {
                                 "0": "UklGRh..."
                             },
-                            "quantity": 19
+                            "quantity": 19,
+                            "unit_price": 4.5
                         },
                         "2": {...},
                         [...]
@@ -377,28 +539,31 @@ async def update_order(
             }
 
     '''
+    status_id = None
     try:
-        order = Order(db_cursor, id)
-        if not order.is_open():
-            raise OrderCantBeChanged
-    except ObjectNotFound:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Status inválido")
-    except OrderCantBeChanged:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Ordem não pode ser alterada. Verifique se a mesma não está cancelada ou entregue.")
-    if new_info.status != None:
-        try:
-            status_id = utils.get_status_id(db_cursor, new_info.status)
-        except utils.ObjectNotFound:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Status inválido")
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
         try:
-            if status_id == 1:
-                order.cancel_order()
-                return {"message": "Ordem cancelada com sucesso."}
+            order = Order(db_cursor, id)
+            if not order.is_open():
+                raise OrderCantBeChanged
+        except ObjectNotFound:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Ordem não localizada")
         except OrderCantBeChanged:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Ordem não pode ser alterada. Verifique se a mesma não está cancelada ou entregue.")
-    try:
-        db_connection = db_operations.postgres_connection();
-        db_cursor = db_connection.cursor()
+        if new_info.status != None:
+            try:
+                status_id = utils.get_status_id(db_cursor, new_info.status)
+            except utils.ObjectNotFound:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Status inválido")
+            try:
+                if status_id == 1:
+                    order.cancel_order()
+                    db_connection.commit()
+                    order.record_sales()
+                    return {"message": "Ordem cancelada com sucesso."}
+            except OrderCantBeChanged:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Ordem não pode ser alterada. Verifique se a mesma não está cancelada ou entregue.")
         if new_info.products_to_include != None:
             try:
                 for item in new_info.products_to_include:
@@ -414,15 +579,17 @@ async def update_order(
                 for item in new_info.products_to_remove:
                     product = Product(db_cursor, item.product_id)
                     quantity = item.quantity
-                    order.remove_product(db_cursor, product.id, quantity)
+                    order.remove_product(product.id, quantity)
             except ValueError:
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Um ou mais produto informado possui quantidade além do disponível na ordem.")
             except ObjectNotFound:
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Um ou mais produto não foi localizado")
             except ItemNotFound:
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Um ou mais produto não existe na ordem")
-        order.change_status(db_cursor, status_id)
+        if status_id != None:
+            order.change_status(status_id)
         db_connection.commit()
+        order.record_sales()
         return {
             "message": "Ordem atualizada com sucesso",
             "details": order.get_info()
@@ -465,11 +632,14 @@ async def delete_order(
             order.cancel_order()
         except:
             pass
+        sales_rollups.mark_dirty_days(db_cursor,
+            "SELECT (created_at AT TIME ZONE %s)::date FROM orders WHERE id = %s", (sales_rollups.REPORTS_TIMEZONE, id,))
         query = """
             DELETE FROM orders WHERE id = %s
         """
         result = db_operations.insert(db_cursor, query, (id,))
         db_connection.commit()
+        order.record_sales()
         return {"message": "Ordem deletada com sucesso"}
     except:
         raise
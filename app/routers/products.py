@@ -1,27 +1,79 @@
 from fastapi import APIRouter
 from datetime import datetime
 from typing import Annotated, Optional
-import re
 
-from fastapi import Depends, HTTPException, status, Query
+from fastapi import Depends, HTTPException, status, Query, Request
+from psycopg2.errors import UniqueViolation
 
+import bulk_import
 import db_operations
+import query_builder
+import sales_rollups
+import stock_ledger
+import text_search
 import utils
 
-from base_models import User, NewProduct, UpdateProduct
-from db_classes import ObjectNotFound, Product, admin_role_id
+from base_models import User, NewProduct, UpdateProduct, StockShards
+from db_classes import ObjectNotFound, Product, PRODUCT_STOCK, CHANGES_PAGE_SIZE, admin_role_id, get_changes_watermark, get_product_changes, record_product_changes, set_stock, set_stocks
 
 router = APIRouter()
 
+# Columns read from each row of post(/products:bulk)
+BULK_COLUMNS = ('description', 'sell_value', 'barcode', 'section', 'stock', 'expiration_date')
+# Page of get(/products), with the WHERE clause of get_product_filters and the sort
+PRODUCTS_QUERY = "SELECT p.id FROM products p {filters} ORDER BY {order} LIMIT 20 OFFSET %s"
+
 # PRODUCTS ROUTES ------------------------------------------------------------------------------------------------
 
+def get_product_filters(db_cursor, category: str | None, sell_value: float | None, available: bool | None, q: str | None) -> tuple:
+    '''Builds the WHERE clause shared by get(/products) and get(/export/products), for products aliased as p.
+    Returns the clause ('' without filters) and its args. Raises HTTPException with status 400 if the category is not found.
+    '''
+    conditions = []
+    args = []
+    if category != None and category != '':
+        try:
+            category_id = utils.get_section_id(db_cursor, category)
+            conditions.append("p.section_id = %s")
+            args.append(category_id)
+        except ObjectNotFound:
+            raise HTTPException(status_code=400, detail= "Categoria não localizada, por favor redefina o filtro")
+
+    if sell_value != None and sell_value > 0:
+        conditions.append("p.sell_value <= %s")
+        args.append(sell_value)
+
+    if available:
+        conditions.append(f"{PRODUCT_STOCK} > 0")
+
+    if q != None and q != '':
+        pattern = text_search.like_pattern(q)
+        conditions.append("(p.description ILIKE %s OR p.barcode LIKE %s)")
+        args += [pattern, pattern]
+
+    return query_builder.where(tuple(conditions)), args
+
+def get_products_query(db_cursor, offset: int = 0, category: str | None = None, sell_value: float | None = 0, available: bool | None = False,
+        q: str | None = None) -> tuple:
+    '''Builds the query of get(/products), selecting the ids of a page of products. Returns the query and its args.
+    Raises HTTPException with status 400 if the category is not found.
+    '''
+    filters, args = get_product_filters(db_cursor, category, sell_value, available, q)
+    order = 'p.id'
+    if q != None and q != '':
+        order = text_search.PRODUCT_RANK
+        args += [q.lower(), q.lower()]
+    args.append(offset)
+    return query_builder.statement(PRODUCTS_QUERY, filters=filters, order=order), args
+
 @router.get("/products")
 async def get_products(
     current_user: Annotated[User, Depends(utils.get_current_active_user)],
     offset: Optional[int] = Query(0, ge=0),
     category: Optional[str] = Query(None),
     sell_value: Optional[float] = Query(0, ge=0),
-    available: Optional[bool] = Query(False)
+    available: Optional[bool] = Query(False),
+    q: Optional[str] = Query(None)
 ):
     '''Returns products list, limit of 20 entries.
     
@@ -31,12 +83,14 @@ async def get_products(
         category (str, optional, default = None): Filter results by section.
         sell_value (float, optional, default = 0): Filter results lower than the specified sell_value if > 0.
         available (bool, optional, default = False): Filter only results with items in stock if True
+        q (str, optional, default = None): Filter results by description and barcode using the specified keyword. Best matches come first.
 
         Example parameters:
             offset: 10
             category: "Hortifruti"
             sell_value: 10.5
             available: True
+            q: "feijão"
 
         Example return:
             [
@@ -67,36 +121,10 @@ async def get_products(
                 }
             ]
     '''
-    args = []
-    category_string = ''
-    sell_value_string = ''
-    available_string = ''
     try:
         db_connection = db_operations.postgres_connection();
         db_cursor = db_connection.cursor()
-        if category != None and category != '':
-            try:
-                category_id = utils.get_section_id(db_cursor, category)
-                category_string = "section_id = %s AND "
-                args.append(category_id)
-            except ObjectNotFound:
-                raise HTTPException(status_code=400, detail= "Categoria não localizada, por favor redefina o filtro")
-        
-        if sell_value > 0:
-            sell_value_string = "sell_value <= %s AND "
-            args.append(sell_value)
-
-        if available:
-            available_string = "stock > 0 AND "
-        
-        args.append(offset)
-        query = f"""
-            SELECT * FROM products {category_string}{sell_value_string}{available_string} LIMIT 20 OFFSET %s
-        """
-        query = re.sub(' +', ' ', query)
-        query = query.replace(" AND LIMIT", " LIMIT")
-        if len(category_string+sell_value_string+available_string)>0:
-            query = query.replace("FROM products", "FROM products WHERE")
+        query, args = get_products_query(db_cursor, offset, category, sell_value, available, q)
         result_raw = db_operations.select(db_cursor, query, args)
         if len(result_raw) == 0:
             raise HTTPException(status_code=status.HTTP_204_NO_CONTENT)
@@ -122,6 +150,8 @@ async def create_product(
 
     All request fields are required, except for expiration_date and images.
 
+    Send an optional Idempotency-Key header to retry safely: a request repeated with the same key within 24 hours returns the recorded response instead of running again.
+
         description (str): Product's description        
         sell_value (float): Product's selling value        
         barcode (str): Product's barcode, must be unique        
@@ -180,46 +210,264 @@ async def create_product(
                 raise ObjectNotFound
         except ObjectNotFound:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "ID de categoria inválido")
+        query = """
+                INSERT INTO products (description, sell_value, barcode, section_id, stock, expiration_date)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """
+        args = (
+            new_product.description,
+            new_product.sell_value,
+            new_product.barcode,
+            new_product.section_id,
+            0,
+            new_product.expiration_date,
+        )
+        # The unique constraint checks the barcode in the same statement, without a lookup before
         try:
-            existing_product = Product(db_cursor, barcode=new_product.barcode)
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Código de barras já existe") 
-        except ObjectNotFound:
-            query = """
-                    INSERT INTO products (description, sell_value, barcode, section_id, stock, expiration_date)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """
-            args = (
-                new_product.description,
-                new_product.sell_value,
-                new_product.barcode,
-                new_product.section_id,
-                new_product.stock,
-                new_product.expiration_date,
-            )
             result = db_operations.insert(db_cursor, query, args, 'id')
-            db_connection.commit()
-            saved_product = Product(db_cursor, result)
-            message = "Produto cadastrado com sucesso"
-            errored_image = False
-            if new_product.images!=None:
-                for image in new_product.images:
-                    try:
-                        saved_product.insert_image(image)
-                    except:
-                        if not errored_image:
-                            message += ". Uma ou mais imagem não pôde ser salva..."
-                            errored_image = True
-            db_connection.commit()
-            return {
-                "message": message,
-                "details": saved_product.get_info()
-                }
+        except UniqueViolation:
+            db_connection.rollback()
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Código de barras já existe")
+        # The initial stock is recorded in the ledger like any other movement
+        set_stock(db_cursor, result, new_product.stock, reason=stock_ledger.REGISTRATION)
+        db_connection.commit()
+        saved_product = Product(db_cursor, result)
+        message = "Produto cadastrado com sucesso"
+        errored_image = False
+        if new_product.images!=None:
+            for image in new_product.images:
+                try:
+                    saved_product.insert_image(image)
+                except:
+                    if not errored_image:
+                        message += ". Uma ou mais imagem não pôde ser salva..."
+                        errored_image = True
+        db_connection.commit()
+        return {
+            "message": message,
+            "details": saved_product.get_info()
+            }
     except:
         raise
     finally:
         db_cursor.close()
         db_connection.close()
 
+@router.post("/products:bulk")
+async def upsert_products_bulk(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    request: Request
+):
+    '''Registers or updates many products, identified by barcode, from a CSV (Content-Type: text/csv) or NDJSON (Content-Type: application/x-ndjson) body.
+    Only admins can perform this action.
+
+    The body is read as it arrives, so the whole catalog can be sent at once. CSV files need a header with the columns below.
+    Products with a barcode already registered are updated, others are registered. Images are not imported.
+    If a barcode repeats in the file, the last row is used and the previous ones are rejected.
+
+        description (str): Product's description
+        sell_value (float): Product's sell value (must be greater than 0)
+        barcode (str): Product's barcode
+        section (str): Name of the product's section
+        stock (int): Product's stock (0 or greater)
+        expiration_date (str, format dd/mm/aaaa, optional): Expiration date of the product
+
+        Example request (CSV):
+            description,sell_value,barcode,section,stock,expiration_date
+            Feijão Carioca,8.70,789100000003,Marcearia,150,12/06/2025
+
+        Example return:
+            {
+                "message": "Importação de produtos concluída",
+                "received": 3,
+                "inserted": 1,
+                "updated": 1,
+                "rejected": 1,
+                "errors": [
+                    {
+                        "row": 3,
+                        "detail": "Categoria não localizada"
+                    }
+                ]
+            }
+    '''
+    if current_user.role > admin_role_id:
+        raise HTTPException(status_code=403, detail= "Apenas Admins podem adicionar produtos")
+    format = bulk_import.get_format(request.headers.get('content-type'))
+    if format == None:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail= "Formato não suportado, envie CSV ou NDJSON")
+    report = bulk_import.Report()
+    try:
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
+        sections = {name.lower(): id for id, name in db_operations.select(db_cursor, "SELECT id, name FROM sections")}
+        db_operations.insert(db_cursor,
+            """
+            CREATE TEMP TABLE products_import (
+                file_row INT NOT NULL, description VARCHAR(50), sell_value DECIMAL(9,2), barcode VARCHAR(50),
+                section_id SMALLINT, stock INT, expiration_date DATE, product_id INT, inserted BOOLEAN
+            ) ON COMMIT DROP
+            """, ())
+        try:
+            async for batch in bulk_import.iter_batches(request, format, BULK_COLUMNS):
+                report.received += len(batch)
+                rows = []
+                for row, record in batch:
+                    try:
+                        rows.append((row,) + parse_bulk_product(record, sections))
+                    except ValueError as error:
+                        report.reject(row, str(error))
+                bulk_import.copy_rows(db_cursor, 'products_import',
+                    ('file_row', 'description', 'sell_value', 'barcode', 'section_id', 'stock', 'expiration_date'), rows)
+        except bulk_import.InvalidFile:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Arquivo inválido, verifique a codificação (UTF-8) e o cabeçalho")
+        repeated = db_operations.select(db_cursor,
+            """
+            DELETE FROM products_import s USING products_import later
+            WHERE later.barcode = s.barcode AND later.file_row > s.file_row
+            RETURNING s.file_row
+            """, ())
+        for row in {row[0] for row in repeated}:
+            report.reject(row, "Código de barras repetido no arquivo")
+        # Stock is set afterwards through the ledger, so the upsert leaves it untouched
+        db_operations.insert(db_cursor,
+            """
+            WITH merged AS (
+                INSERT INTO products (description, sell_value, barcode, section_id, stock, expiration_date)
+                SELECT description, sell_value, barcode, section_id, 0, expiration_date FROM products_import ORDER BY barcode
+                ON CONFLICT (barcode) DO UPDATE SET
+                    description = EXCLUDED.description,
+                    sell_value = EXCLUDED.sell_value,
+                    section_id = EXCLUDED.section_id,
+                    expiration_date = EXCLUDED.expiration_date
+                RETURNING id, barcode, xmax = 0 AS inserted
+            )
+            UPDATE products_import s SET product_id = m.id, inserted = m.inserted
+            FROM merged m
+            WHERE m.barcode = s.barcode
+            """, ())
+        merged = db_operations.select(db_cursor, "SELECT product_id, stock, inserted FROM products_import")
+        set_stocks(db_cursor, [(product_id, stock) for product_id, stock, inserted in merged if inserted], stock_ledger.REGISTRATION)
+        set_stocks(db_cursor, [(product_id, stock) for product_id, stock, inserted in merged if not inserted])
+        db_connection.commit()
+    finally:
+        db_cursor.close()
+        db_connection.close()
+    inserted = len([entry for entry in merged if entry[2]])
+    return {
+        "message": "Importação de produtos concluída",
+        "inserted": inserted,
+        "updated": len(merged) - inserted,
+        **report.get_info()
+    }
+
+def parse_bulk_product(record: dict | None, sections: dict) -> tuple:
+    '''Validates a row of post(/products:bulk) and returns (description, sell_value, barcode, section_id, stock, expiration_date).
+    Raises ValueError with the error message if invalid.
+    '''
+    if record == None:
+        raise ValueError("Linha inválida")
+    description = record['description']
+    if type(description) != str or len(description) < 1 or len(description) > 50:
+        raise ValueError("Descrição inválida")
+    try:
+        sell_value = round(float(record['sell_value']), 2)
+    except (TypeError, ValueError):
+        raise ValueError("Preço de venda inválido")
+    if not sell_value >= .01 or sell_value >= 10000000:
+        raise ValueError("Preço de venda inválido")
+    barcode = record['barcode']
+    if type(barcode) == int:
+        barcode = str(barcode)
+    if type(barcode) != str or len(barcode) < 1 or len(barcode) > 50:
+        raise ValueError("Código de barras inválido")
+    section_id = sections.get(str(record['section']).strip().lower())
+    if section_id == None:
+        raise ValueError("Categoria não localizada")
+    try:
+        stock = int(record['stock'])
+    except (TypeError, ValueError):
+        raise ValueError("Estoque inválido")
+    if stock < 0 or stock > 2147483647:
+        raise ValueError("Estoque inválido")
+    expiration_date = record['expiration_date']
+    if expiration_date in (None, ''):
+        expiration_date = None
+    else:
+        try:
+            expiration_date = datetime.strptime(str(expiration_date), "%d/%m/%Y").strftime("%Y-%m-%d")
+        except ValueError:
+            raise ValueError("Prazo de validade inválido")
+    return description, sell_value, barcode, section_id, stock, expiration_date
+
+@router.get("/products/changes")
+async def get_products_changes(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    since: Optional[int] = Query(0, ge=0),
+    until: Optional[int] = Query(0, ge=0),
+    after: Optional[int] = Query(0, ge=0)
+):
+    '''Returns the products created, changed (including price and stock) or deleted since the last sync, so terminals
+    don't need to download the whole catalog again. Images are not included.
+
+    Send 0 (or nothing) on the first sync to receive every product, then the next_since of the previous response.
+    A product may be returned again in the next sync, apply changes by id.
+    Up to 500 products are returned at once. While next_page is not null, send its parameters to get the rest of the
+    sync, and keep next_since until the last page.
+
+        since (int, default = 0): next_since returned by the previous sync.
+        until (int, default = 0): from next_page, leave it out on the first page.
+        after (int, default = 0): from next_page, leave it out on the first page.
+
+        Example return:
+            {
+                "next_since": 48213,
+                "next_page": {
+                    "since": 47950,
+                    "until": 48213,
+                    "after": 512
+                },
+                "upserts": [
+                    {
+                        "id": 3,
+                        "description": "Feijão Carioca",
+                        "sell_value": 8.7,
+                        "barcode": "789100000003",
+                        "section_name": "Marcearia",
+                        "stock": 148,
+                        "expiration_date": "2025-06-12"
+                    }
+                ],
+                "deletes": [12]
+            }
+    '''
+    try:
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
+        # The watermark is taken on the first page and kept by the next ones, so changes made while paging go to the next sync
+        if until == 0:
+            until = get_changes_watermark(db_cursor)
+        if since == 0:
+            # Products created before the change log existed have no changes, so the first sync lists the catalog itself
+            rows = db_operations.select(db_cursor,
+                "SELECT id, FALSE FROM products WHERE id > %s ORDER BY id LIMIT %s", (after, CHANGES_PAGE_SIZE,))
+        else:
+            rows = get_product_changes(db_cursor, since, until, after)
+        products = Product.load_many(db_cursor, [product_id for product_id, deleted in rows if not deleted])
+        next_page = None
+        if len(rows) == CHANGES_PAGE_SIZE:
+            next_page = {"since": since, "until": until, "after": rows[-1][0]}
+        return {
+            "next_since": until,
+            "next_page": next_page,
+            "upserts": [products[product_id].get_info_without_image() for product_id in sorted(products)],
+            # Products deleted after their change was recorded are gone too
+            "deletes": [product_id for product_id, deleted in rows if deleted or product_id not in products]
+        }
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
 @router.get("/products/{id}")
 async def get_produc_by_id(
     current_user: Annotated[User, Depends(utils.get_current_active_user)],
@@ -312,82 +560,71 @@ async def put_product(
     if current_user.role > admin_role_id:
         raise HTTPException(status_code=403, detail= "Apenas Admins podem editar productes")
     try:
-        product = Product(db_cursor, id = id)
-    except ObjectNotFound:
-        raise HTTPException(status_code=status.HTTP_204_NO_CONTENT)
-    
-    values = []
-    description_field = ''
-    sell_value_field = ''
-    barcode_field = ''
-    section_id_field = ''
-    stock_field = ''
-    expiration_date_field = ''
-
-    if new_information.description != None:
-        if new_information.description == '':
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Descrição inválida")
-        description_field = 'description = %s, '
-        values.append(new_information.description)
-    
-    if new_information.sell_value != None:
-        if new_information.sell_value < 0:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Preço de venda inválido")
-        sell_value_field = 'sell_value = %s, '
-        values.append(new_information.sell_value)
-    
-    if new_information.barcode != None:
-        if new_information.barcode == '':
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Barcode inválido")
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
         try:
-            existing_product = Product(db_cursor, barcode=new_information.barcode)
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Barcode já existe")
+            product = Product(db_cursor, id = id)
         except ObjectNotFound:
-            barcode_field = 'barcode = %s, '
+            raise HTTPException(status_code=status.HTTP_204_NO_CONTENT)
+        
+        columns = []
+        values = []
+
+        if new_information.description != None:
+            if new_information.description == '':
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Descrição inválida")
+            columns.append('description')
+            values.append(new_information.description)
+        
+        if new_information.sell_value != None:
+            if new_information.sell_value < 0:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Preço de venda inválido")
+            columns.append('sell_value')
+            values.append(new_information.sell_value)
+        
+        if new_information.barcode != None:
+            if new_information.barcode == '':
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Barcode inválido")
+            columns.append('barcode')
             values.append(new_information.barcode)
-    
-    if new_information.section_id != None:
-        try:
-            query = "SELECT * FROM sections WHERE id=%s"
-            result = db_operations.select(db_cursor, query, (new_information.section_id,))
-            if len(result) < 1:
-                raise ObjectNotFound
-        except ObjectNotFound:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "ID de categoria inválido")
-        section_id_field = 'section_id = %s, '
-        values.append(new_information.section_id)
-    
-    if new_information.stock != None:
-        if new_information.stock < 0:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Estoque inválido")
-        stock_field = 'stock = %s, '
-        values.append(new_information.stock)
+        
+        if new_information.section_id != None:
+            try:
+                query = "SELECT * FROM sections WHERE id=%s"
+                result = db_operations.select(db_cursor, query, (new_information.section_id,))
+                if len(result) < 1:
+                    raise ObjectNotFound
+            except ObjectNotFound:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "ID de categoria inválido")
+            columns.append('section_id')
+            values.append(new_information.section_id)
+        
+        if new_information.stock != None:
+            if new_information.stock < 0:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Estoque inválido")
 
-    if new_information.expiration_date != None:
-        try:
-            date_obj = datetime.strptime(new_information.expiration_date, "%d/%m/%Y")
-            new_information.expiration_date = date_obj.strftime("%Y-%m-%d")
-        except ValueError:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Prazo de validade inválido")
-        expiration_date_field = 'expiration_date = %s, '
-        values.append(new_information.expiration_date)
-
-    query = f"""UPDATE products SET
-        {description_field}
-        {sell_value_field}
-        {barcode_field}
-        {section_id_field}
-        {stock_field}
-        {expiration_date_field} WHERE id = %s """
-    query = query.replace('\n', '')
-    query = re.sub(' +', ' ', query)
-    query = query.replace(", WHERE", " WHERE")
-    values.append(id)
-    try:
-        db_connection = db_operations.postgres_connection();
-        db_cursor = db_connection.cursor()
-        result = db_operations.insert(db_cursor, query, values, "id")
-        updated_product = Product(db_cursor, id = result)
+        if new_information.expiration_date != None:
+            try:
+                date_obj = datetime.strptime(new_information.expiration_date, "%d/%m/%Y")
+                new_information.expiration_date = date_obj.strftime("%Y-%m-%d")
+            except ValueError:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Prazo de validade inválido")
+            columns.append('expiration_date')
+            values.append(new_information.expiration_date)
+
+        if len(values) > 0:
+            query = query_builder.update('products', tuple(columns))
+            values.append(id)
+            try:
+                db_operations.insert(db_cursor, query, values, "id")
+            except UniqueViolation:
+                db_connection.rollback()
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Barcode já existe")
+        # Stock goes through set_stock so sharded products are spread over their shards
+        if new_information.stock != None:
+            set_stock(db_cursor, id, new_information.stock)
+        record_product_changes(db_cursor, [id])
+        updated_product = Product(db_cursor, id = id)
         message = "Produto atualizado com sucesso"
         errored_image = False
         if new_information.images!=None:
@@ -409,6 +646,86 @@ async def put_product(
         db_cursor.close()
         db_connection.close()
 
+@router.put("/products/{id}/stock-shards")
+async def put_product_stock_shards(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    id: int,
+    new_information: StockShards
+):
+    '''Splits a product's stock into several counters, so concurrent orders of a heavily sold product don't wait on each other.
+    Only admins can perform this action.
+
+    The stock returned by the API is still the total of all shards. Send 0 shards to turn sharding off. The total stock is kept.
+
+        shards (int): Number of stock counters, from 0 (not sharded) to 64.
+
+        Example request:
+            {
+                "shards": 8
+            }
+
+        Example return:
+            {
+                "message": "Estoque do produto redistribuído com sucesso",
+                "shards": 8,
+                "stock": 150
+            }
+    '''
+    if current_user.role > admin_role_id:
+        raise HTTPException(status_code=403, detail= "Apenas Admins podem editar productes")
+    if new_information.shards < 0 or new_information.shards > 64:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Quantidade de divisões inválida")
+    try:
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
+        try:
+            stock = set_stock(db_cursor, id, shards=new_information.shards)
+        except ObjectNotFound:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Produto não localizado")
+        db_connection.commit()
+        return {
+            "message": "Estoque do produto redistribuído com sucesso",
+            "shards": new_information.shards,
+            "stock": stock
+        }
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+@router.get("/products/{id}/stock-history")
+async def get_product_stock_history(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    id: int,
+    offset: Optional[int] = Query(0, ge=0)
+):
+    '''Returns the stock movements of a product, newest first, 20 per page.
+
+        id: ID of the product
+        offset (int, default = 0): Number of movements to skip.
+
+        Example return:
+            [
+                {
+                    "id": 412,
+                    "delta": -3,
+                    "reason": "inclusao_ordem",
+                    "order_id": 27,
+                    "created_at": "2025-05-12T14:03:11.482113-03:00"
+                }
+            ]
+    '''
+    try:
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
+        try:
+            Product(db_cursor, id)
+        except ObjectNotFound:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Produto não localizado")
+        return stock_ledger.get_history(db_cursor, id, offset)
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
 @router.delete("/products/{id}")
 async def delete_product(
     current_user: Annotated[User, Depends(utils.get_current_active_user)],
@@ -438,10 +755,22 @@ async def delete_product(
             product = Product(db_cursor, id = id)
         except ObjectNotFound:
             raise HTTPException(status_code=status.HTTP_204_NO_CONTENT)
+        sales_rollups.mark_dirty_days(db_cursor, "SELECT day FROM sales_daily_products WHERE product_id = %s", (id,))
+        # The delete cascades to the order lines of the product, so their orders' totals are settled without them first
+        db_operations.insert(db_cursor,
+            """
+            UPDATE orders o SET item_count = o.item_count - l.quantity, total_value = o.total_value - l.value, updated_at = NOW()
+            FROM (
+                SELECT order_id, SUM(quantity) AS quantity, SUM(quantity * unit_price) AS value
+                FROM orders_products WHERE product_id = %s GROUP BY order_id
+            ) l
+            WHERE o.id = l.order_id
+            """, (id,))
         query = """
             DELETE FROM products WHERE id = %s
         """
         result = db_operations.insert(db_cursor, query, (id,))
+        record_product_changes(db_cursor, [id], deleted=True)
         db_connection.commit()
         return {"message": "Produto deletado com sucesso"}
     except:
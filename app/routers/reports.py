@@ -0,0 +1,297 @@
+from fastapi import APIRouter
+from datetime import datetime
+from typing import Annotated, Optional
+import pytz
+
+from fastapi import Depends, HTTPException, status, Query
+
+import db_operations
+import leaderboard
+import sales_rollups
+import utils
+
+from base_models import User
+from db_classes import admin_role_id
+
+router = APIRouter()
+
+# REPORTS ROUTES ------------------------------------------------------------------------------------------------
+
+def get_date_range(start_date: str | None, end_date: str | None) -> tuple:
+    '''Converts the dd/mm/aaaa start and end dates of a report into dates.
+    Defaults to 01/01/1900 and today. Raises HTTPException with status 400 if invalid.
+    '''
+    if start_date != None:
+        try:
+            start_date = datetime.strptime(start_date, "%d/%m/%Y").date()
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Data de início inválida")
+    else:
+        start_date = datetime.strptime('01/01/1900', "%d/%m/%Y").date()
+    if end_date != None:
+        try:
+            end_date = datetime.strptime(end_date, "%d/%m/%Y").date()
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Data de fim inválida")
+    else:
+        end_date = datetime.now(pytz.timezone(sales_rollups.REPORTS_TIMEZONE)).date()
+    if start_date > end_date:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Data de fim início não pode ser maior que data de fim")
+    return start_date, end_date
+
+@router.get("/reports/sales/daily")
+async def get_daily_sales(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None)
+):
+    '''Returns orders, units sold and revenue per day, from the precalculated rollups. Cancelled orders are not included.
+
+    Results may be up to one refresh interval behind the orders.
+
+        start_date (str, format dd/mm/aaaa, default = None): First day of the report. If unspecified, starts at 01/01/1900.
+        end_date (str, format dd/mm/aaaa, default = None): Last day of the report. If unspecified, ends today.
+
+        Example return:
+            [
+                {
+                    "day": "2025-05-12",
+                    "orders": 3,
+                    "units": 51,
+                    "revenue": 412.7
+                }
+            ]
+    '''
+    start_date, end_date = get_date_range(start_date, end_date)
+    query = """
+        SELECT day, SUM(orders), SUM(units), SUM(revenue)
+        FROM sales_daily_clients
+        WHERE day BETWEEN %s AND %s
+        GROUP BY day
+        ORDER BY day
+    """
+    try:
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
+        result_raw = db_operations.select(db_cursor, query, (start_date, end_date,))
+        return [
+            {'day': row[0], 'orders': row[1], 'units': row[2], 'revenue': row[3]}
+            for row in result_raw
+        ]
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+@router.get("/reports/sales/sections")
+async def get_sales_by_section(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None)
+):
+    '''Returns orders, units sold and revenue per section in the period, sorted by revenue.
+
+        start_date (str, format dd/mm/aaaa, default = None): First day of the report. If unspecified, starts at 01/01/1900.
+        end_date (str, format dd/mm/aaaa, default = None): Last day of the report. If unspecified, ends today.
+
+        Example return:
+            [
+                {
+                    "section_id": 2,
+                    "section_name": "Marcearia",
+                    "orders": 14,
+                    "units": 230,
+                    "revenue": 2104.3
+                }
+            ]
+    '''
+    start_date, end_date = get_date_range(start_date, end_date)
+    query = """
+        SELECT r.section_id, s.name, SUM(r.orders), SUM(r.units), SUM(r.revenue)
+        FROM sales_daily_sections r
+        JOIN sections s ON r.section_id = s.id
+        WHERE r.day BETWEEN %s AND %s
+        GROUP BY r.section_id, s.name
+        ORDER BY SUM(r.revenue) DESC
+    """
+    try:
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
+        result_raw = db_operations.select(db_cursor, query, (start_date, end_date,))
+        return [
+            {'section_id': row[0], 'section_name': row[1], 'orders': row[2], 'units': row[3], 'revenue': row[4]}
+            for row in result_raw
+        ]
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+@router.get("/reports/sales/products")
+async def get_sales_by_product(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None),
+    section: Optional[str] = Query(None),
+    limit: Optional[int] = Query(20, ge=1, le=1000)
+):
+    '''Returns orders, units sold and revenue per product in the period, sorted by revenue.
+
+        start_date (str, format dd/mm/aaaa, default = None): First day of the report. If unspecified, starts at 01/01/1900.
+        end_date (str, format dd/mm/aaaa, default = None): Last day of the report. If unspecified, ends today.
+        section (str, default = None): Filters products of the section.
+        limit (int, default = 20): Maximum number of products returned (up to 1000).
+
+        Example return:
+            [
+                {
+                    "product_id": 8,
+                    "description": "Queijo Mussarela",
+                    "orders": 4,
+                    "units": 58,
+                    "revenue": 2117.0
+                }
+            ]
+    '''
+    start_date, end_date = get_date_range(start_date, end_date)
+    args = [start_date, end_date]
+    section_field = ''
+    try:
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
+        if section != None and section != '':
+            try:
+                section_id = utils.get_section_id(db_cursor, section)
+                section_field = "AND p.section_id = %s"
+                args.append(section_id)
+            except utils.ObjectNotFound:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Categoria não localizada, por favor redefina o filtro")
+        args.append(limit)
+        query = f"""
+            SELECT r.product_id, p.description, SUM(r.orders), SUM(r.units), SUM(r.revenue)
+            FROM sales_daily_products r
+            JOIN products p ON r.product_id = p.id
+            WHERE r.day BETWEEN %s AND %s {section_field}
+            GROUP BY r.product_id, p.description
+            ORDER BY SUM(r.revenue) DESC
+            LIMIT %s
+        """
+        result_raw = db_operations.select(db_cursor, query, args)
+        return [
+            {'product_id': row[0], 'description': row[1], 'orders': row[2], 'units': row[3], 'revenue': row[4]}
+            for row in result_raw
+        ]
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+@router.get("/reports/sales/clients")
+async def get_sales_by_client(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None),
+    client_id: Optional[int] = Query(0, ge=0),
+    limit: Optional[int] = Query(20, ge=1, le=1000)
+):
+    '''Returns orders, units bought and revenue per client in the period, sorted by revenue.
+
+        start_date (str, format dd/mm/aaaa, default = None): First day of the report. If unspecified, starts at 01/01/1900.
+        end_date (str, format dd/mm/aaaa, default = None): Last day of the report. If unspecified, ends today.
+        client_id (int, default = 0): Filters a single client.
+        limit (int, default = 20): Maximum number of clients returned (up to 1000).
+
+        Example return:
+            [
+                {
+                    "client_id": 12,
+                    "name": "Christine Melton",
+                    "orders": 2,
+                    "units": 40,
+                    "revenue": 395.1
+                }
+            ]
+    '''
+    start_date, end_date = get_date_range(start_date, end_date)
+    args = [start_date, end_date]
+    client_field = ''
+    if client_id != None and client_id > 0:
+        client_field = "AND r.client_id = %s"
+        args.append(client_id)
+    args.append(limit)
+    query = f"""
+        SELECT r.client_id, c.name, SUM(r.orders), SUM(r.units), SUM(r.revenue)
+        FROM sales_daily_clients r
+        JOIN clients c ON r.client_id = c.id
+        WHERE r.day BETWEEN %s AND %s {client_field}
+        GROUP BY r.client_id, c.name
+        ORDER BY SUM(r.revenue) DESC
+        LIMIT %s
+    """
+    try:
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
+        result_raw = db_operations.select(db_cursor, query, args)
+        return [
+            {'client_id': row[0], 'name': row[1], 'orders': row[2], 'units': row[3], 'revenue': row[4]}
+            for row in result_raw
+        ]
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+@router.get("/reports/top-products")
+async def get_top_products(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    window: Optional[str] = Query('today'),
+    limit: Optional[int] = Query(10, ge=1, le=100)
+):
+    '''Returns the best selling products of the window, by units sold. Served from an in memory leaderboard kept by the order routes.
+
+    Units sold through other workers may take up to 5 minutes to be counted.
+
+        window (str, default = "today"): "today" (since local midnight) or "week" (last 7 days).
+        limit (int, default = 10): Number of products to return (up to 100).
+
+        Example return:
+            [
+                {
+                    "product_id": 2,
+                    "description": "Arroz Branco Tipo 1",
+                    "units": 30
+                }
+            ]
+    '''
+    try:
+        since = leaderboard.get_window_start(window)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Janela inválida")
+    top = leaderboard.board.top(limit, since)
+    if len(top) == 0:
+        return []
+    try:
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
+        descriptions = dict(db_operations.select(db_cursor,
+            "SELECT id, description FROM products WHERE id = ANY(%s)", ([product_id for product_id, _ in top],)))
+        return [
+            {'product_id': product_id, 'description': descriptions.get(product_id), 'units': units}
+            for product_id, units in top if product_id in descriptions
+        ]
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+@router.post("/reports/refresh")
+async def refresh_reports(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)]
+):
+    '''Refreshes the sales rollups immediately instead of waiting for the background refresh. Only admins can perform this action.
+
+        Example return:
+            {
+                "message": "Relatórios atualizados com sucesso",
+                "days": 3
+            }
+    '''
+    if current_user.role > admin_role_id:
+        raise HTTPException(status_code=403, detail= "Apenas Admins podem atualizar relatórios")
+    refreshed = sales_rollups.refresh_now()
+    return {"message": "Relatórios atualizados com sucesso", "days": refreshed}
@@ -0,0 +1,49 @@
+from fastapi import APIRouter
+from typing import Annotated, Optional
+
+from fastapi import Depends, HTTPException, status, Query
+
+import db_operations
+import text_search
+import utils
+
+from base_models import User
+
+router = APIRouter()
+
+# SEARCH ROUTES ------------------------------------------------------------------------------------------------
+
+@router.get("/search/autocomplete")
+async def get_autocomplete(
+    current_user: Annotated[User, Depends(utils.get_current_active_user)],
+    q: str = Query(...),
+    scope: Optional[str] = Query('clients'),
+    limit: Optional[int] = Query(10, ge=1, le=20)
+):
+    '''Returns clients or products starting with the typed term, for search boxes suggesting results as the user types.
+
+    Results are kept in memory for 30 seconds, so recent changes may take that long to show up.
+
+        q (str): Beginning of the client's name or email, or of the product's description or barcode (at least 2 characters).
+        scope (str, default = "clients"): "clients" or "products".
+        limit (int, default = 10): Number of suggestions to return (up to 20).
+
+        Example return:
+            [
+                {
+                    "id": 14,
+                    "label": "Vicente Cameron"
+                }
+            ]
+    '''
+    if len(q.strip()) < text_search.MIN_TERM_LENGTH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Termo de busca muito curto")
+    if scope not in text_search.AUTOCOMPLETE_QUERIES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Escopo de busca inválido")
+    try:
+        db_connection = db_operations.postgres_connection();
+        db_cursor = db_connection.cursor()
+        return text_search.autocomplete(db_cursor, scope, q.strip(), limit)
+    finally:
+        db_cursor.close()
+        db_connection.close()
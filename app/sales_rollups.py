@@ -0,0 +1,113 @@
+import asyncio
+import logging
+
+import db_operations
+
+# Reports run in the same timezone used to present dates in the API
+REPORTS_TIMEZONE = 'America/Sao_Paulo'
+# Seconds between two background refreshes of the sales rollups
+REFRESH_INTERVAL = 60
+# Orders updated slightly before the last watermark are read again, so transactions that committed late are not lost.
+# Recalculating a day is idempotent, so reading an order twice is harmless.
+WATERMARK_OVERLAP = '5 minutes'
+
+logger = logging.getLogger(__name__)
+
+def refresh_sales_rollups(db_cursor) -> int:
+    '''Recalculates the daily rollups (sections, products and clients) of every day touched since the last refresh.
+    Only days with orders created, changed or deleted after the watermark are rebuilt, never the whole history.
+    Returns the number of days refreshed. Commit is up to the caller.
+
+    db_cursor: cursor used for the refresh.
+    '''
+    # Locking the state row keeps concurrent refreshes (one per worker) from interleaving
+    watermark = db_operations.select(db_cursor,
+        "SELECT watermark, NOW() FROM report_refresh_state WHERE name = 'sales' FOR UPDATE", fetch=1)
+    if watermark == None:
+        db_operations.insert(db_cursor,
+            "INSERT INTO report_refresh_state (name, watermark) VALUES ('sales', '1900-01-01 00:00:00+00') ON CONFLICT DO NOTHING", ())
+        watermark = db_operations.select(db_cursor,
+            "SELECT watermark, NOW() FROM report_refresh_state WHERE name = 'sales' FOR UPDATE", fetch=1)
+    last_watermark, new_watermark = watermark
+    query = f"""
+        SELECT DISTINCT (created_at AT TIME ZONE %s)::date FROM orders WHERE updated_at > %s - INTERVAL '{WATERMARK_OVERLAP}'
+        UNION
+        SELECT day FROM report_dirty_days
+    """
+    days = [row[0] for row in db_operations.select(db_cursor, query, (REPORTS_TIMEZONE, last_watermark,))]
+    if len(days) > 0:
+        refresh_days(db_cursor, days)
+        db_operations.insert(db_cursor, "DELETE FROM report_dirty_days WHERE day = ANY(%s)", (days,))
+    db_operations.insert(db_cursor,
+        "UPDATE report_refresh_state SET watermark = %s WHERE name = 'sales'", (new_watermark,))
+    return len(days)
+
+def refresh_days(db_cursor, days: list):
+    '''Rebuilds the rollup rows of the given days from orders, orders_products and products.
+
+    days: list of dates to be rebuilt.
+    '''
+    # Range on created_at lets the planner use idx_orders_created_at before the per day filter
+    day_filter = """
+        o.created_at >= (%s::date - 1) AND o.created_at < (%s::date + 2)
+        AND (o.created_at AT TIME ZONE %s)::date = ANY(%s)
+        AND o.status <> 1
+    """
+    day_args = (min(days), max(days), REPORTS_TIMEZONE, days,)
+    for table in ('sales_daily_sections', 'sales_daily_products', 'sales_daily_clients'):
+        db_operations.insert(db_cursor, f"DELETE FROM {table} WHERE day = ANY(%s)", (days,))
+    db_operations.insert(db_cursor, f"""
+        INSERT INTO sales_daily_sections (day, section_id, orders, units, revenue)
+        SELECT (o.created_at AT TIME ZONE %s)::date, p.section_id, COUNT(DISTINCT o.id), SUM(op.quantity), SUM(op.quantity * op.unit_price)
+        FROM orders o
+        JOIN orders_products op ON o.id = op.order_id
+        JOIN products p ON op.product_id = p.id
+        WHERE {day_filter}
+        GROUP BY 1, 2
+    """, (REPORTS_TIMEZONE,) + day_args)
+    db_operations.insert(db_cursor, f"""
+        INSERT INTO sales_daily_products (day, product_id, orders, units, revenue)
+        SELECT (o.created_at AT TIME ZONE %s)::date, op.product_id, COUNT(DISTINCT o.id), SUM(op.quantity), SUM(op.quantity * op.unit_price)
+        FROM orders o
+        JOIN orders_products op ON o.id = op.order_id
+        WHERE {day_filter}
+        GROUP BY 1, 2
+    """, (REPORTS_TIMEZONE,) + day_args)
+    # Order totals are kept on the orders row, so clients need no join
+    db_operations.insert(db_cursor, f"""
+        INSERT INTO sales_daily_clients (day, client_id, orders, units, revenue)
+        SELECT (o.created_at AT TIME ZONE %s)::date, o.client_id, COUNT(*), SUM(o.item_count), SUM(o.total_value)
+        FROM orders o
+        WHERE {day_filter}
+        GROUP BY 1, 2
+    """, (REPORTS_TIMEZONE,) + day_args)
+
+def mark_dirty_days(db_cursor, query: str, args: tuple):
+    '''Flags days to be rebuilt on the next refresh. Used before deletes, which leave nothing behind for the watermark.
+
+    query: a SELECT returning the days to flag.
+    '''
+    db_operations.insert(db_cursor, f"INSERT INTO report_dirty_days (day) {query} ON CONFLICT DO NOTHING", args)
+
+def refresh_now() -> int:
+    '''Runs one refresh on its own connection and commits it. Returns the number of days refreshed.
+    '''
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    try:
+        refreshed = refresh_sales_rollups(db_cursor)
+        db_connection.commit()
+        return refreshed
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+async def refresh_loop():
+    '''Keeps the sales rollups up to date in background, refreshing every REFRESH_INTERVAL seconds.
+    '''
+    while True:
+        try:
+            await asyncio.to_thread(refresh_now)
+        except Exception:
+            logger.exception("Sales rollup refresh failed")
+        await asyncio.sleep(REFRESH_INTERVAL)
@@ -0,0 +1,113 @@
+import itertools
+import logging
+import queue
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import db_operations
+import query_stats
+
+# Statements taking longer than this many seconds are logged and explained
+SLOW_QUERY_THRESHOLD = 0.2
+# Slow statements kept for get(/diagnostics/slow-queries), oldest are dropped first
+BUFFER_SIZE = 100
+# Statements waiting to be explained. Past this, new ones are logged without a plan.
+EXPLAIN_QUEUE_SIZE = 20
+# Seconds before a statement of the same shape is explained again
+EXPLAIN_COOLDOWN = 60
+# Limits for the EXPLAIN, so it never holds up the routes waiting on the same rows
+EXPLAIN_STATEMENT_TIMEOUT = '30s'
+EXPLAIN_LOCK_TIMEOUT = '1s'
+
+logger = logging.getLogger(__name__)
+
+entries = deque(maxlen=BUFFER_SIZE)
+pending = queue.Queue(maxsize=EXPLAIN_QUEUE_SIZE)
+explained_at = {}
+ids = itertools.count(1)
+worker_lock = threading.Lock()
+worker_thread = None
+
+WRITE_STATEMENT = re.compile(r'\b(?:INSERT|UPDATE|DELETE|MERGE|COPY|CREATE|DROP|ALTER|TRUNCATE|LOCK)\b', re.IGNORECASE)
+READ_STATEMENT = re.compile(r'^\s*(?:SELECT|WITH|VALUES|TABLE)\b', re.IGNORECASE)
+
+def is_read_only(query: str) -> bool:
+    '''Returns whether running the statement again changes nothing and locks no rows, so EXPLAIN ANALYZE can run it.
+    Writes and SELECT ... FOR UPDATE are only planned.
+    '''
+    return READ_STATEMENT.match(query) != None and WRITE_STATEMENT.search(query) == None
+
+def record(query: str, args, duration: float, rowcount: int, caller: str):
+    '''db_operations hook logging statements slower than SLOW_QUERY_THRESHOLD and queueing them to be explained.
+    '''
+    if duration < SLOW_QUERY_THRESHOLD:
+        return
+    params = list(args) if args != None else []
+    statement = query_stats.WHITESPACE.sub(' ', query).strip()
+    logger.warning("Slow query (%.1f ms) from %s: %s params=%r", duration * 1000, caller, statement, params)
+    entry = {
+        'id': next(ids),
+        'query': statement,
+        'params': params,
+        'duration_ms': round(duration * 1000, 2),
+        'rows': rowcount,
+        'caller': caller,
+        'recorded_at': datetime.now(timezone.utc),
+        'analyzed': is_read_only(query),
+        'plan': None,
+    }
+    entries.append(entry)
+    shape = query_stats.normalize(query)
+    now = time.monotonic()
+    if explained_at.get(shape, -EXPLAIN_COOLDOWN) + EXPLAIN_COOLDOWN > now:
+        return
+    try:
+        pending.put_nowait((entry, query, args))
+        explained_at[shape] = now
+    except queue.Full:
+        pass
+
+def explain(entry: dict, query: str, args):
+    '''Runs EXPLAIN for the entry on a connection of its own, rolled back afterwards, and stores the plan in it.
+    '''
+    options = 'ANALYZE, BUFFERS' if entry['analyzed'] else 'VERBOSE'
+    db_connection = db_operations.postgres_connection()
+    try:
+        db_cursor = db_connection.cursor()
+        # Straight on the cursor, so the EXPLAIN isn't seen by the hooks and recorded as a slow query itself
+        db_cursor.execute(f"SET LOCAL statement_timeout = '{EXPLAIN_STATEMENT_TIMEOUT}'")
+        db_cursor.execute(f"SET LOCAL lock_timeout = '{EXPLAIN_LOCK_TIMEOUT}'")
+        db_cursor.execute(f"EXPLAIN ({options}) {query}", args)
+        entry['plan'] = '\n'.join(row[0] for row in db_cursor.fetchall())
+    except Exception as error:
+        entry['plan'] = f"EXPLAIN failed: {str(error).strip()}"
+    finally:
+        db_connection.rollback()
+        db_connection.close()
+
+def explain_worker():
+    while True:
+        entry, query, args = pending.get()
+        try:
+            explain(entry, query, args)
+        except Exception:
+            logger.exception("Explaining slow query failed")
+
+def start():
+    '''Starts recording slow statements, with a thread explaining them in the background.
+    '''
+    global worker_thread
+    with worker_lock:
+        if record not in db_operations.hooks:
+            db_operations.hooks.append(record)
+        if worker_thread == None:
+            worker_thread = threading.Thread(target=explain_worker, name='slow-queries', daemon=True)
+            worker_thread.start()
+
+def get_entries(limit: int = BUFFER_SIZE, min_duration: float = 0) -> list:
+    '''Returns the recorded slow statements, most recent first.
+    '''
+    return [entry for entry in reversed(entries) if entry['duration_ms'] >= min_duration * 1000][:limit]
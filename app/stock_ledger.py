@@ -0,0 +1,134 @@
+import asyncio
+import logging
+
+import db_operations
+
+# Reasons recorded in stock_movements
+ORDER_INCLUDED = 'inclusao_ordem'
+ORDER_REMOVED = 'remocao_ordem'
+ORDER_CANCELLED = 'cancelamento_ordem'
+ADJUSTMENT = 'ajuste'
+REGISTRATION = 'cadastro'
+
+# Seconds between two background compactions
+COMPACT_INTERVAL = 30
+# Products folded per transaction
+COMPACT_BATCH_SIZE = 500
+# Movements returned per page of a product's history
+HISTORY_PAGE_SIZE = 20
+
+logger = logging.getLogger(__name__)
+
+def compact(db_cursor) -> int:
+    '''Folds the pending movements of up to COMPACT_BATCH_SIZE products into products.stock and advances their stock_folded_xid.
+    Movements are kept as history and never updated, only the watermark moves. Returns the number of products compacted.
+    Commit is up to the caller.
+
+    Sharded products only advance the watermark, their stock already lives in the shards.
+    '''
+    # Every transaction before the oldest one still running has ended, so all of its movements are visible and no more can
+    # come: those are folded. Movements of later transactions stay pending for the next run, whatever their ids.
+    horizon = db_operations.select(db_cursor, "SELECT pg_snapshot_xmin(pg_current_snapshot())::text", fetch=1)[0]
+    # NO KEY UPDATE is enough for updating the stock and doesn't conflict with the key share lock taken by the foreign key
+    # of new movements, so orders keep appending to these products while they are compacted.
+    products = db_operations.select(db_cursor,
+        """
+        SELECT p.id FROM products p
+        WHERE EXISTS (
+            SELECT 1 FROM stock_movements m
+            WHERE m.product_id = p.id AND m.txid >= p.stock_folded_xid AND m.txid < %s::xid8
+        )
+        ORDER BY p.id
+        LIMIT %s
+        FOR NO KEY UPDATE
+        """,
+        (horizon, COMPACT_BATCH_SIZE,))
+    if len(products) == 0:
+        return 0
+    db_operations.insert(db_cursor,
+        """
+        UPDATE products p SET
+            stock = p.stock + CASE WHEN p.stock_shards > 0 THEN 0 ELSE m.total END,
+            stock_folded_xid = %s::xid8
+        FROM (
+            SELECT m.product_id, SUM(m.delta) AS total
+            FROM stock_movements m
+            JOIN products locked ON locked.id = m.product_id
+            WHERE m.product_id = ANY(%s) AND m.txid >= locked.stock_folded_xid AND m.txid < %s::xid8
+            GROUP BY m.product_id
+        ) m
+        WHERE p.id = m.product_id
+        """,
+        (horizon, [row[0] for row in products], horizon,))
+    return len(products)
+
+def prune_changes(db_cursor) -> int:
+    '''Deletes the changes of product_changes superseded by a later change of the same product, keeping one row per product
+    (two if it was deleted, the tombstone is only replaced by another one). Returns the number of rows deleted. Commit is up to the caller.
+
+    A sync lists a product if it has a change from its since on, so only the latest change of each product is needed:
+    get(/products/changes) returns the product as it is now, not the change itself.
+    '''
+    return db_operations.select(db_cursor,
+        """
+        WITH pruned AS (
+            DELETE FROM product_changes c
+            WHERE EXISTS (
+                SELECT 1 FROM product_changes newer
+                WHERE newer.product_id = c.product_id AND (newer.txid, newer.seq) > (c.txid, c.seq) AND (newer.deleted OR NOT c.deleted)
+            )
+            RETURNING 1
+        )
+        SELECT COUNT(*) FROM pruned
+        """,
+        fetch=1)[0]
+
+def get_history(db_cursor, product_id: int, offset: int = 0) -> list:
+    '''Returns a page of a product's stock movements, newest first.
+    '''
+    result = db_operations.select(db_cursor,
+        """
+        SELECT id, delta, reason, order_id, created_at FROM stock_movements
+        WHERE product_id = %s
+        ORDER BY id DESC
+        LIMIT %s OFFSET %s
+        """,
+        (product_id, HISTORY_PAGE_SIZE, offset,))
+    return [
+        {'id': row[0], 'delta': row[1], 'reason': row[2], 'order_id': row[3], 'created_at': row[4]}
+        for row in result
+    ]
+
+def compact_now() -> int:
+    '''Compacts every product with pending movements, one batch per transaction. Returns the number of products compacted.
+    '''
+    db_connection = db_operations.postgres_connection()
+    db_cursor = db_connection.cursor()
+    compacted = 0
+    try:
+        while True:
+            batch = compact(db_cursor)
+            db_connection.commit()
+            compacted += batch
+            if batch < COMPACT_BATCH_SIZE:
+                break
+        # Every stock movement records a product change, so they are pruned along
+        prune_changes(db_cursor)
+        db_connection.commit()
+        return compacted
+    except:
+        db_connection.rollback()
+        raise
+    finally:
+        db_cursor.close()
+        db_connection.close()
+
+async def compact_loop():
+    '''Compacts the stock ledger and prunes product_changes every COMPACT_INTERVAL seconds.
+    '''
+    while True:
+        try:
+            await asyncio.to_thread(compact_now)
+        except Exception:
+            logger.exception("Stock ledger compaction failed")
+        await asyncio.sleep(COMPACT_INTERVAL)
@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+
+import db_operations
+import metrics
+
+# Seconds an autocomplete result is served from memory. New or edited clients and products may take this long to show up.
+AUTOCOMPLETE_TTL = 30
+# Autocomplete results kept per worker process, least recently used are dropped first
+AUTOCOMPLETE_CACHE_SIZE = 1024
+# Shortest term searched. Trigram indexes can't narrow down a single character.
+MIN_TERM_LENGTH = 2
+
+# Ranks matches by how closely the term matches a whole word of the field, best first
+CLIENT_RANK = "GREATEST(word_similarity(%s, name), word_similarity(%s, email)) DESC, id"
+PRODUCT_RANK = "GREATEST(word_similarity(%s, p.description), word_similarity(%s, p.barcode)) DESC, p.id"
+
+AUTOCOMPLETE_QUERIES = {
+    'clients': """
+        SELECT id, name FROM clients
+        WHERE name ILIKE %s OR email ILIKE %s
+        ORDER BY name, id
+        LIMIT %s
+    """,
+    'products': """
+        SELECT id, description FROM products
+        WHERE description ILIKE %s OR barcode LIKE %s
+        ORDER BY description, id
+        LIMIT %s
+    """,
+}
+
+def like_pattern(term: str, prefix: bool = False) -> str:
+    '''Returns a LIKE pattern matching the term anywhere in the field, or only at its start if prefix is True.
+    Wildcards typed by the user are matched literally.
+    '''
+    term = term.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    if prefix:
+        return term + '%'
+    return '%' + term + '%'
+
+class ResultCache():
+    '''
+    Small LRU cache whose entries expire after ttl seconds. Shared by the requests of a worker process.
+    '''
+    def __init__(self, ttl: float = AUTOCOMPLETE_TTL, max_size: int = AUTOCOMPLETE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''Returns the cached value, or None if missing or expired.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+autocomplete_cache = ResultCache()
+
+def autocomplete(db_cursor, scope: str, term: str, limit: int) -> list:
+    '''Returns up to limit {'id', 'label'} dicts of clients (by name or email) or products (by description or barcode) starting with the term.
+    Raises ValueError for unknown scopes.
+    '''
+    if scope not in AUTOCOMPLETE_QUERIES:
+        raise ValueError
+    key = (scope, term.lower(), limit)
+    result = autocomplete_cache.get(key)
+    metrics.record_cache('autocomplete', result != None)
+    if result == None:
+        pattern = like_pattern(term, prefix=True)
+        result = [
+            {'id': row[0], 'label': row[1]}
+            for row in db_operations.select(db_cursor, AUTOCOMPLETE_QUERIES[scope], (pattern, pattern, limit,))
+        ]
+        autocomplete_cache.set(key, result)
+    return result
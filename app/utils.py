@@ -12,7 +12,9 @@ import db_operations
 
 from base_models import TokenData, User
 import random
+import re
 import base64
+import numpy as np
 import pytz
 
 # Hash and secret declarations
@@ -187,6 +189,33 @@ def validate_cpf(cpf:str) -> bool:
 
     return True
 
+def validate_cpfs(cpfs: list) -> np.ndarray:
+    ''' Validates many CPFs at once, with the same rules of validate_cpf. Returns an array of bools in the order of cpfs.
+
+    The check digits are calculated for all CPFs together with array arithmetic instead of one by one.
+
+    cpfs: list of CPFs to be validated
+    '''
+    well_formed = np.array([type(cpf) == str and len(cpf) == 11 and cpf.isascii() and cpf.isdigit() for cpf in cpfs], dtype=bool)
+    if not well_formed.any():
+        return well_formed
+    text = ''.join(cpf if ok else '00000000000' for cpf, ok in zip(cpfs, well_formed))
+    digits = (np.frombuffer(text.encode('ascii'), dtype=np.uint8).reshape(-1, 11) - ord('0')).astype(np.int32)
+    first_digit = (digits[:, :9] @ np.arange(10, 1, -1) * 10 % 11) % 10
+    second_digit = (digits[:, :10] @ np.arange(11, 1, -1) * 10 % 11) % 10
+    repeated = (digits == digits[:, :1]).all(axis=1)
+    return well_formed & ~repeated & (digits[:, 9] == first_digit) & (digits[:, 10] == second_digit)
+
+# Same rules of validate_email: x chars + '@' + y chars + '.' + z chars, with a single '@' and a single '.' after it
+EMAIL_PATTERN = re.compile(r'[^@]+@[^@.]+\.[^@.]+')
+
+def validate_emails(emails: list) -> np.ndarray:
+    ''' Validates many emails at once, with the same rules of validate_email. Returns an array of bools in the order of emails.
+
+    emails: list of emails to be validated
+    '''
+    return np.array([type(email) == str and EMAIL_PATTERN.fullmatch(email) != None for email in emails], dtype=bool)
+
 def validate_email(email: str) -> bool:
     ''' Validates if email is valid. Returns a bool.
 
@@ -211,16 +240,31 @@ def validate_email(email: str) -> bool:
     except:
         return False
     
-def generate_cpf():
-    '''Generates random valid CPF
+def generate_cpf(number: int | None = None):
+    '''Generates valid CPF. Random, unless number is given: its last 9 digits are the base of the CPF, so different numbers below 10^9 give different CPFs.
     '''
-    cpf = [random.randint(0, 9) for x in range(9)]                              
+    if number == None:
+        cpf = [random.randint(0, 9) for x in range(9)]
+    else:
+        cpf = [int(digit) for digit in f"{number % 10**9:09d}"]
     for i in range(2):
         val = sum([(len(cpf) + 1 - j) * v for j, v in enumerate(cpf)]) % 11
         cpf.append(11 - val if val > 1 else 0)
     string_cpf = [str(x) for x in cpf]
     return ''.join(string_cpf)
 
+def generate_cpfs(numbers) -> list:
+    ''' Generates the CPFs of many numbers at once, the same as generate_cpf(number) for each. Returns a list of strings in the order of numbers.
+
+    numbers: list or array of ints
+    '''
+    digits = (np.asarray(numbers, dtype=np.int64)[:, None] % 10**9 // 10 ** np.arange(8, -1, -1, dtype=np.int64)) % 10
+    for weights in (np.arange(10, 1, -1), np.arange(11, 1, -1)):
+        val = digits @ weights % 11
+        digits = np.column_stack([digits, np.where(val > 1, 11 - val, 0)])
+    text = (digits + ord('0')).astype(np.uint8).tobytes().decode('ascii')
+    return [text[i:i + 11] for i in range(0, len(text), 11)]
+
 def get_section_id(db_cursor, name: str):
     try:
         name = '%'+name.lower()+'%'
@@ -4,6 +4,8 @@ GRANT ALL PRIVILEGES ON DATABASE infog2 TO admin;
 
 \c infog2;
 
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 CREATE TABLE IF NOT EXISTS roles (
     id  SERIAL PRIMARY KEY,
     name VARCHAR(50) NOT NULL UNIQUE
@@ -44,7 +46,18 @@ CREATE TABLE IF NOT EXISTS products (
     barcode varchar(50) NOT NULL UNIQUE,
     section_id SMALLINT NOT NULL REFERENCES sections(id) ON DELETE CASCADE,
     stock INT NOT NULL,
-    expiration_date DATE
+    expiration_date DATE,
+    stock_shards SMALLINT NOT NULL DEFAULT 0,
+    stock_folded_xid XID8 NOT NULL DEFAULT '0'
+);
+
+-- Stock of products with stock_shards > 0, split in that many rows so concurrent orders don't queue on a single row.
+-- products.stock is not used while a product is sharded.
+CREATE TABLE IF NOT EXISTS product_stock_shards (
+    product_id INT NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    slot SMALLINT NOT NULL,
+    stock INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (product_id, slot)
 );
 
 CREATE TABLE IF NOT EXISTS images (
@@ -62,25 +75,155 @@ CREATE TABLE IF NOT EXISTS orders (
     id SERIAL PRIMARY KEY,
     created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
     status SMALLINT DEFAULT 2 REFERENCES clients(id) ON DELETE CASCADE,
-    client_id INT NOT NULL REFERENCES clients(id) ON DELETE CASCADE
+    client_id INT NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+    item_count INT NOT NULL DEFAULT 0,
+    total_value DECIMAL(11,2) NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
 );
 
 CREATE TABLE IF NOT EXISTS orders_products(
     id SERIAL PRIMARY KEY,
     order_id INT NOT NULL REFERENCES orders(id) ON DELETE CASCADE,
     product_id INT NOT NULL REFERENCES products(id) ON DELETE CASCADE,
-    quantity SMALLINT NOT NULL DEFAULT 1
+    quantity SMALLINT NOT NULL DEFAULT 1,
+    unit_price DECIMAL(9,2) NOT NULL DEFAULT 0
 );
 
 CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at);
 CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status);
 CREATE INDEX IF NOT EXISTS idx_orders_client_id ON orders (client_id);
+CREATE INDEX IF NOT EXISTS idx_orders_item_count ON orders (item_count);
+CREATE INDEX IF NOT EXISTS idx_orders_total_value ON orders (total_value);
 
 CREATE INDEX IF NOT EXISTS idx_orders_products_order_id ON orders_products (order_id);
 CREATE INDEX IF NOT EXISTS idx_orders_products_product_id ON orders_products (product_id);
 
 CREATE INDEX IF NOT EXISTS idx_products_section_id ON products (section_id);
 
+-- ############# Search ##############
+
+-- Trigram indexes serve the substring (ILIKE '%x%') and prefix searches of clients and products
+CREATE INDEX IF NOT EXISTS idx_clients_name_trgm ON clients USING GIN (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_clients_email_trgm ON clients USING GIN (email gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_products_description_trgm ON products USING GIN (description gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_products_barcode_trgm ON products USING GIN (barcode gin_trgm_ops);
+
+-- ############# Stock ledger ##############
+
+-- Every stock change is appended here instead of updating products.stock in place, so orders don't queue on the product row.
+-- Movements of transactions before products.stock_folded_xid are already folded into products.stock by the compactor, which
+-- only moves that watermark up to transactions that have all ended. Rows are never updated. Transaction ids are used
+-- instead of movement ids, as ids are taken before commit and a movement may commit after others with higher ids.
+CREATE TABLE IF NOT EXISTS stock_movements (
+    id BIGSERIAL PRIMARY KEY,
+    product_id INT NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    delta INT NOT NULL,
+    reason VARCHAR(30) NOT NULL,
+    order_id INT REFERENCES orders(id) ON DELETE SET NULL,
+    txid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_stock_movements_product_id ON stock_movements (product_id, id);
+CREATE INDEX IF NOT EXISTS idx_stock_movements_product_txid ON stock_movements (product_id, txid);
+
+-- ############# Catalog changes ##############
+
+-- Products created, changed (including stock) or deleted, read by catalog syncs through get(/products/changes).
+-- Rows are ordered by the id of the writing transaction, so a sync never misses a change committed after it read.
+-- No foreign key, so deletions are kept as tombstones. Only the latest change of each product is kept, see stock_ledger.prune_changes.
+CREATE TABLE IF NOT EXISTS product_changes (
+    seq BIGSERIAL PRIMARY KEY,
+    product_id INT NOT NULL,
+    deleted BOOLEAN NOT NULL DEFAULT FALSE,
+    txid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_product_changes_txid ON product_changes (txid);
+CREATE INDEX IF NOT EXISTS idx_product_changes_product_id ON product_changes (product_id, txid);
+
+-- ############# Order intake ##############
+-- Orders accepted with "Prefer: respond-async", waiting for order_intake.py workers
+CREATE TABLE IF NOT EXISTS order_intake (
+    id SERIAL PRIMARY KEY,
+    username VARCHAR(50) NOT NULL,
+    client_id INT NOT NULL,
+    products JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pendente',
+    order_id INT REFERENCES orders(id) ON DELETE SET NULL,
+    error JSONB,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    processed_at TIMESTAMP WITH TIME ZONE
+);
+
+CREATE INDEX IF NOT EXISTS idx_order_intake_pending ON order_intake (id) WHERE status = 'pendente';
+
+-- ############# Idempotency ##############
+-- Responses of mutating requests sent with an Idempotency-Key header, see idempotency.py. status_code is NULL while in flight.
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    username VARCHAR(50) NOT NULL,
+    key VARCHAR(255) NOT NULL,
+    route VARCHAR(100) NOT NULL,
+    request_hash CHAR(64) NOT NULL,
+    status_code SMALLINT,
+    content_type VARCHAR(100),
+    response BYTEA,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    PRIMARY KEY (username, key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys (expires_at);
+
+-- ############# Reports ##############
+-- Daily rollups kept by sales_rollups.refresh_sales_rollups. Days are in America/Sao_Paulo and cancelled orders are left out.
+CREATE TABLE IF NOT EXISTS sales_daily_sections (
+    day DATE NOT NULL,
+    section_id SMALLINT NOT NULL REFERENCES sections(id) ON DELETE CASCADE,
+    orders INT NOT NULL DEFAULT 0,
+    units INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(14,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, section_id)
+);
+
+CREATE TABLE IF NOT EXISTS sales_daily_products (
+    day DATE NOT NULL,
+    product_id INT NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    orders INT NOT NULL DEFAULT 0,
+    units INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(14,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, product_id)
+);
+
+CREATE TABLE IF NOT EXISTS sales_daily_clients (
+    day DATE NOT NULL,
+    client_id INT NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+    orders INT NOT NULL DEFAULT 0,
+    units INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(14,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, client_id)
+);
+
+-- Last orders.updated_at already folded into the rollups
+CREATE TABLE IF NOT EXISTS report_refresh_state (
+    name VARCHAR(50) PRIMARY KEY,
+    watermark TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+-- Days whose orders were deleted, which the watermark alone can't see
+CREATE TABLE IF NOT EXISTS report_dirty_days (
+    day DATE PRIMARY KEY
+);
+
+CREATE INDEX IF NOT EXISTS idx_orders_updated_at ON orders (updated_at);
+CREATE INDEX IF NOT EXISTS idx_sales_daily_sections_section_id ON sales_daily_sections (section_id, day);
+CREATE INDEX IF NOT EXISTS idx_sales_daily_products_product_id ON sales_daily_products (product_id, day);
+CREATE INDEX IF NOT EXISTS idx_sales_daily_clients_client_id ON sales_daily_clients (client_id, day);
+
+INSERT INTO report_refresh_state (name, watermark) VALUES ('sales', '1900-01-01 00:00:00+00')
+ON CONFLICT DO NOTHING;
+
 -- ############# Sample data ##############
 INSERT INTO roles (name)
 VALUES 
@@ -336,3 +479,15 @@ INSERT INTO orders_products (order_id, product_id, quantity) VALUES
 
 ON CONFLICT DO NOTHING;
 
+-- Sample order lines are inserted without price, so unit prices and order totals are derived here
+UPDATE orders_products op SET unit_price = p.sell_value
+FROM products p
+WHERE p.id = op.product_id;
+
+UPDATE orders o SET item_count = t.item_count, total_value = t.total_value
+FROM (
+    SELECT order_id, SUM(quantity) AS item_count, SUM(quantity * unit_price) AS total_value
+    FROM orders_products
+    GROUP BY order_id
+) t
+WHERE t.order_id = o.id;